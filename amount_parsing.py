@@ -0,0 +1,212 @@
+from typing import Callable, NamedTuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+# : `amount_parsing.py` parses amount strings (eg "<0.01", "> 5", "= 12", "BDL" or "ND") for
+# : `data_cleaning.parse_amounts`. If numba is installed a compiled kernel scans the UTF-8 bytes
+# : of all the strings once, otherwise (or with `jit=False`, or for fewer than `JIT_MIN_STRINGS`
+# : strings) they are parsed with pandas regexes.
+# : Both give exactly the same results: the kernel only converts numbers which it can convert
+# : exactly like `float()`, and leaves the others (and non-ASCII strings) to the regex path.
+
+
+AMOUNT_PATTERN = r'\A([<>=]?)([0-9]*\.?[0-9]+)\Z'
+BELOW_DETECTION_LIMIT = ["BDL", "ND"]
+
+# prefix codes
+NO_PREFIX, LESS, GREATER, EQUAL = 0, 1, 2, 3
+PREFIX_CODES = {"": NO_PREFIX, "<": LESS, ">": GREATER, "=": EQUAL}
+
+# status codes, FALLBACK is only used within the kernel
+NUMBER, BELOW_LIMIT, INVALID, FALLBACK = 0, 1, 2, 3
+
+# numbers with a mantissa below 2 ** 53 and at most 22 decimals are converted exactly
+# (both are exact doubles so a single division is correctly rounded)
+MAX_MANTISSA = 2 ** 53
+POWERS_OF_TEN = np.array([10.0 ** power for power in range(23)])
+
+# fewer strings are parsed with regexes, which is quicker than importing numba
+# and loading the compiled kernel (about a second in each new process)
+JIT_MIN_STRINGS = 10000
+
+
+class ParsedAmounts(NamedTuple):
+    """
+    The parsed amount strings, `prefix_codes` (see `PREFIX_CODES`), `values`
+    (NaN unless `status` is NUMBER) and `status` (NUMBER, BELOW_LIMIT or INVALID).
+    """
+    prefix_codes: np.ndarray
+    values: np.ndarray
+    status: np.ndarray
+
+    @property
+    def invalid(self) -> np.ndarray:
+        return self.status == INVALID
+
+
+def scan_amounts(data: np.ndarray,
+                 offsets: np.ndarray,
+                 prefix_codes: np.ndarray,
+                 values: np.ndarray,
+                 status: np.ndarray) -> None:
+    """
+    Parses each string `data[offsets[i]:offsets[i + 1]]` (UTF-8 bytes) into the output arrays,
+    ignoring whitespace. Strings which are not ASCII or whose number may not be
+    converted exactly are FALLBACK. Compiled by `compiled_kernel`.
+    """
+    for row in range(len(offsets) - 1):
+        prefix = NO_PREFIX
+        mantissa = 0
+        n_digits = 0
+        n_decimals = 0
+        seen_dot = False
+        exact = True
+        other = False
+        is_ascii = True
+        n_chars = 0
+        # the first three characters, for "BDL" and "ND"
+        first = 0
+        second = 0
+        third = 0
+
+        for position in range(offsets[row], offsets[row + 1]):
+            char = data[position]
+            if char >= 128:
+                is_ascii = False
+                break
+            # the ASCII characters python's str.split() and regex \s treat as whitespace
+            if char == 32 or 9 <= char <= 13 or 28 <= char <= 31:
+                continue
+            if n_chars == 0:
+                first = char
+            elif n_chars == 1:
+                second = char
+            elif n_chars == 2:
+                third = char
+            n_chars += 1
+
+            if 48 <= char <= 57:
+                n_digits += 1
+                if seen_dot:
+                    n_decimals += 1
+                mantissa = mantissa * 10 + (char - 48)
+                if mantissa >= MAX_MANTISSA:
+                    exact = False
+                    mantissa = 0
+            elif char == 46 and not seen_dot:
+                seen_dot = True
+                # digits are only valid after the dot
+                n_digits = 0
+            elif n_chars == 1 and char == 60:
+                prefix = LESS
+            elif n_chars == 1 and char == 62:
+                prefix = GREATER
+            elif n_chars == 1 and char == 61:
+                prefix = EQUAL
+            else:
+                other = True
+
+        prefix_codes[row] = prefix
+        values[row] = np.nan
+        if not is_ascii:
+            status[row] = FALLBACK
+        elif other:
+            if (n_chars == 3 and first == 66 and second == 68 and third == 76) or \
+                    (n_chars == 2 and first == 78 and second == 68):
+                status[row] = BELOW_LIMIT
+            else:
+                status[row] = INVALID
+            prefix_codes[row] = NO_PREFIX
+        elif n_digits == 0:
+            status[row] = INVALID
+            prefix_codes[row] = NO_PREFIX
+        elif not exact or n_decimals >= len(POWERS_OF_TEN):
+            status[row] = FALLBACK
+        else:
+            status[row] = NUMBER
+            values[row] = mantissa / POWERS_OF_TEN[n_decimals]
+
+
+compiled_scan_amounts: Callable | None = None
+
+
+def compiled_kernel() -> Callable | None:
+    """
+    Returns `scan_amounts` compiled with numba (cached on disk), or None if numba is not installed.
+    """
+    global compiled_scan_amounts
+    if compiled_scan_amounts is None:
+        try:
+            import numba
+        except ImportError:
+            return None
+        compiled_scan_amounts = numba.njit(cache=True, nogil=True)(scan_amounts)
+    return compiled_scan_amounts
+
+
+def jit_available() -> bool:
+    return compiled_kernel() is not None
+
+
+def encode_strings(strings: np.ndarray | list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the UTF-8 bytes of all the strings in one buffer and the offset
+    of each string in it (with the end as the last offset).
+    """
+    array = pa.array(strings, type=pa.large_string())
+    (_, offsets, data) = array.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[array.offset:array.offset + len(array) + 1]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.zeros(0, dtype=np.uint8)
+    return (data, offsets)
+
+
+def parse_amount_strings_python(strings: np.ndarray | list[str]) -> ParsedAmounts:
+    """
+    Parses amount strings with pandas string methods, see `parse_amount_strings`.
+    """
+    # remove whitespace then match prefix-numerical form
+    text = pd.Series(np.asarray(strings, dtype=object), dtype=object).str.replace(r'\s+', '', regex=True)
+    parts = text.str.extract(AMOUNT_PATTERN)
+    matched = parts[1].notna().to_numpy()
+
+    prefix_codes = np.full(len(text), NO_PREFIX, dtype=np.int8)
+    prefix_codes[matched] = parts[0][matched].map(PREFIX_CODES).to_numpy(dtype=np.int8)
+    values = np.full(len(text), np.nan)
+    values[matched] = parts[1][matched].astype(float).to_numpy()
+    status = np.full(len(text), INVALID, dtype=np.int8)
+    status[matched] = NUMBER
+    status[text.isin(BELOW_DETECTION_LIMIT).to_numpy() & ~matched] = BELOW_LIMIT
+    return ParsedAmounts(prefix_codes, values, status)
+
+
+def parse_amount_strings(strings: np.ndarray | list[str],
+                         jit: bool = True,
+                         jit_min_strings: int = JIT_MIN_STRINGS
+                         ) -> ParsedAmounts:
+    """
+    Parses amount strings: whitespace is ignored, then a string is a number if it
+    matches `AMOUNT_PATTERN` (with an optional "<", ">" or "=" prefix) or below
+    the detection limit if it is one of `BELOW_DETECTION_LIMIT`, otherwise invalid.
+
+    Uses the compiled kernel if numba is installed, `jit` is True and there are at
+    least `jit_min_strings` strings, otherwise `parse_amount_strings_python`.
+    """
+    kernel = compiled_kernel() if jit and len(strings) >= max(jit_min_strings, 1) else None
+    if kernel is None:
+        return parse_amount_strings_python(strings)
+
+    (data, offsets) = encode_strings(strings)
+    n_strings = len(offsets) - 1
+    parsed = ParsedAmounts(np.empty(n_strings, dtype=np.int8), np.empty(n_strings),
+                           np.empty(n_strings, dtype=np.int8))
+    kernel(data, offsets, parsed.prefix_codes, parsed.values, parsed.status)
+
+    fallback = np.flatnonzero(parsed.status == FALLBACK)
+    if len(fallback) > 0:
+        remaining = parse_amount_strings_python(np.asarray(strings, dtype=object)[fallback])
+        for (column, values) in zip(parsed, remaining):
+            column[fallback] = values
+    return parsed
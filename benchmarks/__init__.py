@@ -0,0 +1,2 @@
+# : `benchmarks` generates synthetic datasets and times the cleaning stages on them.
+# : Run `python -m benchmarks --help` from the repository root.
@@ -0,0 +1,74 @@
+import argparse
+
+import pandas as pd
+
+from benchmarks.generate import write_dataset
+from benchmarks.harness import run_benchmarks, save_results, load_results, results_table, compare_results
+
+
+# : eg from the repository root
+# :     python -m benchmarks run --rows 10000 100000 1000000 --output results.json
+# :     python -m benchmarks compare baseline.json results.json
+# :     python -m benchmarks generate --rows 100000000 --output Datasets/generated.csv
+
+
+def generate_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    parser.add_argument("--censored-fraction", type=float, default=0.1)
+    parser.add_argument("--missing-fraction", type=float, default=0.1)
+    parser.add_argument("--blank-fraction", type=float, default=0.01)
+    parser.add_argument("--messy-fraction", type=float, default=0.05)
+
+
+def generate_kwargs(args: argparse.Namespace) -> dict:
+    return {
+        "duplicate_rate": args.duplicate_rate,
+        "censored_fraction": args.censored_fraction,
+        "missing_fraction": args.missing_fraction,
+        "blank_fraction": args.blank_fraction,
+        "messy_fraction": args.messy_fraction,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Benchmark the cleaning stages on generated datasets.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="time the cleaning pipelines")
+    run.add_argument("--rows", type=int, nargs="+", default=[10**4, 10**5])
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--pipelines", nargs="+", default=None)
+    run.add_argument("--no-memory", action="store_true", help="do not measure peak memory")
+    run.add_argument("--output", default="benchmark_results.json")
+    generate_options(run)
+
+    compare = commands.add_parser("compare", help="compare two results files")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+
+    generate = commands.add_parser("generate", help="write a generated dataset to csv")
+    generate.add_argument("--rows", type=int, required=True)
+    generate.add_argument("--chunk-rows", type=int, default=1000000)
+    generate.add_argument("--output", required=True)
+    generate_options(generate)
+
+    args = parser.parse_args(argv)
+
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        if args.command == "run":
+            results = run_benchmarks(args.rows, seed=args.seed, repeat=args.repeat,
+                                     trace_memory=not args.no_memory, pipelines=args.pipelines,
+                                     **generate_kwargs(args))
+            save_results(results, args.output)
+            print(results_table(results)[["rows", "pipeline", "stage", "seconds",
+                                          "rows_per_second", "peak_memory_bytes"]])
+        elif args.command == "compare":
+            print(compare_results(load_results(args.baseline), load_results(args.current)))
+        else:
+            write_dataset(args.output, args.rows, args.chunk_rows, seed=args.seed, **generate_kwargs(args))
+
+
+if __name__ == "__main__":
+    main()
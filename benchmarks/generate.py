@@ -0,0 +1,206 @@
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from cleaning_utils import create_unit_table, UnitTable
+
+
+# : `benchmarks/generate.py` generates seeded long format groundwater datasets
+# : with the same columns as the `Tests/small_*_in.csv` fixtures.
+
+
+# each unit converts to the standard as (x + offset) * scale / divisor
+UNITS = {
+    'g/L': (0, 1, 1),
+    'mg/L': (0, 1, 1e3),
+    'ug/L': (0, 1, 1e6),
+    'µg/L': (0, 1, 1e6),
+    'ng/L': (0, 1, 1e9),
+    'pH': (0, 1, 1),
+    '°C': (0, 1, 1),
+    '°F': (-32, 5, 9),
+    'uS/cm': (0, 1, 1),
+    'µS/cm': (0, 1, 1),
+}
+
+# chemical name -> (median amount in the standard unit, units it is reported in)
+CHEMICALS = {
+    'Calcium': (0.05, ['mg/L', 'g/L', 'ug/L']),
+    'Chloride': (0.1, ['mg/L', 'g/L', 'µg/L']),
+    'Sodium': (0.04, ['mg/L', 'ug/L']),
+    'Magnesium': (0.02, ['mg/L', 'ng/L']),
+    'Sulfate': (0.08, ['mg/L', 'g/L']),
+    'Nitrate': (0.005, ['mg/L', 'ug/L']),
+    'Water Temperature': (18, ['°C', '°F']),
+    'pH': (7, ['pH']),
+    'Specific Conductivity': (600, ['uS/cm', 'µS/cm']),
+}
+
+
+def unit_table() -> UnitTable:
+    """
+    Returns the unit table which converts every generated unit (after `clean_units`).
+    """
+    return create_unit_table({"".join(unit.lower().split()): conversion
+                              for unit, conversion in UNITS.items()})
+
+
+def from_standard(values: np.ndarray, units: np.ndarray) -> np.ndarray:
+    """
+    Converts `values` in the standard unit to the given `units`.
+    """
+    table = np.array(list(UNITS.values()), dtype=float)
+    offsets, scales, divisors = table[pd.Categorical(units, categories=list(UNITS)).codes].T
+    return values * divisors / scales - offsets
+
+
+def format_amounts(values: np.ndarray) -> np.ndarray:
+    """
+    Formats amounts as strings without exponents, like the source datasets.
+    """
+    return np.char.mod('%.4f', values).astype(object)
+
+
+def generate_dataset(n_rows: int,
+                     *,
+                     seed: int | np.random.SeedSequence = 0,
+                     chemicals: dict[str, tuple[float, list[str]]] | None = None,
+                     duplicate_rate: float = 0.1,
+                     censored_fraction: float = 0.1,
+                     bdl_fraction: float = 0.2,
+                     missing_fraction: float = 0.1,
+                     blank_fraction: float = 0.01,
+                     messy_fraction: float = 0.05,
+                     first_sample_id: int = 0
+                     ) -> pd.DataFrame:
+    """
+    Generates a long format dataset with exactly `n_rows` measurements.
+    The same arguments always generate the same dataset.
+
+    Parameters
+    ----------
+    `seed` : Seed of the random generator
+
+    `chemicals` : Chemical names to their median amount (in the standard unit)
+        and the units they are reported in, chosen uniformly (default `CHEMICALS`)
+
+    `duplicate_rate` : Fraction of measurements which are repeated in the same sample
+
+    `censored_fraction` : Fraction of measurements below the detection limit
+
+    `bdl_fraction` : Fraction of the censored measurements reported as BDL or ND
+        rather than "<" the detection limit
+
+    `missing_fraction` : Fraction of chemicals which are not measured in a sample
+
+    `blank_fraction` : Fraction of measurements with an empty amount
+
+    `messy_fraction` : Fraction of measurements with extra whitespace or
+        different case in the amount and unit (eg "< 0.5", " MG/l")
+
+    `first_sample_id` : The sample ids count up from this
+    """
+    if chemicals is None:
+        chemicals = CHEMICALS
+    rng = np.random.default_rng(seed)
+    names = np.array(list(chemicals.keys()), dtype=object)
+    n_chemicals = len(names)
+
+    # slots are (sample, chemical) pairs, some are not measured and some are repeated
+    rows_per_slot = (1 - missing_fraction) * (1 + duplicate_rate)
+    n_slots = int(n_rows / max(rows_per_slot, 1e-9) * 1.1) + n_chemicals
+    slots = np.empty(0, dtype=np.int64)
+    while True:
+        candidates = np.arange(n_slots, dtype=np.int64)
+        measured = candidates[rng.random(n_slots) >= missing_fraction]
+        slots = np.repeat(measured, 1 + (rng.random(len(measured)) < duplicate_rate))
+        if len(slots) >= n_rows:
+            break
+        n_slots *= 2
+    slots = slots[:n_rows]
+
+    samples = slots // n_chemicals
+    chemical_codes = slots % n_chemicals
+
+    # one collection date per sample
+    n_samples = int(samples[-1]) + 1 if n_rows > 0 else 0
+    days = rng.integers(0, 34 * 365, n_samples)
+    dates = (pd.Timestamp("1990-01-01") + pd.to_timedelta(days, unit="D")).strftime("%d/%m/%Y")
+    dates = np.asarray(dates, dtype=object)[samples]
+
+    # units and amounts
+    medians = np.array([chemicals[name][0] for name in names], dtype=float)
+    unit_choices = [chemicals[name][1] for name in names]
+    unit_index = np.floor(rng.random(n_rows) * np.array([len(u) for u in unit_choices])[chemical_codes])
+    units = np.empty(n_rows, dtype=object)
+    for code in range(n_chemicals):
+        rows = chemical_codes == code
+        units[rows] = np.asarray(unit_choices[code], dtype=object)[unit_index[rows].astype(np.int64)]
+
+    values = medians[chemical_codes] * rng.lognormal(0, 0.5, n_rows)
+    values = from_standard(values, units)
+    min_detect_limits = from_standard(medians[chemical_codes] * 0.1, units)
+
+    amounts = format_amounts(values)
+    censored = rng.random(n_rows) < censored_fraction
+    limits = format_amounts(min_detect_limits)
+    amounts[censored] = "<" + limits[censored]
+    bdl = censored & (rng.random(n_rows) < bdl_fraction)
+    amounts[bdl] = np.where(rng.random(bdl.sum()) < 0.5, "BDL", "ND")
+
+    messy = rng.random(n_rows) < messy_fraction
+    amounts[messy & censored & ~bdl] = "< " + limits[messy & censored & ~bdl]
+    amounts[messy & ~censored] = " " + amounts[messy & ~censored] + " "
+    # upper case µ does not lower back to the micro sign, so only ascii units change case
+    ascii_units = pd.Series(units).map(str.isascii).to_numpy()
+    units[messy & ascii_units] = np.char.upper(units[messy & ascii_units].astype(str)).astype(object)
+    units[messy] = " " + units[messy]
+
+    blank = rng.random(n_rows) < blank_fraction
+    amounts[blank] = np.nan
+
+    return pd.DataFrame({
+        "SampleID": samples + first_sample_id,
+        "DateCollected": dates,
+        "ChemicalName": names[chemical_codes],
+        "Amount": amounts,
+        "UOM": units,
+        "MinDetectLimit": np.round(min_detect_limits, 4),
+    })
+
+
+def iter_generated_chunks(n_rows: int,
+                          chunk_rows: int = 1000000,
+                          *,
+                          seed: int = 0,
+                          **generate_kwargs
+                          ) -> Iterator[pd.DataFrame]:
+    """
+    Generates a dataset of `n_rows` in chunks of at most `chunk_rows`, so
+    datasets larger than memory (eg 10^8 rows) can be written to disk.
+    Each chunk has its own samples and its own seed (spawned from `seed`).
+    """
+    seeds = np.random.SeedSequence(seed).spawn((n_rows + chunk_rows - 1) // chunk_rows)
+    first_sample_id = 0
+    for idx, chunk_seed in enumerate(seeds):
+        chunk = generate_dataset(min(chunk_rows, n_rows - idx * chunk_rows), seed=chunk_seed,
+                                 first_sample_id=first_sample_id, **generate_kwargs)
+        first_sample_id = int(chunk["SampleID"].iloc[-1]) + 1
+        yield chunk
+
+
+def write_dataset(path: str,
+                  n_rows: int,
+                  chunk_rows: int = 1000000,
+                  *,
+                  seed: int = 0,
+                  **generate_kwargs
+                  ) -> None:
+    """
+    Writes a generated dataset to a csv file, one chunk at a time.
+    See `iter_generated_chunks` and `generate_dataset`.
+    """
+    for idx, chunk in enumerate(iter_generated_chunks(n_rows, chunk_rows, seed=seed, **generate_kwargs)):
+        chunk.to_csv(path, mode="w" if idx == 0 else "a", header=idx == 0,
+                     index=False, encoding="utf-8")
@@ -0,0 +1,260 @@
+import json
+import time
+import platform
+import datetime
+import tracemalloc
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+from cleaning_utils import pivot_dataset, transform_chemical_data
+from pipeline import Pipeline
+from amount_parsing import JIT_MIN_STRINGS, jit_available, parse_amount_strings
+from benchmarks.generate import generate_dataset, unit_table, CHEMICALS
+
+
+# : `benchmarks/harness.py` times each cleaning stage on generated datasets
+# : of increasing size and keeps the results as json so runs can be compared.
+
+
+# stages of each pipeline, see `pipeline.STAGES`
+PIPELINES = {
+    "wide": ["pivot", "clean_units", {"format_amount": {"erase_invalid": True}},
+             {"standardise_unit": {"erase_invalid": True}}, "drop_units_min_detect",
+             "agg_measurement", {"filter_rows_by_nas": {"na_threshold": 2}},
+             "fill_nans", "sort_columns"],
+    "long": [{"clean_long": {"erase_invalid": True}}, {"filter_rows_by_nas": {"na_threshold": 2}},
+             "fill_nans", "sort_columns"],
+    "fused": [{"clean_fused": {"erase_invalid": True}}, {"filter_rows_by_nas": {"na_threshold": 2}},
+              "fill_nans", "sort_columns"],
+}
+
+
+def benchmark_context(chemical_names: list[str]) -> dict[str, Any]:
+    """
+    Returns the pipeline settings for a generated dataset.
+    """
+    return {
+        "sample_id_columns": ["SampleID"],
+        "per_sample_data": ["DateCollected"],
+        "chemical_name_column": "ChemicalName",
+        "desired_chemical_names": chemical_names,
+        "units": unit_table(),
+    }
+
+
+def time_call(func: Callable[[], Any], trace_memory: bool = False) -> dict[str, Any]:
+    """
+    Calls `func` and returns its wall time and (if `trace_memory`) the peak memory
+    allocated by python during the call.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return {"seconds": seconds, "peak_memory_bytes": peak_memory}
+
+
+def benchmark_pipeline(df: pd.DataFrame,
+                       stages: list,
+                       context: dict[str, Any],
+                       repeat: int = 3,
+                       trace_memory: bool = True
+                       ) -> list[dict[str, Any]]:
+    """
+    Runs the pipeline `repeat` times on copies of `df` and returns the report
+    of each stage with its fastest time. Memory is measured in a separate run
+    because tracing slows down the stages.
+    """
+    pipeline = Pipeline.from_config({"stages": stages, **context})
+
+    best = None
+    for _ in range(repeat):
+        _, report = pipeline.run(df.copy(), trace_memory=False)
+        if best is None:
+            best = report
+        else:
+            for best_stage, stage in zip(best, report):
+                if stage["seconds"] < best_stage["seconds"]:
+                    best_stage.update(stage)
+
+    if trace_memory:
+        _, traced = pipeline.run(df.copy(), trace_memory=True)
+        for best_stage, stage in zip(best, traced):
+            best_stage["peak_memory_bytes"] = stage["peak_memory_bytes"]
+    return best
+
+
+def benchmark_transform_chemical_data(df: pd.DataFrame,
+                                      context: dict[str, Any],
+                                      trace_memory: bool = True
+                                      ) -> list[dict[str, Any]]:
+    """
+    Times the per-cell `transform_chemical_data` path (formatting amounts
+    with `data_cleaning.format_amount`) which the columnar stages replaced.
+    """
+    names = context["desired_chemical_names"]
+    pivoted = pivot_dataset(
+        df, context["sample_id_columns"], context["per_sample_data"], context["chemical_name_column"],
+        ["Amount", "UOM", "MinDetectLimit"], names)
+    dc.clean_dataset_units(pivoted, names)
+
+    def run():
+        transform_chemical_data(pivoted.copy(), names, dc.format_amount(True),
+                                ["Amount", "MinDetectLimit", "UOM"], ["Prefix", "Amount", "UOM"],
+                                split_lists=True)
+
+    result = time_call(run)
+    if trace_memory:
+        result["peak_memory_bytes"] = time_call(run, trace_memory=True)["peak_memory_bytes"]
+    return [{"stage": "transform_chemical_data", "rows_in": len(pivoted), "rows_out": len(pivoted),
+             "rows_per_second": len(pivoted) / result["seconds"] if result["seconds"] > 0 else None,
+             **result}]
+
+
+def benchmark_amount_parsing(df: pd.DataFrame,
+                             trace_memory: bool = True,
+                             per_cell_max_rows: int = 100000
+                             ) -> list[dict[str, Any]]:
+    """
+    Times parsing the raw amounts with `data_cleaning.parse_amounts` using the compiled
+    kernel (if numba is installed and there are at least `JIT_MIN_STRINGS` amount strings)
+    and the regex path, and with the per-cell `data_cleaning.format_amount` on datasets
+    up to `per_cell_max_rows`.
+    """
+    columns = (df["Amount"], df["MinDetectLimit"], df["UOM"])
+    # compile (or load) the kernel before it is timed
+    parse_amount_strings(["<5"], jit_min_strings=0)
+    jit = jit_available() and sum(isinstance(amount, str) for amount in df["Amount"]) >= JIT_MIN_STRINGS
+    runs = {
+        "parse_amounts_jit" if jit else "parse_amounts_no_jit":
+            lambda: dc.parse_amounts(*columns, erase_invalid=True),
+        "parse_amounts_regex": lambda: dc.parse_amounts(*columns, erase_invalid=True, jit=False),
+    }
+    if len(df) <= per_cell_max_rows:
+        format_amount = dc.format_amount(True)
+        runs["format_amount"] = lambda: [format_amount(*cells) for cells in zip(*columns)]
+
+    stages = []
+    for stage, run in runs.items():
+        result = time_call(run)
+        if trace_memory:
+            result["peak_memory_bytes"] = time_call(run, trace_memory=True)["peak_memory_bytes"]
+        stages.append({"stage": stage, "rows_in": len(df), "rows_out": len(df),
+                       "rows_per_second": len(df) / result["seconds"] if result["seconds"] > 0 else None,
+                       **result})
+    return stages
+
+
+def run_benchmarks(sizes: list[int],
+                   *,
+                   seed: int = 0,
+                   repeat: int = 3,
+                   trace_memory: bool = True,
+                   pipelines: list[str] | None = None,
+                   per_cell_max_rows: int = 100000,
+                   **generate_kwargs
+                   ) -> dict[str, Any]:
+    """
+    Generates a dataset of each size and benchmarks every pipeline on it.
+
+    Parameters
+    ----------
+    `sizes` : Number of rows of each generated dataset eg [10**4, 10**5, 10**6]
+
+    `repeat` : Number of times to run each pipeline, the fastest time of each stage is kept
+
+    `pipelines` : Names from `PIPELINES` to run (default all)
+
+    `per_cell_max_rows` : The per-cell `transform_chemical_data` and `format_amount`
+        paths are only timed on datasets up to this size (they are much slower)
+
+    Any other keyword arguments are passed to `generate_dataset`.
+
+    Returns
+    ---------
+    The results, with `meta` describing the machine and settings and `runs`
+    with the stages of each pipeline on each size (see `Pipeline.run`).
+    """
+    if pipelines is None:
+        pipelines = list(PIPELINES.keys())
+    chemicals = generate_kwargs.get("chemicals") or CHEMICALS
+    context = benchmark_context(list(chemicals.keys()))
+
+    runs = []
+    for n_rows in sizes:
+        generation = time.perf_counter()
+        df = generate_dataset(n_rows, seed=seed, **generate_kwargs)
+        generation = time.perf_counter() - generation
+
+        for name in pipelines:
+            stages = benchmark_pipeline(df, PIPELINES[name], context, repeat, trace_memory)
+            runs.append({"rows": n_rows, "pipeline": name, "generate_seconds": generation,
+                         "total_seconds": sum(stage["seconds"] for stage in stages), "stages": stages})
+
+        if n_rows <= per_cell_max_rows:
+            stages = benchmark_transform_chemical_data(df, context, trace_memory)
+            runs.append({"rows": n_rows, "pipeline": "per_cell", "generate_seconds": generation,
+                         "total_seconds": stages[0]["seconds"], "stages": stages})
+
+        stages = benchmark_amount_parsing(df, trace_memory, per_cell_max_rows)
+        runs.append({"rows": n_rows, "pipeline": "amount_parsing", "generate_seconds": generation,
+                     "total_seconds": sum(stage["seconds"] for stage in stages), "stages": stages})
+
+    return {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "seed": seed,
+            "repeat": repeat,
+            "generate": {key: value for key, value in generate_kwargs.items() if key != "chemicals"},
+        },
+        "runs": runs,
+    }
+
+
+def save_results(results: dict[str, Any], path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent=4)
+
+
+def load_results(path: str) -> dict[str, Any]:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def results_table(results: dict[str, Any]) -> pd.DataFrame:
+    """
+    Flattens the results into a dataframe with a row per stage of each run.
+    """
+    rows = [{"rows": run["rows"], "pipeline": run["pipeline"], **stage}
+            for run in results["runs"] for stage in run["stages"]]
+    rows.extend({"rows": run["rows"], "pipeline": run["pipeline"], "stage": "total",
+                 "seconds": run["total_seconds"]} for run in results["runs"])
+    return pd.DataFrame(rows)
+
+
+def compare_results(baseline: dict[str, Any], current: dict[str, Any]) -> pd.DataFrame:
+    """
+    Compares the time of each stage between two results.
+    A `speedup` above 1 means the `current` run is faster.
+    """
+    keys = ["rows", "pipeline", "stage"]
+    table = pd.merge(
+        results_table(baseline)[[*keys, "seconds"]],
+        results_table(current)[[*keys, "seconds"]],
+        on=keys, suffixes=("_baseline", "_current"))
+    table["speedup"] = table["seconds_baseline"] / table["seconds_current"]
+    return table
@@ -1,6 +1,7 @@
 import statistics as st
 import pandas as pd
-import math
+
+from outliers import outlier_mask, drop_outliers
 
 def Normalize(data, attribute, method):
     if (method == 'scaling'):
@@ -11,66 +12,35 @@ def Normalize(data, attribute, method):
 
 def Fill_by_Average(data, attribute):
     filled_data = data
-    temp = []
-    median = st.mean([x for x in data[attribute] if str(x) != 'nan'])
-    for d in data[attribute]:
-        #Need to check when the data is missing
-        if (math.isnan(d)):
-            d = median
-        
-        temp.append(d)
-    
-    filled_data[attribute] = temp
+    average = data[attribute].mean()
+    filled_data[attribute] = data[attribute].fillna(average)
     return filled_data
 
 def Fill_by_Mode(data, attribute):
     filled_data = data
-    temp = []
-    median = st.mode([x for x in data[attribute] if str(x) != 'nan'])
-    for d in data[attribute]:
-        #Need to check when the data is missing
-        if (math.isnan(d)):
-            d = median
-        
-        temp.append(d)
-    
-    filled_data[attribute] = temp
+    # most common value, the first one seen if several are equally common (like st.mode)
+    counts = data[attribute].value_counts(sort=False)
+    mode = counts.idxmax()
+    filled_data[attribute] = data[attribute].fillna(mode)
     return filled_data
 
 def Fill_by_Median(data, attribute):
     filled_data = data
-    temp = []
-    median = st.median([x for x in data[attribute] if str(x) != 'nan'])
-    for d in data[attribute]:
-        #Need to check when the data is missing
-        if (math.isnan(d)):
-            d = median
-        
-        temp.append(d)
-    
-    filled_data[attribute] = temp
+    median = data[attribute].median()
+    filled_data[attribute] = data[attribute].fillna(median)
     return filled_data
 
 def Detele_Missing(data, attribute):
-    for i in range(len(data[attribute])):
-        if (math.isnan(data[attribute].at[i])):
-            data = data.drop([i])
+    return data[data[attribute].notna()]
 
-    return data
+def remove_outliers(data, attribute, method, threshold=None, groups=None):
+    # method is one of outliers.OUTLIER_METHODS ('z-score', 'modified-z' or 'iqr')
+    # groups are columns to find outliers within eg ['well_id']
+    if groups is not None:
+        groups = [data[group] for group in groups]
+    mask, report = outlier_mask(data[attribute], method, threshold, groups)
+    return drop_outliers(data, mask)
 
-def remove_outliers(data, attribute, method):
-    if (method == 'z-score'):
-        avg = st.mean(data[attribute])
-        std = st.stdev(data[attribute])
-        print(avg)
-        print(std)
-
-        for i in range(len(data[attribute])):
-            z = (data[attribute].at[i] - avg)/std
-            if (abs(z) > 3):
-                data = data.drop([i])
-
-    return data
 def Convert_Data_Format(data, format):
     pass
 
@@ -107,15 +77,16 @@ def Unit_conversion(data, attribute, ori, after):
 
     return converted_data
 
-data = {
-  "calories": [390,390,390,390,390,390,390,390,390,390,1],
-  "duration": [390,390,390,390,390,390,390,390,390,390,1]
-}
+if __name__ == "__main__":
+    data = {
+      "calories": [390,390,390,390,390,390,390,390,390,390,1],
+      "duration": [390,390,390,390,390,390,390,390,390,390,1]
+    }
 
 
-#load data into a DataFrame object:
-df = pd.DataFrame(data)
-print(df)
+    #load data into a DataFrame object:
+    df = pd.DataFrame(data)
+    print(df)
 
-df = remove_outliers(df, 'calories', 'z-score')
-print(df)
\ No newline at end of file
+    df = remove_outliers(df, 'calories', 'z-score')
+    print(df)
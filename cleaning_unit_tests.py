@@ -1,9 +1,99 @@
 import unittest
+import unittest.mock
+import glob
+import re
+import importlib.util
+import sys
+import subprocess
+import os
+import shutil
+import tempfile
+import io
+import json
+import hashlib
 import pandas as pd
 import numpy as np
 import math
-from cleaning_utils import pivot_dataset, transform_chemical_data
+import statistics as st
+import tracemalloc
+import warnings
+from cleaning_utils import pivot_dataset, pivot_measurements, transform_chemical_data
+from cleaning_utils import convert_units, create_standardise_units_func, map_chemicals
+from cleaning_utils import parameter_presence, params_per_sample_histogram, samples_per_param_histogram
+from cleaning_utils import create_missing_index, rows_with_missing_at_most, rows_missing_chemical, completeness_histogram
 import data_cleaning as dc
+from cleaning_acceptance_tests import convert_to_standard
+from stream_cleaning import stream_clean_dataset, read_dataset
+import dataset_cache
+from dataset_cache import cached_read_csv, cache_path, write_cleaned_dataset, read_cleaned_dataset
+from imputation import fit_imputation_stats, imputation_fill_values, impute_chunks
+from imputation import save_imputation_stats, load_imputation_stats
+from outliers import OUTLIER_METHODS, outlier_mask, dataset_outlier_mask, drop_outliers
+import clean_data
+from pipeline import Pipeline, main as pipeline_main
+from stage_cache import StageCache
+from benchmarks.generate import generate_dataset, write_dataset, unit_table as generate_unit_table
+from schema import SCHEMAS, PREFIX_DTYPE, read_compact_csv, compact_pivoted, memory_report
+from benchmarks.harness import run_benchmarks, save_results, load_results, results_table, compare_results
+from convert_text_csv import convert_files, convert_text, byte_ranges, TEXT_CACHE_READ_CSV
+from imputation import partial_imputation_stats, remove_imputation_stats, merge_imputation_stats, mode_count_error
+from incremental import update_incremental, read_incremental_dataset, compact_incremental
+import sql_backend
+from lazy_cleaning import LazyDataset
+import amount_parsing as ap
+from dedup import DuplicateFilter, BLOOM_BATCH_SIZE, row_fingerprints
+import profiling
+from profiling import Profiler
+from temporal import interpolate_by_well, resample_by_well
+from spatial_imputation import dataset_spatial_index, idw_estimates, wells_within_radius, fill_dataset_nans_spatial
+
+
+desired_chemical_names = ["Calcium", "Chloride", "Water Temperature"]
+
+# per-cell conversions which convert_to_standard was compiled from
+convert_to_standard_funcs = dict()
+convert_to_standard_funcs['g/l'] = lambda x: x
+convert_to_standard_funcs['mg/l'] = lambda x: x/1e3
+convert_to_standard_funcs['ug/l'] = lambda x: x/1e6
+convert_to_standard_funcs['µg/l'] = lambda x: x/1e6
+convert_to_standard_funcs['ng/l'] = lambda x: x/1e9
+convert_to_standard_funcs['ph'] = lambda x: x
+convert_to_standard_funcs['°c'] = lambda x: x
+convert_to_standard_funcs['°f'] = lambda x: 5*(x-32)/9
+convert_to_standard_funcs['us/cm'] = lambda x: x
+convert_to_standard_funcs['µs/cm'] = lambda x: x
+
+
+def same_value(a, b):
+    if isinstance(a, float) and isinstance(b, float):
+        if math.isnan(a) and math.isnan(b):
+            return True
+    return a == b
+
+
+def clean_fixture(test_path, format_stage, sort_all_columns=False, units=convert_to_standard):
+    # runs the acceptance test pipeline and returns the output csv as a string
+    df = pd.read_csv(test_path)
+    df = pivot_dataset(
+        df,
+        sample_id_columns=["SampleID"],
+        per_sample_data=["DateCollected"],
+        chemical_name_column="ChemicalName",
+        values_per_chemical=["Amount", "UOM", "MinDetectLimit"],
+        desired_chemical_names=desired_chemical_names,
+    )
+    dc.clean_dataset_units(df, desired_chemical_names)
+    format_stage(df, desired_chemical_names)
+    dc.standardise_dataset_unit(df, desired_chemical_names, units, erase_invalid=True)
+    dc.drop_units_min_detect(df, desired_chemical_names)
+    dc.agg_dataset_measurement(df, desired_chemical_names)
+    df = dc.filter_rows_by_nas(df, desired_chemical_names, 1000)
+    (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, desired_chemical_names)
+    dc.fill_dataset_nans(df, desired_chemical_names, amount_avgs, missing_chemicals)
+    df = dc.sort_columns(df, list(desired_chemical_names))
+    if sort_all_columns:
+        df = df.sort_index(axis=1)
+    return df.to_csv(index=False)
 
 
 class TestUtilMethods (unittest.TestCase):
@@ -103,11 +193,1317 @@ class TestUtilMethods (unittest.TestCase):
         pass
 
     def test_clean_units(self):
-        # Test single value version, not dataset version
-        pass
+        self.assertEqual(dc.clean_units(" M g/L "), "mg/l")
+        self.assertEqual(dc.clean_units(["UG/L", np.nan, "micrograms per litre", "μg/L"]),
+                         ["ug/l", np.nan, "ug/l", "µg/l"])
+        self.assertEqual(dc.clean_units("Micrograms per Litre", aliases=None), "microgramsperlitre")
+        self.assertTrue(math.isnan(dc.clean_units(3)))
+
+        # the dataset version cleans each distinct unit once and should match cleaning every cell
+        df = pd.DataFrame({
+            ("A", "UOM"): ["mg/L", [" G/l", 2, "mg/L"], np.nan, "deg C", ["μS/cm"]],
+            ("B", "UOM"): [" ug / L", 5, "MG/L", ["ng/l", np.nan], "Micrograms per litre"],
+        })
+        expected = df.map(dc.clean_units)
+        dc.clean_dataset_units(df, ["A", "B"])
+        self.assertEqual(df.astype(str).to_dict(), expected.astype(str).to_dict())
+        self.assertEqual(list(df["A", "UOM"].fillna("")), ["mg/l", ["g/l", 2, "mg/l"], "", "°c", ["µs/cm"]])
+
+        long = pd.DataFrame({"UOM": [" ug / L", "MG/L", np.nan, "μg/l", "mg/l", "micrograms per liter"]})
+        categorical = long.astype("category")
+        dc.clean_long_units(long)
+        dc.clean_long_units(categorical)
+        self.assertEqual(list(long["UOM"].fillna("")), ["ug/l", "mg/l", "", "µg/l", "mg/l", "ug/l"])
+        self.assertEqual(list(categorical["UOM"].astype(object).fillna("")), list(long["UOM"].fillna("")))
+        self.assertEqual(sorted(categorical["UOM"].cat.categories), ["mg/l", "ug/l", "µg/l"])
 
     def test_format_amount(self):
-        pass
+        # columnar parser should match format_amount on every cell
+        amounts = ['1', ' < 0.5', '>3', '=2', '.5', '5.', 'abc', 'BDL', 'ND',
+                   ' B D L ', 3, 2.5, np.nan, np.int64(4), '1e5', '', None]
+        min_detect_limits = [100] * len(amounts)
+        min_detect_limits[8] = None
+        uoms = ['mg/l'] * len(amounts)
+
+        prefixes, values, units = dc.parse_amounts(
+            amounts, min_detect_limits, uoms, erase_invalid=True)
+        format_amount_func = dc.format_amount(True)
+
+        for i in range(len(amounts)):
+            expected = format_amount_func(
+                amounts[i], min_detect_limits[i], uoms[i])
+            self.assertTrue(same_value(prefixes[i], expected[0]), amounts[i])
+            self.assertTrue(same_value(values[i], expected[1]), amounts[i])
+            self.assertTrue(same_value(units[i], expected[2]), amounts[i])
+
+        with self.assertRaises(ValueError):
+            dc.parse_amounts(['1', 'x'], [1, 1], ['mg/l', 'mg/l'])
+
+    def test_format_dataset_amount(self):
+        # columnar formatting should give identical output to the per-cell version
+        def format_per_cell(df, desired_chemical_names):
+            for chemical_name in desired_chemical_names:
+                transform_chemical_data(df, [chemical_name], dc.format_amount(True),
+                                        ["Amount", "MinDetectLimit", "UOM"], ["Prefix", "Amount", "UOM"], split_lists=True)
+
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            expected = clean_fixture(test_path, format_per_cell)
+            generated = clean_fixture(test_path, dc.format_dataset_amount)
+            self.assertEqual(generated, expected, test_path)
+
+    def test_pivot_measurements(self):
+        # one measurement per chemical, values keep their dtypes
+        data = list()
+
+        data.append([1, 12, "A", 1.0, "="])
+        data.append([1, 12, "B", 2.0, "<"])
+        data.append([2, 8, "A", 12.0, "="])
+
+        df = pd.DataFrame(data, columns=["ID", "X", "Name", "Y", "Z"])
+
+        df = pivot_measurements(
+            df,
+            sample_id_columns=["ID"],
+            per_sample_data=["X"],
+            chemical_name_column="Name",
+            values_per_chemical=["Y", "Z"],
+        )
+
+        # check dimensions
+        self.assertEqual(list(df.columns), [
+            ("ID", ""), ("X", ""), ("A", "Y"), ("A", "Z"), ("B", "Y"), ("B", "Z")])
+        self.assertEqual(list(df.index), list(range(0, 2)))
+
+        # check contents
+        self.assertEqual(df["A", "Y"].dtype, np.float64)
+        self.assertEqual(list(df["A", "Y"]), [1.0, 12.0])
+        self.assertEqual(list(df["B", "Z"])[0], "<")
+        self.assertTrue(math.isnan(list(df["B", "Y"])[1]))
+
+    def test_clean_long_dataset(self):
+        # cleaning in long format should match cleaning the pivoted lists
+        def clean_long(test_path):
+            df = pd.read_csv(test_path)
+            df = dc.clean_long_dataset(
+                df, ["SampleID"], ["DateCollected"], "ChemicalName",
+                desired_chemical_names, convert_to_standard)
+            self.assertEqual(df["Calcium", "Amount"].dtype, np.float64)
+            df = dc.filter_rows_by_nas(df, desired_chemical_names, 1000)
+            (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, desired_chemical_names)
+            dc.fill_dataset_nans(df, desired_chemical_names, amount_avgs, missing_chemicals)
+            df = dc.sort_columns(df, list(desired_chemical_names))
+            return df.sort_index(axis=1).to_csv(index=False)
+
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            expected = clean_fixture(test_path, dc.format_dataset_amount, True)
+            self.assertEqual(clean_long(test_path), expected, test_path)
+
+    def test_agg_dataset_measurement(self):
+        # grouped aggregation should match aggregating each cell
+        columns = pd.MultiIndex.from_product([["A"], ["Amount", "Prefix"]])
+        df = pd.DataFrame([
+            [[1.0, 2.0, 6.0], ["=", "<", "="]],
+            [[4.0, 2.0], ["<", "<"]],
+            [5.0, ">"],
+            [np.nan, np.nan],
+            [[3.0, np.nan], ["=", np.nan]],
+        ], columns=columns)
+
+        expected = df.copy()
+        transform_chemical_data(expected, ["A"], dc.agg_measurement, ["Amount", "Prefix"], ["Amount", "Prefix"])
+        default = df.copy()
+        dc.agg_dataset_measurement(default, ["A"])
+        self.assertEqual(default.to_csv(), expected.to_csv())
+
+        # other policies for measurements below the detection limit
+        results = dict()
+        for policy in dc.AGG_POLICIES:
+            results[policy] = df.copy()
+            dc.agg_dataset_measurement(results[policy], ["A"], policy=policy)
+        self.assertEqual(list(results["max_dl"]["A", "Amount"][:3]), [3.0, 4.0, 5.0])
+        self.assertEqual(list(results["half_dl"]["A", "Amount"][:3]), [(1 + 1 + 6) / 3, 1.5, 5.0])
+        self.assertEqual(list(results["detected"]["A", "Amount"][:3]), [3.5, 2.0, 5.0])
+        for policy in dc.AGG_POLICIES:
+            self.assertEqual(list(results[policy]["A", "Prefix"][:3]), ["=", "<", ">"], policy)
+            self.assertTrue(results[policy]["A", "Amount"][3:].isna().all(), policy)
+
+        with self.assertRaises(ValueError):
+            dc.agg_dataset_measurement(df.copy(), ["A"], policy="median")
+
+    def test_convert_units(self):
+        # unit table should give exactly the same floats as the per-cell functions
+        values = np.array([0.005, 1, 12, -40, 100, 1e-9, 37.5, np.nan])
+        for uom, func in convert_to_standard_funcs.items():
+            converted, invalid = convert_units(
+                convert_to_standard, values, np.array([uom] * len(values), dtype=object))
+            self.assertFalse(invalid.any())
+            for value, result in zip(values, converted):
+                self.assertTrue(same_value(float(result), float(func(value))), uom)
+
+        # unknown and missing units are masked
+        converted, invalid = convert_units(
+            convert_to_standard, [1, 2, 3], np.array(["mg/l", "kg", np.nan], dtype=object))
+        self.assertEqual(list(invalid), [False, True, True])
+        self.assertTrue(math.isnan(converted[1]))
+
+        standardise_units_func = create_standardise_units_func(convert_to_standard)
+        self.assertEqual(standardise_units_func(100, '°f'), (5*(100-32)/9,))
+        with self.assertRaises(ValueError):
+            standardise_units_func(1, 'kg')
+
+    def test_standardise_dataset_unit(self):
+        # unit table and per-cell functions should give identical output
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            expected = clean_fixture(
+                test_path, dc.format_dataset_amount, units=convert_to_standard_funcs)
+            generated = clean_fixture(
+                test_path, dc.format_dataset_amount, units=convert_to_standard)
+            self.assertEqual(generated, expected, test_path)
+
+    def test_missing_index(self):
+        # bitset queries should match counting the NaNs in each row
+        names = ["C%d" % i for i in range(11)]
+        rng = np.random.default_rng(0)
+        amounts = rng.random((50, len(names)))
+        amounts[rng.random(amounts.shape) < 0.4] = np.nan
+        df = pd.DataFrame(amounts, columns=pd.MultiIndex.from_product([names, ["Amount"]]))
+        df["SampleID", ""] = range(len(df))
+
+        missing_index = create_missing_index(df, names)
+        counts = df[[(name, "Amount") for name in names]].apply(dc.count_nas, axis=1).to_numpy()
+        for k in range(len(names) + 1):
+            self.assertTrue((rows_with_missing_at_most(missing_index, k) == (counts <= k)).all())
+            filtered = dc.filter_rows_by_nas(df, names, k, missing_index)
+            self.assertEqual(list(filtered["SampleID", ""]), list(np.flatnonzero(counts <= k)))
+        for name in names:
+            self.assertTrue((rows_missing_chemical(missing_index, name) == df[name, "Amount"].isna()).all())
+        self.assertEqual(list(completeness_histogram(missing_index)),
+                         list(np.bincount(counts, minlength=len(names) + 1)))
+
+    def test_parameter_presence(self):
+        data = list()
+
+        data.append([1, "a", "Calcium"])
+        data.append([1, "a", "Calcium"])
+        data.append([1, "a", "Chloride"])
+        data.append([1, "b", "Calcium"])
+        data.append([2, "a", "Sodium"])
+        data.append([3, "a", "Chloride"])
+
+        df = pd.DataFrame(data, columns=["Well", "Date", "Name"])
+        search_params = ["Calcium", "Chloride", "pH"]
+
+        presence = parameter_presence(df, ["Well", "Date"], "Name", search_params)
+
+        # check dimensions
+        self.assertEqual(list(presence.index), [(1, "a"), (1, "b"), (2, "a"), (3, "a")])
+        self.assertEqual(list(presence.columns), search_params)
+
+        # check contents
+        self.assertEqual(presence.loc[(1, "a")].tolist(), [True, True, False])
+        self.assertEqual(presence.loc[(2, "a")].tolist(), [False, False, False])
+        self.assertEqual(list(params_per_sample_histogram(presence)), [1, 2, 1, 0])
+        self.assertEqual(list(samples_per_param_histogram(presence)), [2, 2, 0])
+
+        # the compact loaders' categorical columns give the same matrix (without a FutureWarning)
+        categorical = df.astype({"Date": "category", "Name": "category"})
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            categorical_presence = parameter_presence(categorical, ["Well", "Date"], "Name", search_params)
+        self.assertEqual(list(categorical_presence.index), list(presence.index))
+        np.testing.assert_array_equal(categorical_presence.to_numpy(), presence.to_numpy())
+
+    def test_parallel_chemicals(self):
+        # running chemicals in worker processes should give identical output
+        def clean_pivoted(test_path, workers):
+            df = pd.read_csv(test_path)
+            df = pivot_dataset(df, ["SampleID"], ["DateCollected"], "ChemicalName",
+                               ["Amount", "UOM", "MinDetectLimit"], desired_chemical_names)
+            dc.clean_dataset_units(df, desired_chemical_names)
+            dc.format_dataset_amount(df, desired_chemical_names, workers=workers)
+            dc.standardise_dataset_unit(df, desired_chemical_names, convert_to_standard, True, workers=workers)
+            dc.drop_units_min_detect(df, desired_chemical_names)
+            dc.agg_dataset_measurement(df, desired_chemical_names, workers=workers)
+            return df.to_csv(index=False)
+
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            self.assertEqual(clean_pivoted(test_path, 3), clean_pivoted(test_path, 1), test_path)
+
+        # transforms which can not be pickled fall back to threads
+        with self.assertWarns(UserWarning):
+            res = map_chemicals(lambda x: x + 1, [[1], [2], [3]], workers=2)
+        self.assertEqual(res, [2, 3, 4])
+
+
+class TestStreamCleaning (unittest.TestCase):
+    def test_stream_clean_dataset(self):
+        # samples split across chunks should still be aggregated into one row
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            expected = dc.clean_long_dataset(
+                pd.read_csv(test_path), ["SampleID"], ["DateCollected"], "ChemicalName",
+                desired_chemical_names, convert_to_standard)
+            for chunksize in [1, 2, 5, 1000]:
+                generated = stream_clean_dataset(
+                    test_path, ["SampleID"], ["DateCollected"], "ChemicalName",
+                    desired_chemical_names, convert_to_standard, chunksize=chunksize)
+                pd.testing.assert_frame_equal(generated, expected)
+
+    def test_read_dataset(self):
+        df = read_dataset("Tests/small_list_in.csv", "ChemicalName", ["Calcium"], chunksize=3)
+        expected = pd.read_csv("Tests/small_list_in.csv")
+        expected = expected[expected["ChemicalName"] == "Calcium"].reset_index(drop=True)
+        pd.testing.assert_frame_equal(df, expected)
+
+
+class TestDedup (unittest.TestCase):
+    def test_duplicate_filter(self):
+        df = generate_dataset(4000, seed=3)
+        # parts of an export which overlap, and repeat rows within themselves
+        parts = [df.iloc[:2500], df.iloc[2000:], df.iloc[:100]]
+        expected = pd.concat(parts).drop_duplicates(ignore_index=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f"part_{idx}.csv") for idx in range(len(parts))]
+            for part, path in zip(parts, paths):
+                part.to_csv(path, index=False)
+            for duplicates in [DuplicateFilter(), DuplicateFilter(max_exact=500, capacity=10000)]:
+                result = read_dataset(paths, chunksize=300, duplicates=duplicates)
+                pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+                self.assertEqual(duplicates.report()["duplicates"], 4600 - len(expected))
+            self.assertFalse(duplicates.exact)
+
+            names = ["Calcium", "Chloride", "Sodium", "pH"]
+            generated = stream_clean_dataset(paths, ["SampleID"], ["DateCollected"], "ChemicalName", names,
+                                             generate_unit_table(), chunksize=700, duplicates=DuplicateFilter())
+            pd.testing.assert_frame_equal(generated, dc.clean_long_dataset(
+                df, ["SampleID"], ["DateCollected"], "ChemicalName", names, generate_unit_table()))
+
+            config = {"stages": [{"read_csv_deduplicated": {"path": paths, "columns": ["SampleID"]}}]}
+            result, _ = Pipeline.from_config(config).run()
+            self.assertEqual(result["SampleID"].tolist(), df["SampleID"].unique().tolist())
+
+    def test_bloom_filter_memory(self):
+        # switching to the Bloom filter and looking up fingerprints only take fixed size batches
+        rng = np.random.default_rng(4)
+        duplicates = DuplicateFilter(max_exact=500000)
+        fingerprints = rng.integers(0, 2 ** 63, 500000, dtype=np.uint64)
+        duplicates.add(fingerprints)
+        self.assertTrue(duplicates.exact)
+
+        tracemalloc.start()
+        duplicates.add(rng.integers(0, 2 ** 63, 10, dtype=np.uint64))
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertFalse(duplicates.exact)
+        # the Bloom filter is no larger than the exact fingerprints it replaced
+        self.assertLessEqual(duplicates.report()["fingerprint_bytes"], fingerprints.nbytes)
+        batch_bytes = 8 * duplicates.bloom.n_hashes * BLOOM_BATCH_SIZE
+        self.assertLess(peak, duplicates.bloom.bits.nbytes + 5 * batch_bytes)
+
+        tracemalloc.start()
+        found = duplicates.seen(fingerprints)
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertTrue(found.all())
+        self.assertLess(peak, found.nbytes + 5 * batch_bytes)
+
+    def test_bloom_false_positives(self):
+        # a tiny Bloom filter has many false positives, which are checked in the spilled fingerprints
+        rng = np.random.default_rng(5)
+        df = pd.DataFrame({"SampleID": rng.permutation(3000), "Amount": rng.random(3000)})
+        duplicates = DuplicateFilter(max_exact=200, capacity=100, false_positive_rate=0.5)
+        with self.assertWarns(UserWarning):
+            chunks = [duplicates.drop_duplicates(df.iloc[start:start + 100]) for start in range(0, 2000, 100)]
+        pd.testing.assert_frame_equal(pd.concat(chunks), df.iloc[:2000])
+        report = duplicates.report()
+        self.assertFalse(report["exact"])
+        self.assertGreater(report["false_positives"], 0)
+        self.assertEqual((report["duplicates"], report["distinct"]), (0, 2000))
+        self.assertGreater(report["spilled_bytes"], 0)
+
+        # rows seen before are still dropped, new rows are kept
+        chunk = df.iloc[1900:2100]
+        self.assertEqual(duplicates.new_mask(chunk).tolist(), [False] * 100 + [True] * 100)
+        self.assertEqual(duplicates.report()["duplicates"], 100)
+
+        # the spilled fingerprints are removed with the filter
+        spill_path = duplicates.spill_path
+        self.assertTrue(os.path.isdir(spill_path))
+        del duplicates
+        self.assertFalse(os.path.exists(spill_path))
+
+    def test_row_fingerprints(self):
+        # the same rows read with different dtypes have the same fingerprint
+        a = pd.DataFrame({"SampleID": [1, 2], "ChemicalName": ["Calcium", "pH"]})
+        b = pd.DataFrame({"SampleID": [1.0, np.nan], "ChemicalName": pd.Categorical(["Calcium", "pH"])})
+        self.assertEqual(row_fingerprints(a)[0], row_fingerprints(b)[0])
+        self.assertNotEqual(row_fingerprints(a)[1], row_fingerprints(b)[1])
+        self.assertEqual(row_fingerprints(a, ["ChemicalName"]).tolist(),
+                         row_fingerprints(b, ["ChemicalName"]).tolist())
+
+        duplicates = DuplicateFilter(["SampleID"])
+        self.assertEqual(duplicates.new_mask(a).tolist(), [True, True])
+        self.assertEqual(duplicates.new_mask(b).tolist(), [False, True])
+        self.assertEqual(duplicates.report()["duplicates"], 1)
+
+        # read_csv infers Amount as float in a chunk of numbers and object in a chunk with "<0.1"
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, "a.csv"), os.path.join(tmp, "b.csv")]
+            for path, content in zip(paths, ["SampleID,Amount\n1,0.5\n2,3\n", "SampleID,Amount\n1,0.5\n3,<0.1\n"]):
+                with open(path, "w") as f:
+                    f.write(content)
+            chunks = [pd.read_csv(path) for path in paths]
+            self.assertEqual([chunk["Amount"].dtype for chunk in chunks], [np.float64, object])
+            duplicates = DuplicateFilter()
+            self.assertEqual(duplicates.new_mask(chunks[0]).tolist(), [True, True])
+            self.assertEqual(duplicates.new_mask(chunks[1]).tolist(), [False, True])
+            self.assertEqual(read_dataset(paths, duplicates=DuplicateFilter())["SampleID"].tolist(), [1, 2, 3])
+        self.assertEqual(row_fingerprints(pd.DataFrame({"A": ["3", "x", None]})).tolist(),
+                         row_fingerprints(pd.DataFrame({"A": pd.Categorical([3.0, "x", np.nan])})).tolist())
+
+
+def fuzz_amounts(n, seed):
+    # amounts like the datasets' (with whitespace, prefixes and long decimals) and random text
+    rng = np.random.default_rng(seed)
+    alphabet = list("0123456789.<>= \t\nBDLNDe-\x1c\xa0٣")
+    amounts = []
+    for _ in range(n):
+        if rng.random() < 0.6:
+            digits = "".join(rng.choice(list("0123456789"), rng.integers(1, 26)))
+            dot = rng.integers(0, len(digits) + 1)
+            number = digits[:dot] + ("." if rng.random() < 0.7 else "") + digits[dot:]
+            amounts.append(rng.choice(["", "<", ">", "=", " < ", "\t="]) + number + rng.choice(["", " ", "\n"]))
+        else:
+            amounts.append("".join(rng.choice(alphabet, rng.integers(0, 8))))
+    return amounts
+
+
+class TestAmountParsing (unittest.TestCase):
+    def test_fuzz(self):
+        amounts = fuzz_amounts(20000, seed=0) + ["BDL", " N D ", "bdl", "", "5.", ".5", "<.5", "1e5", "9007199254740993",
+                                                 "0." + "0" * 30 + "1", np.str_("<3.25")]
+        parsed = ap.parse_amount_strings(amounts)
+        # the same as float() of the numbers matched by the regex
+        for amount, status, value, prefix in zip(amounts, parsed.status, parsed.values, parsed.prefix_codes):
+            match = re.fullmatch(r'([<>=]?)([0-9]*\.?[0-9]+)', "".join(amount.split()))
+            if match is None:
+                self.assertNotEqual(status, ap.NUMBER, repr(amount))
+                continue
+            self.assertEqual(status, ap.NUMBER, repr(amount))
+            self.assertEqual(value, float(match.group(2)), repr(amount))
+            self.assertEqual(prefix, ap.PREFIX_CODES[match.group(1)], repr(amount))
+        self.assertEqual(parsed.status[-11:-7].tolist(), [ap.BELOW_LIMIT, ap.BELOW_LIMIT, ap.INVALID, ap.INVALID])
+
+        # the compiled and regex paths agree
+        for (compiled, regex) in zip(parsed, ap.parse_amount_strings(amounts, jit=False)):
+            np.testing.assert_array_equal(compiled, regex)
+
+        # the kernel also runs (slowly) as python, eg without numba
+        (data, offsets) = ap.encode_strings(amounts[:2000])
+        scanned = ap.ParsedAmounts(np.empty(2000, dtype=np.int8), np.empty(2000), np.empty(2000, dtype=np.int8))
+        ap.scan_amounts(data, offsets, *scanned)
+        exact = scanned.status != ap.FALLBACK
+        for (column, expected) in zip(scanned, parsed):
+            np.testing.assert_array_equal(column[exact], expected[:2000][exact])
+
+    def test_parse_amounts(self):
+        df = generate_dataset(2 * ap.JIT_MIN_STRINGS, seed=6)
+        columns = (df["Amount"], df["MinDetectLimit"], df["UOM"])
+        compiled = dc.parse_amounts(*columns, erase_invalid=True)
+        regex = dc.parse_amounts(*columns, erase_invalid=True, jit=False)
+        for (a, b) in zip(compiled, regex):
+            pd.testing.assert_series_equal(pd.Series(a), pd.Series(b))
+        for jit in [True, False]:
+            with self.assertRaises(ValueError):
+                dc.parse_amounts(["<5", " 5x"], [1.0, 1.0], ["mg/l", "mg/l"], jit=jit)
+        self.assertEqual(ap.jit_available(), importlib.util.find_spec("numba") is not None)
+
+        # small datasets are parsed without importing numba
+        script = ("import sys, data_cleaning as dc; "
+                  "dc.parse_amounts(['<5', ' 3.2 ', 'BDL'], [1.0, 1.0, 1.0], ['mg/l', 'mg/l', 'mg/l']); "
+                  "print('numba' in sys.modules)")
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        self.assertEqual(output.stdout.strip(), "False")
+
+class TestProfiling (unittest.TestCase):
+    def test_profiler(self):
+        names = ["Calcium", "Chloride", "Sodium", "pH"]
+        df = generate_dataset(2000, seed=4)
+        clean_long_dataset = dc.clean_long_dataset
+        with Profiler() as profiler:
+            profiled = dc.clean_long_dataset(df, ["SampleID"], ["DateCollected"], "ChemicalName", names,
+                                             generate_unit_table())
+        # the functions are only wrapped while profiling
+        self.assertIs(dc.clean_long_dataset, clean_long_dataset)
+        self.assertEqual(len(profiling.patched), 0)
+        pd.testing.assert_frame_equal(profiled, dc.clean_long_dataset(
+            df, ["SampleID"], ["DateCollected"], "ChemicalName", names, generate_unit_table()))
+
+        summary = profiler.summary()
+        self.assertEqual(summary.loc["data_cleaning.clean_long_dataset", "calls"], 1)
+        self.assertEqual(summary.loc["data_cleaning.clean_long_dataset", "elements"], len(df))
+        self.assertIn("cleaning_utils.pivot_measurements", summary.index)
+        self.assertTrue((summary["self_seconds"] <= summary["seconds"] + 1e-9).all())
+        stacks = {record.stack for record in profiler.records}
+        self.assertIn(("data_cleaning.clean_long_dataset", "data_cleaning.clean_long_measurements"), stacks)
+
+        # a transform over every cell is split into its steps
+        with Profiler(trace_memory=False) as profiler:
+            transform_chemical_data(profiled, names, lambda amount: (amount,), ["Amount"], ["Amount"])
+        self.assertLessEqual({"cleaning_utils.transform_chemical_data", "cleaning_utils.apply_transform",
+                              "apply_transform.vectorize", "apply_transform.transpose",
+                              "transform_chemical_data.assign"}, set(profiler.summary().index))
+        self.assertTrue(profiler.summary()["allocated_bytes"].isna().all())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler.save(os.path.join(tmp, "trace.json"))
+            with open(os.path.join(tmp, "trace.json")) as f:
+                events = json.load(f)["traceEvents"]
+            self.assertEqual(len(events), len(profiler.records))
+            self.assertEqual(events[0]["ph"], "X")
+            profiler.save(os.path.join(tmp, "trace.folded"))
+            with open(os.path.join(tmp, "trace.folded")) as f:
+                lines = f.read().splitlines()
+            self.assertIn("cleaning_utils.transform_chemical_data;cleaning_utils.map_chemicals;cleaning_utils.apply_transform;"
+                          "apply_transform.vectorize", [line.rsplit(" ", 1)[0] for line in lines])
+
+    def test_environment(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.folded")
+            script = "import data_cleaning as dc; dc.clean_units(['mg/L', 'ug/l'])"
+            subprocess.run([sys.executable, "-c", script], check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                           env={**os.environ, profiling.PROFILE_ENV: path})
+            with open(path) as f:
+                self.assertTrue(f.read().startswith("data_cleaning."))
+
+
+class TestDatasetCache (unittest.TestCase):
+    def test_cached_read_csv(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "data.csv")
+            shutil.copy("Tests/small_complex_in.csv", csv_path)
+            expected = pd.read_csv(csv_path)
+
+            # cache is built on first read
+            df = cached_read_csv(csv_path)
+            pd.testing.assert_frame_equal(df, expected)
+            self.assertTrue(os.path.exists(cache_path(csv_path)))
+
+            # column projection and filter pushdown
+            df = cached_read_csv(csv_path, columns=["SampleID", "ChemicalName"],
+                                 filters=[("ChemicalName", "in", ["Calcium"])])
+            self.assertEqual(list(df.columns), ["SampleID", "ChemicalName"])
+            self.assertEqual(set(df["ChemicalName"]), {"Calcium"})
+            self.assertEqual(list(df["SampleID"]), list(
+                expected[expected["ChemicalName"] == "Calcium"]["SampleID"]))
+
+            # cache is rebuilt when the csv changes
+            with open(csv_path, "a") as f:
+                f.write("13,1/01/1995,Calcium,5,mg/L,100\n")
+            df = cached_read_csv(csv_path, columns=["SampleID"])
+            self.assertEqual(len(df), len(expected) + 1)
+
+    def test_check_hash(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "data.csv")
+            shutil.copy("Tests/small_complex_in.csv", csv_path)
+            expected = pd.read_csv(csv_path)
+            cached_read_csv(csv_path, check_hash=True)
+
+            # the csv is only hashed when just its modification time has changed
+            with unittest.mock.patch.object(dataset_cache.hashlib, "sha256", wraps=hashlib.sha256) as sha256:
+                pd.testing.assert_frame_equal(cached_read_csv(csv_path, check_hash=True), expected)
+                self.assertEqual(sha256.call_count, 0)
+
+                os.utime(csv_path, ns=(0, 0))
+                mtime = os.stat(cache_path(csv_path)).st_mtime_ns
+                pd.testing.assert_frame_equal(cached_read_csv(csv_path, check_hash=True), expected)
+                self.assertEqual(sha256.call_count, 1)
+                # the touched csv is kept, and its new modification time is stored
+                self.assertEqual(os.stat(cache_path(csv_path)).st_mtime_ns, mtime)
+                cached_read_csv(csv_path, check_hash=True)
+                self.assertEqual(sha256.call_count, 1)
+
+                # a csv of another size is rebuilt without checking the old hash
+                with open(csv_path, "a") as f:
+                    f.write("13,1/01/1995,Calcium,5,mg/L,100\n")
+                self.assertFalse(dataset_cache.is_cache_valid(
+                    csv_path, cache_path(csv_path), dataset_cache.cache_options(), check_hash=True))
+                self.assertEqual(sha256.call_count, 1)
+                self.assertEqual(len(cached_read_csv(csv_path, check_hash=True)), len(expected) + 1)
+
+    def test_cleaned_dataset(self):
+        df = dc.clean_long_dataset(
+            pd.read_csv("Tests/small_complex_in.csv"), ["SampleID"], ["DateCollected"],
+            "ChemicalName", desired_chemical_names, convert_to_standard)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            parquet_path = os.path.join(tmp_dir, "cleaned.parquet")
+            write_cleaned_dataset(df, parquet_path)
+            pd.testing.assert_frame_equal(read_cleaned_dataset(parquet_path), df)
+
+            projected = read_cleaned_dataset(parquet_path, ["Calcium"], ["SampleID"])
+            pd.testing.assert_frame_equal(projected, df[["SampleID", "Calcium"]])
+
+
+class TestImputation (unittest.TestCase):
+    def setUp(self):
+        names = ["A", "B", "C"]
+        rng = np.random.default_rng(1)
+        amounts = np.round(rng.lognormal(size=(301, 3)), 1)
+        amounts[:, 1] -= 1
+        amounts[rng.random(amounts.shape) < 0.2] = np.nan
+        amounts[:, 2] = np.nan
+        columns = pd.MultiIndex.from_product([names, ["Amount"]])
+        df = pd.DataFrame(amounts, columns=columns)
+        for name in names:
+            df[name, "Prefix"] = np.where(df[name, "Amount"].isna(), np.nan, "=")
+        self.names = names
+        self.df = df
+        self.chunks = [df.iloc[i:i + 40].copy() for i in range(0, len(df), 40)]
+
+    def test_fit_imputation_stats(self):
+        # a single pass over chunks should match the statistics of the whole dataset
+        stats = fit_imputation_stats(self.chunks, self.names)
+        (amount_avgs, missing_chemicals) = dc.get_chemical_averages(self.df, self.names)
+        (fill_values, fitted_missing) = imputation_fill_values(stats, "mean")
+        self.assertEqual(fitted_missing, missing_chemicals)
+        for name in ["A", "B"]:
+            values = self.df[name, "Amount"].dropna()
+            self.assertAlmostEqual(fill_values[name], amount_avgs[name])
+            self.assertEqual(imputation_fill_values(stats, "mode")[0][name],
+                             values.value_counts().sort_index().idxmax())
+            for q in [0.1, 0.5, 0.9]:
+                exact = values.sort_values().iloc[int(q * (len(values) - 1))]
+                estimate = imputation_fill_values(stats, q)[0][name]
+                self.assertLessEqual(abs(estimate - exact), 0.01 * abs(exact) + 1e-12, (name, q))
+
+        with self.assertRaises(ValueError):
+            imputation_fill_values(stats, "max")
+
+    def test_impute_chunks(self):
+        # statistics reloaded from disk should fill each chunk like the whole dataset
+        stats = fit_imputation_stats(self.chunks, self.names)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "stats.json")
+            save_imputation_stats(stats, path)
+            loaded = load_imputation_stats(path)
+        for method in ["mean", "median", "mode"]:
+            self.assertEqual(imputation_fill_values(loaded, method), imputation_fill_values(stats, method))
+
+        expected = self.df.copy()
+        dc.fill_dataset_nans(expected, self.names, *imputation_fill_values(stats, "median"))
+        filled = pd.concat(impute_chunks(self.chunks, self.names, loaded, "median"))
+        pd.testing.assert_frame_equal(filled, expected)
+        self.assertFalse(filled.isna().any().any())
+
+    def test_mode_counters(self):
+        # continuous amounts keep a bounded number of mode counts, common values are still found
+        rng = np.random.default_rng(3)
+        amounts = rng.lognormal(size=5000)
+        amounts[rng.choice(5000, 300, replace=False)] = 2.5
+        df = pd.DataFrame({("A", "Amount"): amounts})
+        chunks = [df.iloc[i:i + 500] for i in range(0, len(df), 500)]
+        stats = fit_imputation_stats(chunks, ["A"], mode_counters=20)["A"]
+        self.assertLessEqual(len(stats.value_counts), 20)
+        self.assertEqual(imputation_fill_values({"A": stats}, "mode")[0]["A"], 2.5)
+
+        exact = pd.Series(amounts).value_counts()
+        error = exact[stats.value_counts.index] - stats.value_counts
+        self.assertTrue((error >= 0).all())
+        self.assertTrue((error <= mode_count_error(stats)).all())
+        self.assertLessEqual(mode_count_error(stats), len(amounts) / 21)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "stats.json")
+            save_imputation_stats({"A": stats}, path)
+            loaded = load_imputation_stats(path)["A"]
+        self.assertEqual(loaded.mode_counters, 20)
+        pd.testing.assert_series_equal(loaded.value_counts, stats.value_counts, check_names=False,
+                                       check_index_type=False)
+
+        # no value is common enough to be counted
+        distinct = fit_imputation_stats([pd.DataFrame({("A", "Amount"): rng.lognormal(size=100)})], ["A"],
+                                        mode_counters=1)
+        self.assertEqual(imputation_fill_values(distinct, "mode"), imputation_fill_values(distinct, "median"))
+        with self.assertRaises(ValueError):
+            merge_imputation_stats(distinct, fit_imputation_stats([df], ["A"]))
+
+
+class TestOutliers (unittest.TestCase):
+    def test_outlier_mask(self):
+        rng = np.random.default_rng(2)
+        values = pd.Series(rng.normal(10, 1, 200), index=range(100, 300))
+        values.iloc[[3, 50]] = [30, -20]
+        values.iloc[7] = np.nan
+
+        # z-score matches the statistics module
+        present = values.dropna()
+        z = (values - st.mean(present)) / st.stdev(present)
+        mask, report = outlier_mask(values, "z-score")
+        self.assertEqual(list(mask.index), list(values.index))
+        self.assertEqual(list(mask[mask].index), list(z[z.abs() > 3].index))
+        self.assertEqual(report["Outliers"].iloc[0], mask.sum())
+        self.assertEqual(report["Count"].iloc[0], 199)
+
+        median = present.median()
+        mad = (present - median).abs().median()
+        expected = (0.6745 * (values - median) / mad).abs() > 3.5
+        self.assertTrue((outlier_mask(values, "modified-z")[0] == expected).all())
+
+        q1, q3 = present.quantile(0.25), present.quantile(0.75)
+        expected = (values < q1 - 2 * (q3 - q1)) | (values > q3 + 2 * (q3 - q1))
+        self.assertTrue((outlier_mask(values, "iqr", 2)[0] == expected).all())
+
+        with self.assertRaises(ValueError):
+            outlier_mask(values, "grubbs")
+
+    def test_constant_heavy_outliers(self):
+        # most values at the detection limit, so the IQR or MAD is 0
+        values = pd.Series([1, 2, 3, 1, 2, 2, 2, 2, 100], dtype=float)
+        mask, report = outlier_mask(values, "iqr")
+        # only the 100 is an outlier, not the detections either side of the limit
+        self.assertEqual(list(mask[mask].index), [8])
+        scale = (values - 2).abs().mean() * 1.349 / 0.7979
+        self.assertAlmostEqual(report["Lower"].iloc[0], 2 - 1.5 * scale)
+        self.assertAlmostEqual(report["Upper"].iloc[0], 2 + 1.5 * scale)
+        self.assertEqual(list(drop_outliers(values, mask)), [1, 2, 3, 1, 2, 2, 2, 2])
+        self.assertEqual(list(clean_data.remove_outliers(values.to_frame("x"), "x", "iqr")["x"]),
+                         [1, 2, 3, 1, 2, 2, 2, 2])
+
+        values = pd.Series([5.0] * 10 + [100.0, np.nan])
+        for method in OUTLIER_METHODS:
+            self.assertEqual(list(outlier_mask(values, method)[0].to_numpy().nonzero()[0]), [10])
+        mean_deviation = (values.dropna() - 5).abs().mean()
+        self.assertAlmostEqual(outlier_mask(values, "modified-z")[1]["Upper"].iloc[0],
+                               5 + 3.5 * mean_deviation / 0.7979)
+
+        # constant groups and single values have no outliers
+        groups = pd.Series(["a"] * 5 + ["b"] + ["c"] * 21)
+        values = pd.Series([5.0] * 5 + [1.0] + [5.0] * 20 + [50.0])
+        for method in OUTLIER_METHODS:
+            mask, report = outlier_mask(values, method, groups=groups)
+            self.assertEqual(list(mask[mask].index), [26])
+            self.assertEqual(list(report["Outliers"]), [0, 0, 1])
+            self.assertEqual((report.loc["b", "Lower"], report.loc["b", "Upper"]), (-np.inf, np.inf))
+
+    def test_grouped_outliers(self):
+        # each group is checked against its own statistics
+        columns = pd.MultiIndex.from_tuples([("WellID", ""), ("A", "Amount"), ("B", "Amount")])
+        df = pd.DataFrame([["w1", 1.0 + i % 3, 5.0] for i in range(30)] +
+                          [["w2", 100.0 + i % 3, 5.0] for i in range(30)], columns=columns)
+        df.loc[5, ("A", "Amount")] = 100.0
+
+        mask, report = dataset_outlier_mask(df, ["A", "B"], "modified-z", group_columns=[("WellID", "")])
+        self.assertEqual(list(mask.index[mask["A"]]), [5])
+        self.assertFalse(mask["B"].any())
+        self.assertEqual(report.loc[("A", "w1"), "Outliers"], 1)
+        self.assertEqual(report.loc[("A", "w2"), "Outliers"], 0)
+        self.assertEqual(len(drop_outliers(df, mask)), 59)
+
+        # categorical well ids only report the observed wells (without a FutureWarning)
+        df[("WellID", "")] = pd.Categorical(df[("WellID", "")], categories=["w0", "w1", "w2"])
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            categorical_mask, categorical_report = dataset_outlier_mask(df, ["A", "B"], "modified-z",
+                                                                        group_columns=[("WellID", "")])
+        pd.testing.assert_frame_equal(categorical_mask, mask)
+        self.assertEqual(list(categorical_report.index), list(report.index))
+
+        # without groups the second well is not an outlier
+        mask, report = dataset_outlier_mask(df, ["A"], "z-score")
+        self.assertFalse(mask["A"].any())
+
+    def test_clean_data(self):
+        data = pd.DataFrame({"calories": [390] * 10 + [1], "duration": [1.0, np.nan] * 5 + [1.0]})
+        self.assertEqual(list(clean_data.remove_outliers(data, "calories", "z-score").index), list(range(10)))
+        self.assertEqual(list(clean_data.Detele_Missing(data, "duration").index), list(range(0, 11, 2)))
+
+
+class TestPipeline (unittest.TestCase):
+    def config(self, test_path, stages):
+        units = {'g/l': [0, 1, 1], 'mg/l': [0, 1, 1e3], 'ug/l': [0, 1, 1e6], 'µg/l': [0, 1, 1e6],
+                 'ng/l': [0, 1, 1e9], 'ph': [0, 1, 1], '°c': [0, 1, 1], '°f': [-32, 5, 9],
+                 'us/cm': [0, 1, 1], 'µs/cm': [0, 1, 1]}
+        return {
+            "sample_id_columns": ["SampleID"],
+            "per_sample_data": ["DateCollected"],
+            "chemical_name_column": "ChemicalName",
+            "desired_chemical_names": desired_chemical_names,
+            "units": units,
+            "stages": [{"read_csv": {"path": test_path}}, *stages,
+                       {"filter_rows_by_nas": {"na_threshold": 1000}}, "fill_nans", "sort_columns"],
+        }
+
+    def test_pipeline(self):
+        # configured stages should match running the functions by hand
+        pivoted = ["pivot", "clean_units", {"format_amount": {"erase_invalid": True}},
+                   {"standardise_unit": {"erase_invalid": True}}, "drop_units_min_detect", "agg_measurement"]
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            expected = clean_fixture(test_path, dc.format_dataset_amount, True)
+            for stages in [pivoted, ["clean_long"]]:
+                df, report = Pipeline.from_config(self.config(test_path, stages)).run()
+                self.assertEqual(df.sort_index(axis=1).to_csv(index=False), expected, test_path)
+                self.assertEqual(len(report), len(stages) + 4)
+                self.assertEqual(report[0]["rows_out"], len(pd.read_csv(test_path)))
+                self.assertEqual(report[-1]["rows_out"], len(df))
+                for i in range(1, len(report)):
+                    self.assertEqual(report[i]["rows_in"], report[i - 1]["rows_out"])
+
+            # the SQLite stage reads the file itself and replaces the cleaning stages
+            config = self.config(test_path, [])
+            config["stages"] = [{"clean_sql": {"path": test_path, "na_threshold": 1000}}]
+            df, report = Pipeline.from_config(config).run()
+            self.assertEqual(df.sort_index(axis=1).to_csv(index=False), expected, test_path)
+
+        with self.assertRaises(ValueError):
+            Pipeline([("unknown", {})])
+
+    def test_pipeline_cli(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output_path = os.path.join(tmp, "out.csv")
+            config = self.config("Tests/small_complex_in.csv", ["clean_long"])
+            config["stages"].append({"write_csv": {"path": output_path}})
+            config_path = os.path.join(tmp, "config.json")
+            with open(config_path, "w", encoding="utf-8") as f:
+                json.dump(config, f)
+
+            report_path = os.path.join(tmp, "report.json")
+            pipeline_main([config_path, "--report", report_path])
+            with open(report_path) as f:
+                report = json.load(f)
+            self.assertEqual([stage["stage"] for stage in report],
+                             ["read_csv", "clean_long", "filter_rows_by_nas", "fill_nans", "sort_columns", "write_csv"])
+            for stage in report:
+                self.assertGreaterEqual(stage["seconds"], 0)
+                self.assertGreaterEqual(stage["peak_memory_bytes"], 0)
+            self.assertEqual(len(pd.read_csv(output_path, header=[0, 1])), report[-1]["rows_out"])
+
+    def test_stage_cache(self):
+        pivoted = ["pivot", "clean_units", {"format_amount": {"erase_invalid": True}},
+                   {"standardise_unit": {"erase_invalid": True}}, "drop_units_min_detect", "agg_measurement"]
+        with tempfile.TemporaryDirectory() as tmp:
+            test_path = os.path.join(tmp, "in.csv")
+            shutil.copy("Tests/small_complex_in.csv", test_path)
+            cache = StageCache(os.path.join(tmp, "cache"))
+            config = self.config(test_path, pivoted)
+            expected, _ = Pipeline.from_config(config).run()
+
+            df, report = Pipeline.from_config(config).run(cache=cache)
+            self.assertFalse(any(stage["cached"] for stage in report))
+            df, report = Pipeline.from_config(config).run(cache=cache)
+            self.assertTrue(all(stage["cached"] for stage in report))
+            self.assertEqual(report[-1]["rows_out"], len(expected))
+            pd.testing.assert_frame_equal(df, expected)
+
+            # only the stages from the first changed one are run
+            config["stages"][-3] = {"filter_rows_by_nas": {"na_threshold": 1}}
+            df, report = Pipeline.from_config(config).run(cache=cache)
+            self.assertEqual([stage["stage"] for stage in report if not stage["cached"]],
+                             ["filter_rows_by_nas", "fill_nans", "sort_columns"])
+            pd.testing.assert_frame_equal(df, Pipeline.from_config(config).run()[0])
+
+            config["units"] = {**config["units"], "°f": [-32, 5, 9.0001]}
+            _, report = Pipeline.from_config(config).run(cache=cache)
+            self.assertEqual(report[0]["stage"], "read_csv")
+            self.assertEqual([stage["stage"] for stage in report if stage["cached"]],
+                             ["read_csv", "pivot", "clean_units", "format_amount"])
+
+            # changing the input file invalidates every stage
+            with open(test_path, "a") as f:
+                f.write("\n")
+            os.utime(test_path, ns=(0, 0))
+            _, report = Pipeline.from_config(config).run(cache=cache)
+            self.assertFalse(any(stage["cached"] for stage in report))
+
+            # uncacheable stages always run
+            config["stages"].append({"write_csv": {"path": os.path.join(tmp, "out.csv")}})
+            _, report = Pipeline.from_config(config).run(cache=cache)
+            self.assertEqual([stage["stage"] for stage in report if not stage["cached"]], ["write_csv"])
+
+            # the least recently used outputs are evicted
+            sizes = sorted(entry["bytes"] for entry in cache.read_index().values())
+            small = StageCache(os.path.join(tmp, "small"), max_bytes=sizes[-1] + sizes[-2])
+            Pipeline.from_config(config).run(cache=small)
+            self.assertLessEqual(small.total_bytes(), small.max_bytes)
+            self.assertEqual([entry["stage"] for entry in small.read_index().values()][-1], "sort_columns")
+            self.assertEqual(len(glob.glob(os.path.join(tmp, "small", "*.pkl"))), len(small.read_index()))
+
+
+class TestBenchmarks (unittest.TestCase):
+    def test_generate_dataset(self):
+        df = generate_dataset(5000, seed=3, censored_fraction=0.2, blank_fraction=0.05)
+        self.assertEqual(list(df.columns), ["SampleID", "DateCollected", "ChemicalName", "Amount", "UOM", "MinDetectLimit"])
+        self.assertEqual(len(df), 5000)
+        pd.testing.assert_frame_equal(df, generate_dataset(5000, seed=3, censored_fraction=0.2, blank_fraction=0.05))
+        self.assertFalse(df.equals(generate_dataset(5000, seed=4)))
+        self.assertAlmostEqual(df["Amount"].isna().mean(), 0.05, delta=0.02)
+
+        # every generated value can be cleaned
+        names = list(df["ChemicalName"].unique())
+        long = df.copy()
+        dc.clean_long_units(long)
+        dc.format_long_amount(long, erase_invalid=False)
+        dc.standardise_long_unit(long, generate_unit_table(), erase_invalid=False)
+        self.assertAlmostEqual((long["Prefix"] == "<").mean(), 0.2 * 0.95, delta=0.03)
+
+        # chunks continue the sample ids
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "generated.csv")
+            write_dataset(path, 2500, chunk_rows=1000, seed=3)
+            written = pd.read_csv(path)
+        self.assertEqual(len(written), 2500)
+        self.assertTrue(written["SampleID"].is_monotonic_increasing)
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks([300, 600], repeat=2)
+        self.assertEqual([(run["rows"], run["pipeline"]) for run in results["runs"]],
+                         [(n, name) for n in [300, 600]
+                          for name in ["wide", "long", "fused", "per_cell", "amount_parsing"]])
+        for run in results["runs"]:
+            self.assertAlmostEqual(run["total_seconds"], sum(stage["seconds"] for stage in run["stages"]))
+            for stage in run["stages"]:
+                self.assertIsNotNone(stage["peak_memory_bytes"])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "results.json")
+            save_results(results, path)
+            comparison = compare_results(load_results(path), results)
+        self.assertTrue((comparison["speedup"] == 1).all())
+        self.assertEqual(len(comparison), len(results_table(results)))
+
+
+class TestSchema (unittest.TestCase):
+    def test_compact_long_dataset(self):
+        # compact dtypes should give the same cleaned dataset and be kept by every stage
+        schema = {**SCHEMAS["fixture"], "DateCollected": "category"}
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            expected = dc.clean_long_dataset(
+                pd.read_csv(test_path), ["SampleID"], ["DateCollected"], "ChemicalName",
+                desired_chemical_names, convert_to_standard)
+            df = dc.clean_long_dataset(
+                read_compact_csv(test_path, schema), ["SampleID"], ["DateCollected"], "ChemicalName",
+                desired_chemical_names, convert_to_standard)
+            self.assertEqual(df.to_csv(), expected.to_csv(), test_path)
+
+            def clean(df):
+                df = dc.clean_long_dataset(df, ["SampleID"], ["DateCollected"], "ChemicalName",
+                                           desired_chemical_names, convert_to_standard)
+                df = dc.filter_rows_by_nas(df, desired_chemical_names, 1000)
+                (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, desired_chemical_names)
+                dc.fill_dataset_nans(df, desired_chemical_names, amount_avgs, missing_chemicals)
+                return df
+
+            expected = clean(pd.read_csv(test_path))
+            df = clean(read_compact_csv(test_path, "fixture", float32=True))
+            self.assertEqual(df["DateCollected", ""].dtype, np.dtype("datetime64[ns]"))
+            for chemical_name in desired_chemical_names:
+                if (chemical_name, "Amount") not in expected.columns:
+                    continue
+                self.assertEqual(df[chemical_name, "Amount"].dtype, np.float32)
+                self.assertEqual(df[chemical_name, "Prefix"].dtype, PREFIX_DTYPE)
+                np.testing.assert_allclose(df[chemical_name, "Amount"], expected[chemical_name, "Amount"], rtol=1e-6)
+                self.assertEqual(list(df[chemical_name, "Prefix"]), list(expected[chemical_name, "Prefix"]))
+
+            # frames cleaned without a schema can be compacted after aggregating
+            compact = compact_pivoted(expected.copy(), desired_chemical_names, float32=True)
+            self.assertEqual(list(compact.dtypes.drop([("DateCollected", ""), ("SampleID", "")])),
+                             list(df.dtypes.drop([("DateCollected", ""), ("SampleID", "")])))
+
+    def test_compact_wide_dataset(self):
+        # the wide stages should keep the same compact dtypes as the long stages
+        def clean(df, drop_duplicates):
+            df = pivot_dataset(df, ["SampleID"], ["DateCollected"], "ChemicalName",
+                               ["Amount", "UOM", "MinDetectLimit"], desired_chemical_names,
+                               drop_duplicates=drop_duplicates)
+            dc.clean_dataset_units(df, desired_chemical_names)
+            dc.format_dataset_amount(df, desired_chemical_names)
+            dc.standardise_dataset_unit(df, desired_chemical_names, convert_to_standard, erase_invalid=True)
+            dc.drop_units_min_detect(df, desired_chemical_names)
+            dc.agg_dataset_measurement(df, desired_chemical_names)
+            df = dc.filter_rows_by_nas(df, desired_chemical_names, 1000)
+            (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, desired_chemical_names)
+            dc.fill_dataset_nans(df, desired_chemical_names, amount_avgs, missing_chemicals)
+            return df
+
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            for drop_duplicates in [False, True]:
+                expected = clean(pd.read_csv(test_path), drop_duplicates)
+                df = clean(read_compact_csv(test_path, "fixture", float32=True), drop_duplicates)
+                for chemical_name in desired_chemical_names:
+                    if (chemical_name, "Amount") not in expected.columns:
+                        continue
+                    self.assertEqual(expected[chemical_name, "Amount"].dtype, np.float64)
+                    self.assertEqual(df[chemical_name, "Amount"].dtype, np.float32, (test_path, chemical_name))
+                    self.assertEqual(df[chemical_name, "Prefix"].dtype, PREFIX_DTYPE, (test_path, chemical_name))
+                    np.testing.assert_allclose(df[chemical_name, "Amount"], expected[chemical_name, "Amount"],
+                                               rtol=1e-6)
+                    self.assertEqual(list(df[chemical_name, "Prefix"]), list(expected[chemical_name, "Prefix"]))
+
+    def test_memory_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "generated.csv")
+            write_dataset(path, 20000)
+            baseline = pd.read_csv(path)
+            df = read_compact_csv(path, "fixture", float32=True)
+
+        report = memory_report(df, baseline)
+        self.assertEqual(list(report.index), ["Index", *df.columns, "Total"])
+        self.assertEqual(report.loc["Total", "bytes"], df.memory_usage(deep=True).sum())
+        self.assertGreater(report.loc["Total", "reduction"], 5)
+        self.assertEqual(str(df["UOM"].dtype), "category")
+
+
+class TestConvertText (unittest.TestCase):
+    @staticmethod
+    def reference_conversion(path):
+        # the converter was rewritten from reading and writing each row with the csv module
+        import csv
+        output = io.StringIO(newline="")
+        with open(path, "r", encoding="utf-8", errors="replace") as txt_file:
+            writer = csv.writer(output, delimiter=",")
+            for row in csv.reader(txt_file, delimiter="|"):
+                writer.writerow(row)
+        return output.getvalue().encode("utf-8")
+
+    def test_convert_files(self):
+        rng = np.random.default_rng(0)
+        words = np.array(["a", "b c", "1,5", "<0.5", "", " x ", "mg/L", "caf\xe9"], dtype=object)
+        lines = ["|".join(rng.choice(words, 5)) for _ in range(3000)]
+        contents = {
+            "plain.txt": ("W|X|Y|Z|V\r\n" + "\r\n".join(lines)).encode("utf-8"),
+            "trailing.txt": ("W|X|Y|Z|V\n" + "\n".join(lines) + "\n\n").encode("utf-8"),
+            "invalid.txt": ("W|X|Y|Z|V\n" + "\n".join(lines) + "\n").encode("utf-8") + b"|\xff\xfe|b|c|d\n",
+            "quoted.txt": ("W|X|Y|Z|V\n" + "\n".join(lines[:100]) + '\n"a|\nb"|c|d|e|f\n').encode("utf-8"),
+            # short rows in a later byte range, and a blank line
+            "ragged.txt": ("W|X|Y|Z|V\n" + "\n".join(lines[:2000]) + "\na|b\n\nc\n" + "\n".join(lines[:10])
+                           ).encode("utf-8"),
+            "empty.txt": b"",
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name, content in contents.items():
+                paths.append(os.path.join(tmp, name))
+                with open(paths[-1], "wb") as f:
+                    f.write(content)
+
+            self.assertGreater(len(byte_ranges(paths[0], 4096)), 10)
+            outputs = convert_files(paths, "csv", workers=2, range_size=4096)
+            for path, output in zip(paths, outputs):
+                self.assertEqual(output, path[:-len(".txt")] + ".csv")
+                with open(output, "rb") as f:
+                    self.assertEqual(f.read(), self.reference_conversion(path), path)
+
+            cache_dir = os.path.join(tmp, "cache")
+            outputs = convert_files(paths[:-1], "parquet", workers=2, range_size=4096, cache_dir=cache_dir)
+            for path, output in zip(paths, outputs):
+                csv_path = path[:-len(".txt")] + ".csv"
+                self.assertEqual(output, cache_path(csv_path, cache_dir))
+                expected = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+                pd.testing.assert_frame_equal(pd.read_parquet(output), expected)
+
+                # the parquet file is the cache of the csv, which is not needed to read it
+                os.remove(csv_path)
+                pd.testing.assert_frame_equal(cached_read_csv(csv_path, ["W", "X"], cache_dir=cache_dir,
+                                                              **TEXT_CACHE_READ_CSV), expected[["W", "X"]])
+
+            # the cache is invalid once the text file changes
+            with open(paths[0], "ab") as f:
+                f.write(b"\r\na|b|c|d|e")
+            with self.assertRaises(FileNotFoundError):
+                cached_read_csv(paths[0][:-len(".txt")] + ".csv", cache_dir=cache_dir, **TEXT_CACHE_READ_CSV)
+
+            # rows with more fields than the header have no column
+            with open(paths[0], "ab") as f:
+                f.write(b"\r\na|b|c|d|e|f")
+            with self.assertRaises(ValueError):
+                convert_files(paths[:1], "parquet", workers=1, range_size=4096)
+
+    def test_convert_text(self):
+        self.assertEqual(convert_text(b""), b"")
+        self.assertEqual(convert_text(b"a,b|c|,|x,|,y\r\n|1,2\rd"), b'"a,b",c,",","x,",",y"\r\n,"1,2"\r\nd\r\n')
+
+
+class TestSqlBackend (unittest.TestCase):
+    def test_fixtures(self):
+        # the SQLite backend should give exactly the acceptance test output
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            expected = clean_fixture(test_path, dc.format_dataset_amount, True)
+            df = sql_backend.clean_dataset(test_path, ["SampleID"], ["DateCollected"], "ChemicalName",
+                                           desired_chemical_names, convert_to_standard, 1000,
+                                           backend="sqlite", chunksize=4)
+            self.assertEqual(df.sort_index(axis=1).to_csv(index=False), expected, test_path)
+
+    def test_backends(self):
+        names = ["Calcium", "Chloride", "Sodium", "pH"]
+        context = (["SampleID"], ["DateCollected"], "ChemicalName", names, generate_unit_table())
+        df = generate_dataset(5000, seed=2)
+        for policy in dc.AGG_POLICIES:
+            for na_threshold in [0, 2]:
+                expected = sql_backend.clean_dataset(df, *context, na_threshold, policy=policy)
+                result = sql_backend.clean_dataset(df, *context, na_threshold, backend="sqlite",
+                                                   policy=policy, chunksize=1000)
+                # sums may differ in the last bits
+                pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-12)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dataset.parquet")
+            df.to_parquet(path)
+            database = os.path.join(tmp, "dataset.sqlite")
+            expected = sql_backend.clean_dataset(path, *context, 2)
+            result = sql_backend.clean_dataset(path, *context, 2, backend="sqlite", database=database)
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-12)
+            self.assertTrue(os.path.exists(database))
+
+        with self.assertRaises(ValueError):
+            sql_backend.clean_dataset(df, *context, 2, backend="spark")
+
+
+
+def clean_wide(df, names, convert_to_standard, drop=True, aggregate=True, policy="default"):
+    # the wide format stages run one after another
+    df = pivot_dataset(df, ["SampleID"], ["DateCollected"], "ChemicalName", ["Amount", "UOM", "MinDetectLimit"], names)
+    dc.clean_dataset_units(df, names)
+    dc.format_dataset_amount(df, names)
+    dc.standardise_dataset_unit(df, names, convert_to_standard, erase_invalid=True)
+    if drop:
+        dc.drop_units_min_detect(df, names)
+    if aggregate:
+        dc.agg_dataset_measurement(df, names, policy=policy)
+    return df
+
+
+class TestLazyCleaning (unittest.TestCase):
+    def test_fixtures(self):
+        # fusing the stages should give exactly the same dataset
+        for test_path in glob.glob("Tests/small_*_in.csv"):
+            dataset = LazyDataset.scan_csv(test_path, ["SampleID"], ["DateCollected"], "ChemicalName",
+                                           desired_chemical_names, chunksize=5) \
+                .clean_units().format_amount().standardise_unit(convert_to_standard, erase_invalid=True)
+            for drop in [False, True]:
+                for aggregate in [False, True]:
+                    lazy = dataset.drop_units_min_detect() if drop else dataset
+                    lazy = lazy.agg_measurement() if aggregate else lazy
+                    self.assertEqual(lazy.plan().pivot_last, drop and aggregate)
+                    expected = clean_wide(pd.read_csv(test_path), desired_chemical_names, convert_to_standard,
+                                          drop, aggregate)
+                    pd.testing.assert_frame_equal(lazy.collect(), expected, obj=test_path)
+
+    def test_plan(self):
+        names = ["Calcium", "Chloride", "Sodium", "pH"]
+        df = generate_dataset(3000, seed=5)
+        dataset = LazyDataset.from_frame(df, ["SampleID"], ["DateCollected"], "ChemicalName", names) \
+            .clean_units().format_amount()
+        with self.assertRaises(ValueError):
+            dataset.clean_units()
+        with self.assertRaises(ValueError):
+            LazyDataset.from_frame(df, ["SampleID"], ["DateCollected"], "ChemicalName", names).agg_measurement()
+
+        for policy in dc.AGG_POLICIES:
+            lazy = dataset.standardise_unit(generate_unit_table(), True).drop_units_min_detect().agg_measurement(policy)
+            pd.testing.assert_frame_equal(lazy.collect(), clean_wide(df, names, generate_unit_table(), policy=policy))
+        self.assertIn("where ChemicalName in", lazy.plan().explain())
+
+        # unit conversion functions rather than a unit table
+        units = {"mg/l": lambda amount: amount, "ug/l": lambda amount: amount / 1000,
+                 "µg/l": lambda amount: amount / 1000, "g/l": lambda amount: amount * 1000}
+        lazy = LazyDataset.from_frame(df, ["SampleID"], ["DateCollected"], "ChemicalName", names[:3]) \
+            .clean_units().format_amount().standardise_unit(units, True)
+        pd.testing.assert_frame_equal(lazy.collect(), clean_wide(df, names[:3], units, drop=False, aggregate=False))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dataset.parquet")
+            df.to_parquet(path, row_group_size=500)
+            lazy = LazyDataset.scan_parquet(path, ["SampleID"], ["DateCollected"], "ChemicalName", ["Calcium", "pH"]) \
+                .clean_units().format_amount().standardise_unit(generate_unit_table(), True)
+            # missing amounts are read from parquet as None rather than NaN
+            pd.testing.assert_frame_equal(lazy.collect(workers=2), clean_wide(
+                pd.read_parquet(path), ["Calcium", "pH"], generate_unit_table(), drop=False, aggregate=False))
+
+        config = {"sample_id_columns": ["SampleID"], "per_sample_data": ["DateCollected"],
+                  "chemical_name_column": "ChemicalName", "desired_chemical_names": names,
+                  "units": generate_unit_table(), "stages": [{"clean_fused": {"erase_invalid": True}}]}
+        result, _ = Pipeline.from_config(config).run(df)
+        pd.testing.assert_frame_equal(result, clean_wide(df, names, generate_unit_table()))
+
+class TestSpatialImputation (unittest.TestCase):
+    def pivoted(self):
+        return pd.DataFrame({
+            ("SampleID", ""): [1, 2, 3, 4, 5, 6],
+            ("Latitude", ""): [-33.0, -33.0, -33.0, -34.0, -33.6, np.nan],
+            ("Longitude", ""): [151.0, 151.0, 151.1, 151.0, 151.0, 151.0],
+            ("Calcium", "Amount"): [1.0, np.nan, 3.0, 5.0, np.nan, np.nan],
+            ("Calcium", "Prefix"): ["=", np.nan, "<", "=", np.nan, np.nan],
+            ("Chloride", "Amount"): [np.nan] * 6,
+            ("Chloride", "Prefix"): [np.nan] * 6,
+        })
+
+    def test_idw_estimates(self):
+        df = self.pivoted()
+        index = dataset_spatial_index(df)
+        self.assertEqual(list(index.rows), [0, 1, 2, 3, 4])
+        # 0.1 degrees of longitude at 33S is about 9.3km, a degree of latitude about 111km
+        self.assertEqual(list(wells_within_radius(index, -33.0, 151.0, 10)), [0, 1, 2])
+        self.assertEqual([list(rows) for rows in wells_within_radius(index, [-34.0, 0.0], [151.0, 0.0], 1)],
+                         [[3], []])
+
+        amounts = df["Calcium", "Amount"].to_numpy()
+        estimates = idw_estimates(index, amounts, k=3)
+        # sample 2 is at the same well as sample 1, the last sample has no location
+        self.assertEqual(estimates[1], 1.0)
+        self.assertTrue(np.isnan(estimates[[0, 2, 3, 5]]).all())
+        distances = np.array([66.72, 67.36, 44.48])
+        self.assertAlmostEqual(estimates[4], np.average([1.0, 3.0, 5.0], weights=1 / distances ** 2), places=2)
+        self.assertEqual(idw_estimates(index, amounts, k=1)[4], 5.0)
+        self.assertTrue(np.isnan(idw_estimates(index, amounts, k=3, max_distance_km=40)[4]))
+
+    def test_fill_dataset_nans_spatial(self):
+        df = self.pivoted()
+        names = ["Calcium", "Chloride"]
+        (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, names)
+        fill_dataset_nans_spatial(df, names, amount_avgs, missing_chemicals, k=1)
+        self.assertNotIn("Chloride", df.columns.get_level_values(0))
+        self.assertEqual(list(df["Calcium", "Amount"]), [1.0, 1.0, 3.0, 5.0, 5.0, 3.0])
+        self.assertEqual(list(df["Calcium", "Prefix"]), ["=", "=", "<", "=", "=", "="])
+
+        pipeline = Pipeline([("fill_nans_spatial", {"k": 1})], desired_chemical_names=names)
+        filled, _ = pipeline.run(self.pivoted())
+        pd.testing.assert_frame_equal(filled, df)
+
+
+class TestTemporal (unittest.TestCase):
+    def pivoted(self):
+        return pd.DataFrame({
+            ("Well", ""): ["a", "a", "a", "b", "b", "a", np.nan, "b"],
+            ("Date", ""): ["2001-01-01", "2001-01-11", "2001-01-31", "2001-01-01",
+                           "2001-03-01", "2001-02-10", "2001-01-05", "invalid"],
+            ("Calcium", "Amount"): [1.0, np.nan, 4.0, np.nan, 2.0, 10.0, np.nan, np.nan],
+            ("Calcium", "Prefix"): ["=", np.nan, "<", np.nan, "=", "=", np.nan, np.nan],
+            ("Chloride", "Amount"): [np.nan, 2.0, np.nan, 1.0, 3.0, 6.0, 1.0, np.nan],
+            ("Chloride", "Prefix"): [np.nan, "=", np.nan, "=", "=", "=", "=", np.nan],
+        })
+
+    def test_interpolate_by_well(self):
+        names = ["Calcium", "Chloride"]
+        df = self.pivoted()
+        interpolate_by_well(df, names, "Well", "Date")
+        # gaps outside a well's measurements, without a well or a date are not filled
+        self.assertEqual(df["Calcium", "Amount"].fillna(-1).tolist(), [1.0, 2.0, 4.0, -1, 2.0, 10.0, -1, -1])
+        self.assertEqual(df["Calcium", "Prefix"].fillna("").tolist(), ["=", "=", "<", "", "=", "=", "", ""])
+        self.assertAlmostEqual(df["Chloride", "Amount"][2], 2.0 + 4.0 * 20 / 30)
+
+        df = self.pivoted()
+        interpolate_by_well(df, names, "Well", "Date", method="nearest")
+        self.assertEqual(df["Chloride", "Amount"][2], 6.0)
+        df = self.pivoted()
+        interpolate_by_well(df, names, "Well", "Date", max_gap_days=20)
+        self.assertTrue(np.isnan(df["Chloride", "Amount"][2]))
+
+        # the same as interpolating each well on its own
+        rng = np.random.default_rng(0)
+        n = 5000
+        amounts = rng.random((n, 2))
+        amounts[rng.random((n, 2)) < 0.4] = np.nan
+        df = pd.DataFrame({
+            ("Well", ""): rng.integers(0, 300, n),
+            ("Date", ""): pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.permutation(n), unit="D"),
+            **{(name, value): amounts[:, idx] if value == "Amount" else np.where(np.isnan(amounts[:, idx]), np.nan, "=")
+               for idx, name in enumerate(names) for value in ["Amount", "Prefix"]},
+        })
+        expected = df.copy()
+        for name in names:
+            series = pd.Series(df[name, "Amount"].to_numpy(), index=df["Date", ""])
+            expected[name, "Amount"] = series.groupby(df["Well", ""].to_numpy()).transform(
+                lambda well: well.sort_index().interpolate(method="time", limit_area="inside")).to_numpy()
+        interpolate_by_well(df, names, "Well", "Date")
+        for name in names:
+            np.testing.assert_allclose(df[name, "Amount"], expected[name, "Amount"])
+
+    def test_resample_by_well(self):
+        names = ["Calcium", "Chloride"]
+        df = resample_by_well(self.pivoted(), names, "Well", "Date")
+        self.assertEqual(df["Well", ""].tolist(), ["a", "a", "b", "b", "b"])
+        self.assertEqual(df["Date", ""].dt.month.tolist(), [1, 2, 1, 2, 3])
+        # January of well a averages its samples, February of well b is interpolated
+        self.assertEqual(df["Calcium", "Amount"].fillna(-1).tolist(), [2.5, 10.0, -1, -1, 2.0])
+        self.assertEqual(df["Chloride", "Amount"].tolist(), [2.0, 6.0, 1.0, 2.0, 3.0])
+        self.assertEqual(df["Chloride", "Prefix"].tolist(), ["=", "=", "=", "=", "="])
+
+        pipeline = Pipeline([("resample_by_well", {"well_columns": ["Well"], "date_column": "Date",
+                                                   "frequency": "quarterly", "interpolate": False})],
+                            desired_chemical_names=names)
+        df, _ = pipeline.run(self.pivoted())
+        self.assertEqual(df["Calcium", "Amount"].tolist(), [5.0, 2.0])
+        self.assertEqual(df["Calcium", "Prefix"].tolist(), ["=", "="])
+        with self.assertRaises(ValueError):
+            resample_by_well(self.pivoted(), names, "Well", "Date", "weekly")
+
+        # without any of the chemicals the grid is empty
+        for chemicals in [[], ["Sodium"]]:
+            df = resample_by_well(self.pivoted(), chemicals, "Well", "Date")
+            self.assertEqual(list(df.columns), [("Well", ""), ("Date", "")])
+            self.assertEqual(len(df), 0)
+            self.assertEqual(df["Date", ""].dtype, np.dtype("datetime64[ns]"))
+
+
+class TestIncremental (unittest.TestCase):
+    def test_update_incremental(self):
+        names = ["Calcium", "Chloride", "Sodium", "pH"]
+        context = (["SampleID"], ["DateCollected"], "ChemicalName", names, generate_unit_table())
+        df = generate_dataset(10000, seed=1)
+        first = df[df["SampleID"] < 800]
+        # the next export has new samples, some changed samples and its rows in another order
+        second = df.copy()
+        second.loc[second["SampleID"].isin([3, 50, 700]), "Amount"] = "1.5"
+        second = second.sample(frac=1, random_state=0)
+
+        def batch(df):
+            df = dc.clean_long_dataset(df, *context)
+            df = dc.filter_rows_by_nas(df, names, 2)
+            (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, names)
+            dc.fill_dataset_nans(df, names, amount_avgs, missing_chemicals)
+            return df.sort_index(axis=1)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            update = update_incremental(first, tmp, *context, na_threshold=2)
+            self.assertEqual((update.new_samples, update.changed_samples), (800, 0))
+            pd.testing.assert_frame_equal(update.delta.sort_index(axis=1), batch(first), check_dtype=False)
+
+            update = update_incremental(second, tmp, *context, na_threshold=2)
+            n_samples = df["SampleID"].nunique()
+            self.assertEqual((update.new_samples, update.changed_samples), (n_samples - 800, 3))
+            self.assertEqual(sorted(update.replaced["SampleID"]), [3, 50, 700])
+            self.assertEqual(update.delta["SampleID", ""].isin([3, 50, 700]).sum(), 3)
+
+            # nothing changed, nothing is cleaned or written
+            update = update_incremental(second, tmp, *context, na_threshold=2)
+            self.assertEqual((update.new_samples, update.changed_samples, len(update.delta)), (0, 0, 0))
+
+            expected = batch(second)
+            pd.testing.assert_frame_equal(
+                read_incremental_dataset(tmp, ["SampleID"], names).sort_index(axis=1), expected, check_dtype=False)
+            compact_incremental(tmp, ["SampleID"])
+            self.assertEqual(len(glob.glob(os.path.join(tmp, "part-*.parquet"))), 1)
+            pd.testing.assert_frame_equal(
+                read_incremental_dataset(tmp, ["SampleID"], names).sort_index(axis=1), expected, check_dtype=False)
+
+            # samples which are not in the export are only removed if asked
+            update = update_incremental(first, tmp, *context, na_threshold=2, remove_missing=True)
+            self.assertEqual(update.removed_samples, n_samples - 800)
+            self.assertEqual(update.changed_samples, 3)
+            pd.testing.assert_frame_equal(
+                read_incremental_dataset(tmp, ["SampleID"], names).sort_index(axis=1), batch(first), check_dtype=False)
+
+    def test_remove_imputation_stats(self):
+        df = pd.DataFrame({("A", "Amount"): [1.0, 2.0, np.nan, 2.0, -3.0, 0.0]})
+        stats = partial_imputation_stats(df, ["A"])
+        part = partial_imputation_stats(df.iloc[3:], ["A"])
+        removed = remove_imputation_stats(stats, part)["A"]
+        expected = partial_imputation_stats(df.iloc[:3], ["A"])["A"]
+        self.assertEqual((removed.count, removed.total, removed.zeros), (2, 3.0, 0))
+        pd.testing.assert_series_equal(removed.positive, expected.positive, check_names=False, check_index_type=False)
+        self.assertEqual(len(removed.negative), 0)
+        self.assertEqual(removed.value_counts.to_dict(), {1.0: 1, 2.0: 1})
+        with self.assertRaises(ValueError):
+            remove_imputation_stats(part, stats)
 
 
 if __name__ == '__main__':
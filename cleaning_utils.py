@@ -1,11 +1,17 @@
 import math
-from typing import Callable, Any
+import pickle
+import warnings
+from typing import Callable, Any, NamedTuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import itertools as itt
 
 
 import pandas as pd
 import numpy as np
 
+from profiling import span, instrument_from_environment
+
 
 # : `cleaning_utils.py` contains very general functions that can be applied to a wide range of datasets.
 
@@ -58,9 +64,12 @@ def pivot_dataset(
     Returns a dataset with the following sets of columns: `sample_id_columns` 
     and `per_sample_data` columns. Then for each desired chemical name there 
     will be a pandas multiindex column for each chemical containing the 
-    `values_per_chemical` columns.
+    `values_per_chemical` columns. The dtypes of the `values_per_chemical` columns
+    are recorded in `attrs["value_dtypes"]` (eg "float32" or "category"), so the
+    wide stages of data_cleaning can keep compact dtypes (see schema.py).
     """
 
+    value_dtypes = {value: str(df[value].dtype) for value in values_per_chemical}
     df = df[df[chemical_name_column].isin(
         desired_chemical_names)]
 
@@ -88,6 +97,44 @@ def pivot_dataset(
     df_pivoted = df_pivoted.reset_index()  # ? May not be needed
     # Removes unnecessary data in the coulmns multiindex
     df_pivoted.columns.names = [None, None]
+    df_pivoted.attrs["value_dtypes"] = value_dtypes
+    return df_pivoted
+
+
+def pivot_measurements(
+        df: pd.DataFrame,
+        sample_id_columns: list[str],
+        per_sample_data: list[str],
+        chemical_name_column: str,
+        values_per_chemical: list[str],
+) -> pd.DataFrame:
+    """
+    Pivots a dataset which has already been cleaned in long format, so that 
+    there is at most one row per chemical within each sample. Returns the same 
+    layout as `pivot_dataset`, however each of the `values_per_chemical` columns 
+    keeps its own dtype (eg float amounts) rather than being wrapped in lists.
+
+    Parameters
+    ----------
+    See `pivot_dataset`. 
+
+    Returns 
+    ---------
+    The pivoted dataset with `sample_id_columns` and `per_sample_data` 
+    columns followed by a multiindex column for each chemical.
+    """
+
+    df = df.set_index([*sample_id_columns, *per_sample_data, chemical_name_column])
+    df_pivoted = pd.concat(
+        [df[value].unstack(chemical_name_column) for value in values_per_chemical],
+        axis=1,
+        keys=values_per_chemical
+    )
+
+    df_pivoted.columns = df_pivoted.columns.reorder_levels(order=[1, 0])
+    df_pivoted = df_pivoted.sort_index(axis=1, level=0)
+    df_pivoted = df_pivoted.reset_index()
+    df_pivoted.columns.names = [None, None]
     return df_pivoted
 
 
@@ -99,6 +146,8 @@ def transform_chemical_data(
     output_row_names: list[str],
     *,
     split_lists: bool = False,
+    workers: int = 1,
+    use_threads: bool = False,
 ) -> None:
     """
     Helper function which can be used to easily transform mutliple columns of the 
@@ -131,44 +180,217 @@ def transform_chemical_data(
         - False (default): If a list is in a row it will be passed directly to the 
             transform function. Keep this option to false if `transform` is 
             meant ot aggregrate the multiple values in the lists.
+
+    `workers` : The number of chemicals to transform in parallel, 
+        by default they are transformed one after another. See `map_chemicals`.
+
+    `use_threads` : Run the chemicals in threads rather than processes.
+    """
+    if split_lists:
+        assert len(input_row_names) > 0
+
+    results = map_chemicals(
+        partial(apply_transform, transform, split_lists, len(output_row_names)),
+        [[df[(chem_name, i)].to_numpy() for i in input_row_names] for chem_name in chem_names],
+        workers=workers,
+        use_threads=use_threads,
+    )
+
+    with span("transform_chemical_data.assign", len(df) * len(chem_names)):
+        for chem_name, res in zip(chem_names, results):
+            for idx, output_row in enumerate(output_row_names):
+                df[(chem_name, output_row)] = res[idx]
+
+
+def apply_transform(transform: Callable[[Any], tuple[Any]],
+                    split_lists: bool,
+                    n_outputs: int,
+                    *columns: np.ndarray
+                    ) -> list[tuple[Any]]:
     """
-    for chem_name in chem_names:
+    Applies the `transform` to every row of the `columns` for `transform_chemical_data`, 
+    and returns the list of output columns.
+    """
+    if split_lists:
+        def wrapped_transform(*args):
 
-        input_row_multiindex = [(chem_name, i) for i in input_row_names]
-        output_row_multiindex = [(chem_name, i) for i in output_row_names]
+            if type(args[0]) == list:
+                if len(args[0]) == 1:
+                    res = [transform(*[i[0] for i in args])]
+                    res = tuple(list(row) for row in zip(*res))
+                    return res
+                else:
+                    list_rows = [transform(*[args[i][n] for i in range(len(args))])
+                                 for n in range(len(args[0]))]
+                    list_cols = tuple(list(row) for row in zip(*list_rows))
+                    return list_cols
+            else:
+                res = transform(*[i for i in args])
+                return res
+    else:
+        def wrapped_transform(*args):
+            return transform(*args)
 
-        if split_lists:
-            assert len(input_row_names) > 0
+    with span("apply_transform.vectorize", len(columns[0])):
+        res = np.vectorize(wrapped_transform, otypes=["object"])(*columns)
+    if len(res) == 0:
+        return [()] * n_outputs
+    with span("apply_transform.transpose", len(res)):
+        return list(zip(*[res[i] for i in range(len(res))]))
 
-            def wrapped_transform(*args):
 
-                if type(args[0]) == list:
-                    if len(args[0]) == 1:
-                        res = [transform(*[i[0] for i in args])]
-                        res = tuple(list(row) for row in zip(*res))
-                        return res
-                    else:
-                        list_rows = [transform(*[args[i][n] for i in range(len(args))])
-                                     for n in range(len(args[0]))]
-                        list_cols = tuple(list(row) for row in zip(*list_rows))
-                        return list_cols
-                else:
-                    res = transform(*[i for i in args])
-                    return res
-        else:
-            def wrapped_transform(*args):
-                row = args
-                # return transform(*[row[i] for i in input_row_multiindex])
-                return transform(*args)
+def transform_chemical_columns(
+    df: pd.DataFrame,
+    chem_names: list[str],
+    transform: Callable[..., tuple[np.ndarray, ...]],
+    input_row_names: list[str],
+    output_row_names: list[str],
+    *,
+    workers: int = 1,
+    use_threads: bool = False,
+) -> None:
+    """
+    Columnar version of `transform_chemical_data` with `split_lists=True`.
+    Rather than being called once per cell, `transform` is called with whole 
+    columns (arrays) and must return a tuple of arrays of the same length. 
+
+    Rows where the values are lists are exploded so every index of the 
+    lists is transformed in the same call, then the outputs for those rows 
+    are gathered back into lists.
+
+    Parameters 
+    ----------
+    See `transform_chemical_data`. 
+    """
+    results = map_chemicals(
+        partial(apply_column_transform, transform, len(output_row_names)),
+        [[df[(chem_name, i)].to_numpy() for i in input_row_names] for chem_name in chem_names],
+        workers=workers,
+        use_threads=use_threads,
+    )
+
+    with span("transform_chemical_columns.assign", len(df) * len(chem_names)):
+        for chem_name, res in zip(chem_names, results):
+            for idx, output_row in enumerate(output_row_names):
+                df[(chem_name, output_row)] = res[idx]
+
+
+def apply_column_transform(transform: Callable[..., tuple[np.ndarray, ...]],
+                           n_outputs: int,
+                           *columns: np.ndarray
+                           ) -> list[np.ndarray]:
+    """
+    Applies the columnar `transform` to the `columns` for `transform_chemical_columns`, 
+    exploding any list cells, and returns the list of output columns.
+    """
+    is_list = pd.Series(columns[0]).map(type).eq(list).to_numpy()
+
+    res = transform(*[column[~is_list] for column in columns])
+
+    if is_list.any():
+        cells = pd.DataFrame(dict(enumerate(columns)))[is_list]
+        exploded = cells.explode(list(cells.columns))
+        list_res = transform(*[exploded[i].to_numpy() for i in exploded.columns])
+
+        # explode keeps the order of the rows, so each row's outputs are
+        # the next len(list) values (an empty list explodes to one NaN)
+        lengths = np.maximum(cells[0].map(len).to_numpy(), 1)
+        splits = np.cumsum(lengths)[:-1]
+
+        scalar_res = res
+        res = [np.empty(len(is_list), dtype=object) for _ in range(n_outputs)]
+        for idx in range(n_outputs):
+            res[idx][~is_list] = scalar_res[idx]
+            parts = np.split(np.asarray(list_res[idx]), splits)
+            res[idx][is_list] = pd.Series([part.tolist() for part in parts], dtype=object).to_numpy()
+
+    return list(res)
+
+
+def map_chemicals(func: Callable[..., Any],
+                  args_per_chemical: list[list[Any]],
+                  *,
+                  workers: int = 1,
+                  use_threads: bool = False
+                  ) -> list[Any]:
+    """
+    Calls `func` with each chemical's arguments and returns the results in order.
+    The chemicals are independent so they can be run in parallel.
+
+    `workers` : The number of chemicals to run at once. 
+        With 1 (default) the chemicals are run one after another.
+
+    `use_threads` : By default chemicals are run in separate processes, 
+        which requires `func` (including the transform) to be picklable, 
+        eg a module level function or a `functools.partial` of one. 
+        Set to true to use threads instead. Transforms which cannot be 
+        pickled fall back to threads with a warning.
+    """
+    if workers <= 1 or len(args_per_chemical) <= 1:
+        return [func(*args) for args in args_per_chemical]
+
+    executor_class = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    if not use_threads:
+        try:
+            pickle.dumps(func)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            warnings.warn("Transform can not be pickled, running chemicals in threads instead")
+            executor_class = ThreadPoolExecutor
 
-        res = np.vectorize(wrapped_transform, otypes=["object"])(
-            *[df[i] for i in input_row_multiindex])
-        res = list(zip(*[res[i] for i in range(len(res))]))
-        for idx, output_row in enumerate(output_row_multiindex):
-            df[output_row] = res[idx]
+    with executor_class(max_workers=min(workers, len(args_per_chemical))) as executor:
+        return list(executor.map(func, *zip(*args_per_chemical)))
+
+
+class UnitTable(NamedTuple):
+    """
+    Compiled table of unit conversions, see `create_unit_table`.
+    """
+    units: pd.Index
+    offsets: np.ndarray
+    scales: np.ndarray
+    divisors: np.ndarray
 
 
-def create_standardise_units_func(units_dict: dict[str, Callable]
+def create_unit_table(conversions: dict[str, tuple[float, float, float]]
+                      ) -> UnitTable:
+    """
+    Takes a dictionary of unit names to affine conversions and compiles them
+    into arrays so whole columns can be converted at once by `convert_units`.
+
+    Each conversion is an `(offset, scale, divisor)` tuple and a value 
+    is converted as `(value + offset) * scale / divisor`. 
+    eg {"mg/l": (0, 1, 1e3), "°f": (-32, 5, 9)}
+
+    The divisor is kept separate from the scale so that conversions 
+    such as `x/1e3` give exactly the same floats as dividing directly.
+    """
+    units = pd.Index(list(conversions.keys()), dtype=object)
+    offsets, scales, divisors = np.array(
+        list(conversions.values()), dtype=float).reshape(-1, 3).T
+    return UnitTable(units, offsets, scales, divisors)
+
+
+def convert_units(unit_table: UnitTable,
+                  values: np.ndarray,
+                  uoms: np.ndarray
+                  ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Converts every value to the standard unit using the `unit_table`.
+    Units are looked up once per column by their categorical codes.
+
+    Returns a tuple of the converted values and a mask of the values 
+    whose unit is missing or not in the `unit_table` (these are NaN).
+    """
+    codes = pd.Categorical(uoms, categories=unit_table.units).codes
+    invalid = codes < 0
+    values = np.asarray(values, dtype=float)
+    converted = (values + unit_table.offsets[codes]) * \
+        unit_table.scales[codes] / unit_table.divisors[codes]
+    converted[invalid] = np.nan
+    return (converted, invalid)
+
+
+def create_standardise_units_func(units_dict: dict[str, Callable] | UnitTable
                                   ) -> Callable[[tuple[float, str]], tuple[float]]:
     """
     Takes a dictionary of unit names to functions and 
@@ -177,7 +399,16 @@ def create_standardise_units_func(units_dict: dict[str, Callable]
     and returns a tuple containing the result of applying the 
     corresponding function in the `units_dict` to the value.
     (Compatible with `transform_chemical_data`)
+
+    `units_dict` can also be a `UnitTable` from `create_unit_table`.
     """
+    if isinstance(units_dict, UnitTable):
+        unit_table = units_dict
+        units_dict = dict()
+        for idx, unit in enumerate(unit_table.units):
+            units_dict[unit] = lambda x, idx=idx: (
+                x + unit_table.offsets[idx]) * unit_table.scales[idx] / unit_table.divisors[idx]
+
     def standardise_units_func(value, uom):
         if isinstance(uom, float):
             if math.isnan(uom):
@@ -189,6 +420,83 @@ def create_standardise_units_func(units_dict: dict[str, Callable]
     return standardise_units_func
 
 
+# other spellings of units (after `normalize_unit` removes whitespace and case)
+# -> the unit used in the unit tables
+UNIT_ALIASES = {
+    "μg/l": "µg/l",  # greek mu rather than the micro sign
+    "mcg/l": "ug/l",
+    "microgramsperlitre": "ug/l",
+    "microgramsperliter": "ug/l",
+    "microgramperlitre": "ug/l",
+    "microgramperliter": "ug/l",
+    "milligramsperlitre": "mg/l",
+    "milligramsperliter": "mg/l",
+    "milligramperlitre": "mg/l",
+    "milligramperliter": "mg/l",
+    "gramsperlitre": "g/l",
+    "gramsperliter": "g/l",
+    "nanogramsperlitre": "ng/l",
+    "nanogramsperliter": "ng/l",
+    "degc": "°c",
+    "degreesc": "°c",
+    "degreescelsius": "°c",
+    "degf": "°f",
+    "degreesf": "°f",
+    "degreesfahrenheit": "°f",
+    "μs/cm": "µs/cm",
+    "microsiemenspercentimetre": "us/cm",
+    "microsiemenspercentimeter": "us/cm",
+}
+
+
+def normalize_unit(unit: str, aliases: dict[str, str] | None = UNIT_ALIASES) -> str:
+    """
+    Lowercases a unit and removes all its whitespace,
+    then replaces it with its canonical spelling in `aliases` (if any).
+    eg " Micrograms per Litre" -> "ug/l"
+    """
+    unit = "".join(unit.strip().lower().split())
+    if aliases:
+        return aliases.get(unit, unit)
+    return unit
+
+
+def factorize_units(units: np.ndarray | pd.Series,
+                    aliases: dict[str, str] | None = UNIT_ALIASES
+                    ) -> tuple[np.ndarray, pd.Index]:
+    """
+    Normalizes each distinct unit once (see `normalize_unit`), so the
+    time taken depends on the number of distinct units rather than rows.
+
+    Returns the code of every value and the normalized units the codes index.
+    Units which normalize to the same spelling share a code, missing and
+    non-string values have the code -1.
+    """
+    if isinstance(units, pd.Series) and isinstance(units.dtype, pd.CategoricalDtype):
+        codes = units.cat.codes.to_numpy()
+        uniques = units.cat.categories
+    else:
+        codes, uniques = pd.factorize(np.asarray(units, dtype=object))
+
+    normalized = pd.Series([normalize_unit(unit, aliases) if isinstance(unit, str) else None
+                            for unit in uniques], dtype=object)
+    normalized_codes, normalized_units = pd.factorize(normalized)
+    # code -1 indexes the appended -1
+    codes = np.append(normalized_codes, -1)[codes]
+    return (codes, pd.Index(normalized_units, dtype=object))
+
+
+def normalize_units(units: np.ndarray | pd.Series,
+                    aliases: dict[str, str] | None = UNIT_ALIASES
+                    ) -> np.ndarray:
+    """
+    Returns an object array of the normalized `units` (see `factorize_units`),
+    missing and non-string values become NaN.
+    """
+    codes, normalized_units = factorize_units(units, aliases)
+    return np.append(normalized_units.to_numpy(dtype=object), np.nan)[codes]
+
+
 def drop_chemical_columns(df: pd.DataFrame,
                           chemical_names: list[str],
                           drop_col_names: list[str]) -> None:
@@ -215,3 +523,120 @@ def order_cols(df: pd.DataFrame,
     new_cols = df.columns.reindex(ordered_params, level=0)
     df = df.reindex(columns=new_cols[0])
     return df
+
+
+def parameter_presence(df: pd.DataFrame,
+                       grouping: list[str],
+                       param_col: str,
+                       search_params: list[str]
+                       ) -> pd.DataFrame:
+    """
+    Builds a boolean matrix with a row for each sample (unique combination of
+    the `grouping` columns) and a column for each of the `search_params`,
+    which is true if that parameter was measured in that sample.
+
+    Parameters
+    ----------
+    `df` : the dataframe containing the dataset, one row per measurement
+
+    `grouping` : The list of columns which identify a sample 
+        eg ["SampleNumber"] or ["gm_well_id", "src_samp_collection_date"]
+
+    `param_col` : The column containing the name of the parameter measured 
+
+    `search_params` : The parameters to check for. Other parameters are ignored, 
+        however samples which have none of the `search_params` are still included.
+    """
+    group_codes = df.groupby(grouping, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    groups = df[grouping].drop_duplicates()
+    param_codes = pd.Categorical(df[param_col], categories=search_params).codes
+
+    found = param_codes >= 0
+    presence = np.zeros((len(groups), len(search_params)), dtype=bool)
+    presence[group_codes[found], param_codes[found]] = True
+
+    return pd.DataFrame(presence,
+                        index=pd.MultiIndex.from_frame(groups),
+                        columns=pd.Index(search_params, name=param_col))
+
+
+def params_per_sample_histogram(presence: pd.DataFrame) -> np.ndarray:
+    """
+    Takes the output of `parameter_presence` and returns the number of samples 
+    which have each number of parameters measured (from 0 to all of them).
+    """
+    return np.bincount(presence.sum(axis=1), minlength=presence.shape[1] + 1)
+
+
+def samples_per_param_histogram(presence: pd.DataFrame) -> pd.Series:
+    """
+    Takes the output of `parameter_presence` and returns the number of samples 
+    in which each parameter was measured.
+    """
+    return presence.sum(axis=0)
+
+
+
+class MissingIndex(NamedTuple):
+    """
+    Packed bitset of which chemical amounts are missing in each sample,
+    see `create_missing_index`.
+    """
+    chemicals: pd.Index
+    bits: np.ndarray
+    counts: np.ndarray
+
+
+def create_missing_index(df: pd.DataFrame,
+                         chem_names: list[str],
+                         value_name: str = "Amount"
+                         ) -> MissingIndex:
+    """
+    Builds the missingness index of a pivoted dataset once, so it can be 
+    queried at any number of thresholds without scanning the dataset again.
+
+    Each row of `bits` holds one bit per chemical (packed 8 to a byte), 
+    set if the chemical's `value_name` column is NaN in that row. 
+    `counts` is the number of missing chemicals in each row.
+
+    Parameters
+    ----------
+    `df` : the pivoted dataframe, rows are samples
+
+    `chem_names` : The chemicals to index, in the order of the bits
+
+    `value_name` : The column of each chemical which is checked for NaNs
+    """
+    missing = np.column_stack(
+        [df[(chem_name, value_name)].isna().to_numpy() for chem_name in chem_names]
+    ) if len(chem_names) > 0 else np.zeros((len(df), 0), dtype=bool)
+    bits = np.packbits(missing, axis=1, bitorder="little")
+    return MissingIndex(pd.Index(chem_names), bits, missing.sum(axis=1))
+
+
+def rows_with_missing_at_most(missing_index: MissingIndex, k: int) -> np.ndarray:
+    """
+    Returns a boolean mask of the rows with at most `k` missing chemicals.
+    """
+    return missing_index.counts <= k
+
+
+def rows_missing_chemical(missing_index: MissingIndex, chem_name: str) -> np.ndarray:
+    """
+    Returns a boolean mask of the rows where `chem_name` is missing.
+    """
+    idx = missing_index.chemicals.get_loc(chem_name)
+    return (missing_index.bits[:, idx // 8] >> (idx % 8) & 1).astype(bool)
+
+
+def completeness_histogram(missing_index: MissingIndex) -> np.ndarray:
+    """
+    Returns the number of rows with each number of missing chemicals 
+    (from 0 to all of them). The cumulative sum is the number of rows 
+    kept by `rows_with_missing_at_most` for every `k`.
+    """
+    return np.bincount(missing_index.counts, minlength=len(missing_index.chemicals) + 1)
+
+
+# profiles the functions above if the CLEANING_PROFILE variable is set, see profiling.py
+instrument_from_environment(__name__)
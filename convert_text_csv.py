@@ -1,38 +1,298 @@
-import csv
-import sys
-import glob, os
-
-#  USYD CODE CITATION ACKNOWLEDGEMENT
-#  I declare that the following lines of code have been copied from the
-#  website StackOverFlow and it is not my own work. 
- 
-#  Original URL
-#  https://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072
-#  Last access Auguest, 2023.
-
-maxInt = sys.maxsize
-
-while True:
-    # decrease the maxInt value by factor 10 
-    # as long as the OverflowError occurs.
-    try:
-        csv.field_size_limit(maxInt)
-        break
-    except OverflowError:
-        maxInt = int(maxInt/10)
-#end of copied code
-
-os.chdir("DP_GWDBQLD/")
-for file in glob.glob("*.txt"):
-    input_filename = str(file)
-    output_filename = str(file).split(".")[0] + ".csv"
-
-    # Read the contents of the txt file and write them to a csv file
-    with open(input_filename, "r", encoding='utf-8', errors='replace') as txt_file, open(output_filename, "w", newline='', encoding='utf-8') as csv_file:
-        reader = csv.reader(txt_file, delimiter='|')
-        writer = csv.writer(csv_file, delimiter=',')
-
-        for row in reader:
-            writer.writerow(row)
-
-    print(f"{input_filename} has been converted to {output_filename}.")
\ No newline at end of file
+import csv
+import io
+import os
+import sys
+import glob
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from dataset_cache import cache_path, cache_options, file_fingerprint, write_cache_metadata
+
+
+# : `convert_text_csv.py` converts the pipe delimited `DP_GWDBQLD/*.txt` files to csv
+# : (or parquet, written as the `dataset_cache` cache of the csv with every column as strings, which
+# : `cached_read_csv(csv_path, **TEXT_CACHE_READ_CSV)` reads without the csv).
+# : Big files are split into byte ranges on line boundaries and the
+# : ranges of every file are converted concurrently in a process pool.
+# :
+# : The csv output is identical to reading each file with `csv.reader(delimiter='|')`
+# : and writing every row with `csv.writer`. Files containing quotes (or NUL) are
+# : converted with the csv module, since a quoted field may span lines. Parquet rows
+# : with fewer fields than the header are padded with empty strings, like `pd.read_csv`.
+
+# size of the byte ranges each worker converts
+RANGE_SIZE = 64 * 1024 * 1024
+
+# the largest field size accepted on every platform (a C long)
+csv.field_size_limit(2**31 - 1)
+
+# the `pd.read_csv` arguments which read the csv the same as the parquet output
+TEXT_CACHE_READ_CSV = {"dtype": str, "keep_default_na": False}
+
+
+def output_path(input_path: str, output_format: str = "csv", cache_dir: str | None = None) -> str:
+    """
+    Returns the path of the converted file, eg "DP_GWDBQLD/a.txt" -> "DP_GWDBQLD/a.csv".
+    Parquet files are stored at the `dataset_cache.cache_path` of the csv file.
+    """
+    directory, name = os.path.split(input_path)
+    csv_path = os.path.join(directory, name.split(".")[0] + ".csv")
+    if output_format == "csv":
+        return csv_path
+    return cache_path(csv_path, cache_dir)
+
+
+def byte_ranges(path: str, range_size: int = RANGE_SIZE) -> list[tuple[int, int]]:
+    """
+    Splits the file at `path` into (start, end) byte ranges of about `range_size`,
+    each ending just after a newline (or at the end of the file).
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            end = min(start + range_size, size)
+            if end < size:
+                f.seek(end)
+                newline = -1
+                while newline < 0:
+                    block = f.read(1 << 16)
+                    if not block:
+                        break
+                    newline = block.find(b"\n")
+                    end += len(block) if newline < 0 else newline + 1
+                end = min(end, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_range(path: str, start: int, end: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def convert_text(data: bytes) -> bytes:
+    """
+    Converts pipe delimited utf-8 `data` without quotes to csv, the same as
+    `csv.reader(delimiter='|')` (reading in text mode) and `csv.writer`.
+    """
+    # invalid utf-8 is replaced, and universal newlines as the file was opened in text mode
+    data = data.decode("utf-8", errors="replace").encode("utf-8")
+    data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    if data == b"":
+        return b""
+    if not data.endswith(b"\n"):
+        data += b"\n"
+
+    if b"," in data:
+        # quote the fields containing the csv delimiter, every field ends at a "|" or newline
+        chars = np.frombuffer(data, dtype=np.uint8)
+        delimiters = np.flatnonzero((chars == ord("|")) | (chars == ord("\n")))
+        fields = np.unique(np.searchsorted(delimiters, np.flatnonzero(chars == ord(","))))
+        starts = np.where(fields > 0, delimiters[np.maximum(fields - 1, 0)] + 1, 0)
+        data = np.insert(chars, np.concatenate([starts, delimiters[fields]]), ord('"')).tobytes()
+
+    # csv.writer ends every row with \r\n
+    return data.replace(b"|", b",").replace(b"\n", b"\r\n")
+
+
+def header_names(path: str) -> list[str]:
+    """
+    Returns the column names in the first line of a pipe delimited file.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return next(csv.reader(f, delimiter="|"), [])
+
+
+def convert_range(path: str,
+                  start: int,
+                  end: int,
+                  output_format: str,
+                  column_names: list[str] | None = None
+                  ) -> bytes | pa.Table | None:
+    """
+    Converts one byte range of the file at `path`.
+
+    Returns the csv encoded as utf-8, or for parquet a table of strings
+    (the first range skips the header line). Returns None if the range has
+    a quote or NUL, or for parquet a row with a different number of fields
+    than the header, then the whole file must be converted with the csv module.
+    """
+    data = read_range(path, start, end)
+    if b'"' in data or b"\0" in data:
+        return None
+
+    if output_format == "csv":
+        return convert_text(data)
+
+    ragged = []
+
+    def skip_ragged_row(row):
+        ragged.append(row.number)
+        return "skip"
+
+    table = pa_csv.read_csv(
+        io.BytesIO(data.decode("utf-8", errors="replace").encode("utf-8")),
+        read_options=pa_csv.ReadOptions(column_names=column_names, skip_rows=1 if start == 0 else 0),
+        parse_options=pa_csv.ParseOptions(delimiter="|", quote_char=False, double_quote=False,
+                                          escape_char=False, newlines_in_values=False,
+                                          invalid_row_handler=skip_ragged_row),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in column_names},
+            strings_can_be_null=False, quoted_strings_can_be_null=False),
+    )
+    return None if ragged else table
+
+
+def convert_file_with_csv_module(input_path: str, output_format: str = "csv", cache_dir: str | None = None) -> None:
+    """
+    Converts a whole file row by row with the csv module.
+    Used for files containing quotes, or for parquet rows with a different number of fields
+    than the header. Short rows are padded with empty strings, longer rows raise a ValueError.
+    """
+    with open(input_path, "r", encoding="utf-8", errors="replace") as txt_file:
+        reader = csv.reader(txt_file, delimiter="|")
+        if output_format == "csv":
+            with open(output_path(input_path, "csv"), "w", newline="", encoding="utf-8") as csv_file:
+                writer = csv.writer(csv_file, delimiter=",")
+                for row in reader:
+                    writer.writerow(row)
+            return
+
+        column_names = next(reader, [])
+        rows = []
+        for row in reader:
+            if len(row) > len(column_names):
+                raise ValueError('Row has more fields than the header', input_path, reader.line_num)
+            if row:
+                rows.append(row + [""] * (len(column_names) - len(row)))
+        table = pa.table({name: pa.array([row[idx] for row in rows], type=pa.string())
+                          for idx, name in enumerate(column_names)})
+        pq.write_table(table, output_path(input_path, "parquet", cache_dir))
+
+
+def convert_files(input_paths: list[str],
+                  output_format: str = "csv",
+                  workers: int | None = None,
+                  range_size: int = RANGE_SIZE,
+                  cache_dir: str | None = None
+                  ) -> list[str]:
+    """
+    Converts each pipe delimited file to csv or parquet next to it,
+    returns the paths of the converted files.
+
+    Parameters
+    ----------
+    `output_format` : "csv" or "parquet" (every column is stored as strings, with the
+        `dataset_cache` metadata of a cache of the csv read with `TEXT_CACHE_READ_CSV`
+        which is valid while the text file is unchanged)
+
+    `workers` : Number of processes (default the number of cpus)
+
+    `range_size` : Size in bytes of the part of a file each task converts
+
+    `cache_dir` : Directory of the parquet files (default next to the text files)
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError('Invalid output format', output_format)
+    if output_format == "parquet":
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # the metadata of an earlier cache is only rewritten once the file is converted
+        for path in input_paths:
+            metadata_path = output_path(path, "parquet", cache_dir) + ".json"
+            if os.path.exists(metadata_path):
+                os.remove(metadata_path)
+
+    column_names = [header_names(path) if output_format == "parquet" else None for path in input_paths]
+    tasks = [(idx, start, end) for idx, path in enumerate(input_paths)
+             for (start, end) in byte_ranges(path, range_size)]
+
+    outputs = dict()
+    fallback = []
+
+    def write_result(idx, result):
+        if idx in fallback:
+            return
+        if result is None:
+            # a quote was found, the file is converted again with the csv module
+            fallback.append(idx)
+            output = outputs.pop(idx, None)
+            if output is not None:
+                output.close()
+            return
+        if idx not in outputs:
+            if output_format == "csv":
+                outputs[idx] = open(output_path(input_paths[idx], "csv"), "wb")
+            else:
+                outputs[idx] = pq.ParquetWriter(
+                    output_path(input_paths[idx], "parquet", cache_dir), result.schema)
+        if output_format == "csv":
+            outputs[idx].write(result)
+        else:
+            outputs[idx].write_table(result)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # results are written in order, while a bounded number of ranges are converted ahead
+        pending = deque()
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        for idx, start, end in tasks:
+            pending.append((idx, executor.submit(
+                convert_range, input_paths[idx], start, end, output_format, column_names[idx])))
+            if len(pending) >= max_pending:
+                idx, future = pending.popleft()
+                write_result(idx, future.result())
+        while pending:
+            idx, future = pending.popleft()
+            write_result(idx, future.result())
+
+        for output in outputs.values():
+            output.close()
+
+        # files which are empty have no ranges
+        for idx, path in enumerate(input_paths):
+            if idx not in outputs and idx not in fallback:
+                if output_format == "csv":
+                    open(output_path(path, "csv"), "wb").close()
+                else:
+                    fallback.append(idx)
+
+        for future in [executor.submit(
+                convert_file_with_csv_module, input_paths[idx], output_format, cache_dir)
+                       for idx in fallback]:
+            future.result()
+
+    if output_format == "parquet":
+        for path in input_paths:
+            write_cache_metadata(output_path(path, "parquet", cache_dir), file_fingerprint(path),
+                                 cache_options(**TEXT_CACHE_READ_CSV), path)
+
+    return [output_path(path, output_format, cache_dir) for path in input_paths]
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Convert pipe delimited text files to csv or parquet.")
+    parser.add_argument("directory", nargs="?", default="DP_GWDBQLD", help="directory of *.txt files")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--range-size", type=int, default=RANGE_SIZE, help="bytes per task")
+    parser.add_argument("--cache-dir", default=None, help="directory of the parquet files")
+    args = parser.parse_args(argv)
+
+    input_paths = sorted(glob.glob(os.path.join(args.directory, "*.txt")))
+    output_paths = convert_files(input_paths, args.format, args.workers, args.range_size, args.cache_dir)
+    for input_path, converted_path in zip(input_paths, output_paths):
+        print(f"{os.path.basename(input_path)} has been converted to {os.path.basename(converted_path)}.")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,25 +6,68 @@ import re
 import math
 import statistics as st
 import copy
+from functools import partial
 
-from cleaning_utils import pivot_dataset, transform_chemical_data
+from cleaning_utils import pivot_dataset, pivot_measurements, transform_chemical_data, transform_chemical_columns, map_chemicals
+from cleaning_utils import UnitTable, convert_units
+from cleaning_utils import UNIT_ALIASES, normalize_unit, factorize_units, normalize_units
+from cleaning_utils import create_missing_index, rows_with_missing_at_most
+from schema import PREFIX_DTYPE
+from amount_parsing import AMOUNT_PATTERN, BELOW_DETECTION_LIMIT, NUMBER, BELOW_LIMIT, LESS, parse_amount_strings
+from profiling import instrument_from_environment
 
 # These functions should be performed in the given order
+# pipeline.py can run them from a config file and report the time taken by each
 
-# Clean units formatting
-def clean_units(units):
+# Clean units formatting, other spellings in aliases are replaced by the unit used in the unit tables
+def clean_units(units, aliases = UNIT_ALIASES):
 
     if isinstance(units, list):
-        return ["".join(unit.strip().lower().split()) if isinstance(unit, str) else unit for unit in units]
+        return [normalize_unit(unit, aliases) if isinstance(unit, str) else unit for unit in units]
     elif isinstance(units, str):
-        return "".join(units.strip().lower().split())
+        return normalize_unit(units, aliases)
     else:
         return np.nan
 
-def clean_dataset_units (df, desired_chemical_names):
+# every UOM cell (and each unit in list cells) is cleaned at once, each distinct unit is only cleaned once
+def clean_dataset_units (df, desired_chemical_names, aliases = UNIT_ALIASES):
 
     units_index = list(itt.product(desired_chemical_names, ["UOM"]))
-    df[units_index] = df[units_index].applymap(clean_units)
+    cells = df[units_index].to_numpy(dtype=object)
+    is_list = pd.DataFrame(cells).map(type).eq(list).to_numpy()
+
+    cells[~is_list] = normalize_units(cells[~is_list], aliases)
+    if is_list.any():
+        lists = cells[is_list]
+        units = np.array(list(itt.chain.from_iterable(lists)), dtype=object)
+        # units in lists which are not strings are kept
+        is_str = pd.Series(units, dtype=object).map(type).eq(str).to_numpy()
+        units[is_str] = normalize_units(units[is_str], aliases)
+        splits = np.cumsum([len(units_list) for units_list in lists])[:-1]
+        cells[is_list] = pd.Series([units_list.tolist() for units_list in np.split(units, splits)], dtype=object).to_numpy()
+
+    df[units_index] = cells
+
+
+# the wide stages keep the compact dtypes (see schema.py) of the long dataset pivot_dataset was given:
+# float32 amounts and detection limits if the detection limits were float32, and categorical prefixes
+# if the raw amounts were categorical or strings (the same as format_long_amount).
+# Columns which still have list cells stay object until agg_dataset_measurement.
+def keep_chemical_dtypes (df, desired_chemical_names):
+
+    value_dtypes = df.attrs.get("value_dtypes", {})
+    float32 = value_dtypes.get("MinDetectLimit") == "float32" or value_dtypes.get("Amount") == "float32"
+    categorical = value_dtypes.get("Amount") in ("category", "string") or value_dtypes.get("Prefix") == "category"
+    dtypes = {"Amount": np.float32, "MinDetectLimit": np.float32} if float32 else dict()
+    if categorical:
+        dtypes["Prefix"] = PREFIX_DTYPE
+
+    for column in itt.product(desired_chemical_names, dtypes.keys()):
+        if column not in df.columns or df[column].dtype == dtypes[column[1]]:
+            continue
+        if df[column].dtype == object and df[column].map(type).eq(list).any():
+            continue
+        df[column] = df[column].astype(dtypes[column[1]])
 
 
 # This function should format a single amount value and output a float-prefix tuple.
@@ -69,12 +112,66 @@ def format_amount(erase_invalid: bool = False):
 
     return format_amount_func
 
-def format_dataset_amount (df, desired_chemical_names):
-
-    # apply formatting to every chemical and sort columns
-    for chemical_name in desired_chemical_names:
-        transform_chemical_data(df, chemical_name, format_amount(True),
-            ["Amount", "MinDetectLimit", "UOM"], ["Prefix", "Amount", "UOM"], split_lists=True)
+# Columnar version of format_amount. Parses whole columns of amounts at once and
+# returns (prefix, amount, uom) arrays matching format_amount applied to every cell.
+# strings are parsed by a compiled kernel if numba is installed, jit is True and there are
+# at least amount_parsing.JIT_MIN_STRINGS of them (see amount_parsing.py)
+def parse_amounts(amounts, min_detection_limits, uoms, erase_invalid: bool = False, jit: bool = True):
+
+    # missing arrow strings (see schema.py) are pd.NA, treat them like NaN
+    if isinstance(getattr(amounts, "dtype", None), pd.StringDtype):
+        amounts = amounts.to_numpy(dtype=object, na_value=np.nan)
+    amounts = pd.Series(np.asarray(amounts, dtype=object))
+    min_detection_limits = np.asarray(min_detection_limits, dtype=object)
+    uoms = np.array(uoms, dtype=object)
+
+    prefixes = np.full(len(amounts), np.nan, dtype=object)
+    values = np.full(len(amounts), np.nan)
+
+    # classify cells by type, checking each distinct type only once
+    types = amounts.map(type)
+    unique_types = types.unique()
+    is_str = types.isin([t for t in unique_types if issubclass(t, str)]).to_numpy()
+    is_num = types.isin([t for t in unique_types if issubclass(t, nb.Number)]).to_numpy()
+
+    # if amount is already number
+    prefixes[is_num] = "="
+    values[is_num] = amounts[is_num].astype(float).to_numpy()
+
+    # remove whitespace then match prefix-numerical form
+    parsed = parse_amount_strings(amounts[is_str].to_numpy(), jit)
+    matched = parsed.status == NUMBER
+    str_idx = np.flatnonzero(is_str)
+
+    idx = str_idx[matched]
+    prefixes[idx] = np.where(parsed.prefix_codes[matched] == LESS, "<", "=")
+    values[idx] = parsed.values[matched]
+
+    # if amount is below detection limit
+    bdl = parsed.status == BELOW_LIMIT
+    idx = str_idx[bdl]
+    no_limit = pd.Series(min_detection_limits[idx]).map(type).eq(type(None)).to_numpy()
+    prefixes[idx] = np.where(no_limit, "=", "<")
+    values[idx] = np.where(no_limit, 0, pd.to_numeric(
+        pd.Series(min_detection_limits[idx]), errors='coerce').to_numpy())
+
+    # otherwise amount is invalid
+    invalid = ~is_num
+    invalid[str_idx[matched | bdl]] = False
+    if invalid.any():
+        if not erase_invalid:
+            raise ValueError("Invalid Formatting - " + str(amounts[invalid].iloc[0]))
+        uoms[invalid] = np.nan
+
+    return (prefixes, values, uoms)
+
+# workers: number of chemicals to run in parallel (see cleaning_utils.map_chemicals)
+def format_dataset_amount (df, desired_chemical_names, erase_invalid = True, workers = 1):
+
+    # apply formatting to every chemical, list cells are exploded and parsed in one pass
+    transform_chemical_columns(df, desired_chemical_names, partial(parse_amounts, erase_invalid=erase_invalid),
+        ["Amount", "MinDetectLimit", "UOM"], ["Prefix", "Amount", "UOM"], workers=workers)
+    keep_chemical_dtypes(df, desired_chemical_names)
     df = df.sort_index(axis=1)
 
 
@@ -97,12 +194,35 @@ def standardise_units(units_dict, erase_invalid = False):
         return (amount, min_detection_limit, prefix, uom)
     return standardise_units_func
 
-def standardise_dataset_unit (df, desired_chemical_names, convert_to_standard, erase_invalid = False):
+# Columnar version of standardise_units using a UnitTable.
+# Converts whole columns at once, unknown units are masked rather than checked per cell.
+def standardise_unit_columns(unit_table, erase_invalid = False):
 
-    for chemical_name in desired_chemical_names:
-        transform_chemical_data(df, chemical_name, standardise_units(convert_to_standard, erase_invalid),
-                                ["Amount", "MinDetectLimit", "Prefix", "UOM"], ["Amount", "MinDetectLimit", "Prefix", "UOM"], split_lists=True)
-        df.sort_index(axis=1, inplace=True)
+    return partial(standardise_unit_arrays, unit_table, erase_invalid)
+
+def standardise_unit_arrays(unit_table, erase_invalid, amounts, min_detection_limits, prefixes, uoms):
+
+    amounts, invalid = convert_units(unit_table, amounts, uoms)
+    min_detection_limits, _ = convert_units(unit_table, min_detection_limits, uoms)
+
+    unknown = invalid & pd.notna(uoms)
+    if unknown.any() and not erase_invalid:
+        raise ValueError('Invalid units', uoms[unknown][0])
+
+    prefixes = np.where(invalid, np.nan, prefixes)
+    uoms = np.where(invalid, np.nan, uoms)
+    return (amounts, min_detection_limits, prefixes, uoms)
+
+def standardise_dataset_unit (df, desired_chemical_names, convert_to_standard, erase_invalid = False, workers = 1):
+
+    if isinstance(convert_to_standard, UnitTable):
+        transform_chemical_columns(df, desired_chemical_names, standardise_unit_columns(convert_to_standard, erase_invalid),
+                                   ["Amount", "MinDetectLimit", "Prefix", "UOM"], ["Amount", "MinDetectLimit", "Prefix", "UOM"], workers=workers)
+    else:
+        transform_chemical_data(df, desired_chemical_names, standardise_units(convert_to_standard, erase_invalid),
+                                ["Amount", "MinDetectLimit", "Prefix", "UOM"], ["Amount", "MinDetectLimit", "Prefix", "UOM"], split_lists=True, workers=workers)
+    keep_chemical_dtypes(df, desired_chemical_names)
+    df.sort_index(axis=1, inplace=True)
 
 # drop units and MinDetectLimit columns
 
@@ -139,27 +259,49 @@ def agg_measurement(amount, prefix):
         return (st.mean(amount), "=")
 
 
-def agg_dataset_measurement (df, desired_chemical_names):
+# vectorized version of agg_measurement for a chemical's columns, list cells
+# are exploded and aggregated with a groupby, single measurements keep their prefix
+def agg_measurement_columns(policy, amounts, prefixes):
 
-    for chemical_name in desired_chemical_names:
-        transform_chemical_data(df, chemical_name, agg_measurement,
-            ["Amount", "Prefix"], ["Amount", "Prefix"])
+    cells = pd.DataFrame({"Amount": amounts, "Prefix": prefixes})
+    is_list = cells["Amount"].map(type).eq(list)
+    if ((~is_list & cells["Prefix"].map(type).eq(list)).any()):
+        raise TypeError(prefixes)
+    missing = ~is_list & cells["Amount"].isna()
+
+    exploded = cells[~missing].explode(["Amount", "Prefix"])
+    exploded["Row"] = exploded.index
+    aggregated = agg_long_measurement(exploded, ["Row"], policy).set_index("Row").reindex(cells.index)
+
+    aggregated["Prefix"] = aggregated["Prefix"].where(is_list | missing, cells["Prefix"])
+    return (aggregated["Amount"].to_numpy(), aggregated["Prefix"].to_numpy(dtype=object))
+
+def agg_dataset_measurement (df, desired_chemical_names, workers = 1, policy = "default"):
+
+    results = map_chemicals(partial(agg_measurement_columns, policy),
+        [[df[(chemical_name, "Amount")].to_numpy(), df[(chemical_name, "Prefix")].to_numpy()]
+         for chemical_name in desired_chemical_names], workers=workers)
+
+    for chemical_name, (amounts, prefixes) in zip(desired_chemical_names, results):
+        df[(chemical_name, "Amount")] = amounts
+        df[(chemical_name, "Prefix")] = prefixes
+    keep_chemical_dtypes(df, desired_chemical_names)
 
 # count NaNs in a row
 def count_nas(row):
     return row.isna().sum()
 
 # remove rows with more NaNs than a threshold
-def filter_rows_by_nas (df, desired_chemical_names, na_threshold):
+# a missing_index from create_missing_index can be passed when filtering at several thresholds
+def filter_rows_by_nas (df, desired_chemical_names, na_threshold, missing_index = None):
 
-    df = df.reindex(sorted(df.columns), axis=1)
-    amounts_index = list(itt.product(desired_chemical_names, ["Amount"]))
-    mask = df[amounts_index].apply(count_nas, axis=1)
-    mask = mask[mask <= na_threshold].index
+    if missing_index is None:
+        missing_index = create_missing_index(df, desired_chemical_names)
+    mask = rows_with_missing_at_most(missing_index, na_threshold)
 
+    df = df.reindex(sorted(df.columns), axis=1)
     df = df.loc[mask]
-    df.reset_index(inplace=True)
-    df.drop(['index'], axis=1, inplace=True)
+    df.reset_index(drop=True, inplace=True)
     return df
 
 
@@ -190,7 +332,182 @@ def fill_dataset_nans (df, desired_chemical_names, amount_avgs, missing_chemical
 
     # fill NaN values with averages
     for chemical_name in desired_chemical_names:
-        transform_chemical_data(df, chemical_name, lambda a, p: (amount_avgs[chemical_name], '=') if math.isnan(a) else (a, p),
-                                ["Amount", "Prefix"], ["Amount", "Prefix"])
+        amounts = df[chemical_name, "Amount"]
+        prefixes = df[chemical_name, "Prefix"]
+        missing = amounts.isna()
+        if amounts.dtype != np.float32:
+            amounts = amounts.astype(float)
+        if not isinstance(prefixes.dtype, pd.CategoricalDtype):
+            prefixes = prefixes.astype(object)
+        df[chemical_name, "Amount"] = amounts.mask(missing, amount_avgs[chemical_name])
+        df[chemical_name, "Prefix"] = prefixes.mask(missing, "=")
+
+
+# Long format pipeline.
+# These stages work on the dataset before pivoting, where each row is a single
+# measurement. No list cells are created and the dataset is only pivoted once at the end.
+
+# categorical (see schema.py) and float32 columns keep their dtype through the long format stages
+def keep_dtype (df, column, values):
+
+    dtype = df[column].dtype
+    if isinstance(dtype, pd.CategoricalDtype) or dtype == np.float32:
+        values = pd.Series(values, index=df.index).astype(dtype)
+    df[column] = values
+
+# each distinct unit is cleaned once, units which become the same are merged
+def clean_long_units (df, uom_column = "UOM", aliases = UNIT_ALIASES):
+
+    if isinstance(df[uom_column].dtype, pd.CategoricalDtype):
+        codes, cleaned_units = factorize_units(df[uom_column], aliases)
+        df[uom_column] = pd.Categorical.from_codes(codes, categories=cleaned_units)
+        return
+
+    df[uom_column] = normalize_units(df[uom_column], aliases)
+
+def format_long_amount (df, erase_invalid = True):
+
+    (prefixes, amounts, uoms) = parse_amounts(
+        df["Amount"], df["MinDetectLimit"], df["UOM"], erase_invalid)
+
+    # raw amounts loaded with a schema (categorical or arrow strings) give categorical prefixes,
+    # amounts are parsed into the precision of the detection limits
+    if isinstance(df["Amount"].dtype, (pd.CategoricalDtype, pd.StringDtype)):
+        prefixes = pd.Categorical(prefixes, dtype=PREFIX_DTYPE)
+    if df["MinDetectLimit"].dtype == np.float32:
+        amounts = amounts.astype(np.float32)
+    df["Prefix"] = prefixes
+    df["Amount"] = amounts
+    keep_dtype(df, "UOM", uoms)
+
+def standardise_long_unit (df, convert_to_standard, erase_invalid = False):
+
+    if isinstance(convert_to_standard, UnitTable):
+        columns = ["Amount", "MinDetectLimit", "Prefix", "UOM"]
+        keep_dtype(df, "MinDetectLimit", pd.to_numeric(df["MinDetectLimit"], errors='coerce'))
+        standardised = standardise_unit_columns(convert_to_standard, erase_invalid)(
+            *[df[i].to_numpy(dtype=object if i in ["Prefix", "UOM"] else None) for i in columns])
+        for column, values in zip(columns, standardised):
+            keep_dtype(df, column, values)
+        return
+
+    amounts = df["Amount"].to_numpy(dtype=float, copy=True)
+    min_detection_limits = pd.to_numeric(df["MinDetectLimit"], errors='coerce').to_numpy(dtype=float, copy=True)
+    invalid = df["UOM"].isna().to_numpy()
+
+    # apply each conversion to every measurement with that unit at once
+    codes, units = pd.factorize(df["UOM"])
+    for code, uom in enumerate(units):
+        rows = codes == code
+        if not (uom in convert_to_standard.keys()):
+            if not erase_invalid:
+                raise ValueError('Invalid units', uom)
+            invalid |= rows
+            continue
+        amounts[rows] = convert_to_standard[uom](amounts[rows])
+        min_detection_limits[rows] = convert_to_standard[uom](min_detection_limits[rows])
+
+    amounts[invalid] = np.nan
+    min_detection_limits[invalid] = np.nan
+    keep_dtype(df, "Amount", amounts)
+    keep_dtype(df, "MinDetectLimit", min_detection_limits)
+    df["Prefix"] = df["Prefix"].mask(invalid)
+    df["UOM"] = df["UOM"].mask(invalid)
+
+# aggregate repeated measurements of a chemical within a sample
+# policies for measurements below the detection limit ("<"):
+#   "default": min if every prefix is "<", otherwise the mean of all measurements
+#   "max_dl": max if every prefix is "<" (most conservative limit), otherwise the mean
+#   "half_dl": "<" measurements are substituted by half their detection limit, then the mean
+#   "detected": the mean of only the detected measurements, min if every prefix is "<"
+# the amount is NaN if any measurement is NaN
+# partial aggregates of separate parts of the dataset can be merged before they are finished
+AGG_POLICIES = ["default", "max_dl", "half_dl", "detected"]
+PARTIAL_MEASUREMENT_AGGS = {
+    "Sum": "sum", "Count": "sum", "Min": "min", "Max": "max", "HasNaN": "any", "AllBelow": "all",
+    "BelowSum": "sum", "BelowCount": "sum", "DetectedSum": "sum", "DetectedCount": "sum",
+}
+
+def partial_agg_long_measurement (df, group_columns):
+
+    amounts = df["Amount"].astype(float)
+    below = df["Prefix"].eq("<")
+    partial = pd.DataFrame({
+        "Sum": amounts,
+        "Count": amounts.notna().astype(np.int64),
+        "Min": amounts,
+        "Max": amounts,
+        "HasNaN": amounts.isna(),
+        "AllBelow": below,
+        "BelowSum": amounts.where(below),
+        "BelowCount": (amounts.notna() & below).astype(np.int64),
+        "DetectedSum": amounts.mask(below),
+        "DetectedCount": (amounts.notna() & ~below).astype(np.int64),
+    })
+    return partial.groupby([df[i] for i in group_columns], observed=True).agg(PARTIAL_MEASUREMENT_AGGS)
+
+def merge_partial_measurements (partials):
+
+    partial = pd.concat(partials)
+    return partial.groupby(level=list(range(partial.index.nlevels)), observed=True).agg(PARTIAL_MEASUREMENT_AGGS)
+
+def finish_agg_long_measurement (partial, policy = "default"):
+
+    all_below = partial["AllBelow"]
+    if policy == "default":
+        aggregated = (partial["Sum"] / partial["Count"]).where(~all_below, partial["Min"])
+    elif policy == "max_dl":
+        aggregated = (partial["Sum"] / partial["Count"]).where(~all_below, partial["Max"])
+    elif policy == "half_dl":
+        aggregated = (partial["DetectedSum"] + partial["BelowSum"] / 2) / partial["Count"]
+    elif policy == "detected":
+        aggregated = (partial["DetectedSum"] / partial["DetectedCount"]).where(~all_below, partial["Min"])
+    else:
+        raise ValueError('Invalid aggregation policy', policy)
+
+    return pd.DataFrame({
+        "Amount": aggregated.mask(partial["HasNaN"]),
+        "Prefix": np.where(all_below, "<", "="),
+    }).reset_index()
+
+def agg_long_measurement (df, group_columns, policy = "default"):
+
+    aggregated = finish_agg_long_measurement(partial_agg_long_measurement(df, group_columns), policy)
+    if isinstance(df["Prefix"].dtype, pd.CategoricalDtype):
+        aggregated["Prefix"] = aggregated["Prefix"].astype(PREFIX_DTYPE)
+    if df["Amount"].dtype == np.float32:
+        aggregated["Amount"] = aggregated["Amount"].astype(np.float32)
+    return aggregated
+
+def clean_long_measurements (df, sample_id_columns, per_sample_data, chemical_name_column,
+                             desired_chemical_names, convert_to_standard, erase_invalid = True):
+
+    df = df.loc[df[chemical_name_column].isin(desired_chemical_names),
+                [*sample_id_columns, *per_sample_data, chemical_name_column, "Amount", "UOM", "MinDetectLimit"]].copy()
+    if isinstance(df[chemical_name_column].dtype, pd.CategoricalDtype):
+        df[chemical_name_column] = df[chemical_name_column].cat.remove_unused_categories()
+
+    clean_long_units(df)
+    format_long_amount(df, erase_invalid)
+    standardise_long_unit(df, convert_to_standard, erase_invalid)
+    return df
+
+def clean_long_dataset (df, sample_id_columns, per_sample_data, chemical_name_column,
+                        desired_chemical_names, convert_to_standard, erase_invalid = True,
+                        policy = "default"):
+
+    df = clean_long_measurements(df, sample_id_columns, per_sample_data, chemical_name_column,
+                                 desired_chemical_names, convert_to_standard, erase_invalid)
+    df = agg_long_measurement(df, [*sample_id_columns, *per_sample_data, chemical_name_column], policy)
+
+    return pivot_measurements(
+        df,
+        sample_id_columns=sample_id_columns,
+        per_sample_data=per_sample_data,
+        chemical_name_column=chemical_name_column,
+        values_per_chemical=["Amount", "Prefix"],
+    )
 
 
+# profiles the functions above if the CLEANING_PROFILE variable is set, see profiling.py
+instrument_from_environment(__name__)
@@ -0,0 +1,217 @@
+import os
+import ast
+import json
+import hashlib
+
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+
+
+# : `dataset_cache.py` caches csv datasets as parquet files, so later reads only
+# : load the columns (and rows) which are needed rather than the whole dataset.
+
+
+def file_fingerprint(path: str, check_hash: bool = False) -> dict:
+    """
+    Returns the size and modification time of the file at `path`,
+    and the sha256 hash of its contents if `check_hash` is true.
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if check_hash:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        fingerprint["sha256"] = sha256.hexdigest()
+    return fingerprint
+
+
+def cache_path(csv_path: str, cache_dir: str | None = None) -> str:
+    """
+    Returns the path of the parquet file caching the csv file at `csv_path`.
+    By default the cache is stored next to the csv file.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(csv_path)
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, name + ".parquet")
+
+
+def cache_options(sort_by: list[str] | None = None, **read_csv_kwargs) -> dict:
+    """
+    Returns the options a cache is built with, which are stored in its metadata.
+    """
+    return {"sort_by": sort_by, "read_csv": repr(sorted(read_csv_kwargs.items()))}
+
+
+def is_cache_valid(csv_path: str,
+                   parquet_path: str,
+                   options: dict,
+                   check_hash: bool = False
+                   ) -> bool:
+    """
+    Checks the metadata stored next to the cache against the csv file.
+    The cache is invalid if the size or modification time of the
+    csv file has changed, or the `options` used to build it are different.
+
+    If the cache was written from another file (eg by `convert_text_csv`) that file
+    is checked instead, see `write_cache_metadata`.
+
+    If `check_hash` is true and only the modification time has changed, the contents
+    of the csv file are hashed and a cache whose csv file was only touched is kept
+    (its metadata is updated). The file is not hashed when its size and modification
+    time are unchanged, or its size has changed.
+    """
+    if not (os.path.exists(parquet_path) and os.path.exists(parquet_path + ".json")):
+        return False
+    with open(parquet_path + ".json", "r") as f:
+        metadata = json.load(f)
+    if metadata["options"] != options:
+        return False
+
+    source_path = metadata.get("source_path")
+    if source_path is not None:
+        csv_path = os.path.join(os.path.dirname(parquet_path), source_path)
+        if not os.path.exists(csv_path):
+            return False
+
+    fingerprint = file_fingerprint(csv_path)
+    if fingerprint["size"] != metadata["source"]["size"]:
+        return False
+    if fingerprint["mtime_ns"] == metadata["source"]["mtime_ns"]:
+        return True
+    # only the modification time changed, the contents are hashed if requested
+    if not check_hash or "sha256" not in metadata["source"]:
+        return False
+
+    fingerprint = file_fingerprint(csv_path, check_hash=True)
+    if fingerprint["sha256"] != metadata["source"]["sha256"]:
+        return False
+    write_cache_metadata(parquet_path, fingerprint, options, None if source_path is None else csv_path)
+    return True
+
+
+def write_cache_metadata(parquet_path: str, fingerprint: dict, options: dict, source_path: str | None = None) -> None:
+    """
+    Stores the fingerprint of the csv file and the build options next to the cache.
+
+    `source_path` : The file the cache was written from if it is not the csv file
+        (eg the text file the csv is converted from), its `fingerprint` is stored
+        and it is checked by `is_cache_valid` instead of the csv file.
+    """
+    metadata = {"source": fingerprint, "options": options}
+    if source_path is not None:
+        # relative to the cache, so the directories may be moved together
+        metadata["source_path"] = os.path.relpath(source_path, os.path.dirname(parquet_path) or ".")
+    with open(parquet_path + ".json", "w") as f:
+        json.dump(metadata, f, indent=4)
+
+
+def build_cache(csv_path: str,
+                parquet_path: str,
+                *,
+                check_hash: bool = False,
+                sort_by: list[str] | None = None,
+                **read_csv_kwargs
+                ) -> None:
+    """
+    Reads the csv file and writes it to `parquet_path`.
+
+    `sort_by` : Columns to sort the rows by before writing. Sorting by a column
+        which is usually filtered on (eg the chemical name) groups equal values
+        into the same row groups, so filters on it can skip most of the file.
+    """
+    options = cache_options(sort_by, **read_csv_kwargs)
+    fingerprint = file_fingerprint(csv_path, check_hash)
+
+    read_csv_kwargs.setdefault("low_memory", False)
+    df = pd.read_csv(csv_path, **read_csv_kwargs)
+    if sort_by is not None:
+        df = df.sort_values(sort_by, kind="stable", ignore_index=True)
+
+    os.makedirs(os.path.dirname(parquet_path) or ".", exist_ok=True)
+    df.to_parquet(parquet_path, index=False, row_group_size=100000)
+    write_cache_metadata(parquet_path, fingerprint, options)
+
+
+def cached_read_csv(csv_path: str,
+                    columns: list[str] | None = None,
+                    filters: list[tuple] | None = None,
+                    *,
+                    cache_dir: str | None = None,
+                    check_hash: bool = False,
+                    sort_by: list[str] | None = None,
+                    **read_csv_kwargs
+                    ) -> pd.DataFrame:
+    """
+    Reads the csv file at `csv_path` through a parquet cache.
+    The cache is (re)built when it is missing or the csv file has changed.
+
+    Parameters
+    ----------
+    `columns` : Only these columns are loaded from the cache (default all).
+
+    `filters` : Row filters which are pushed down to the parquet reader
+        eg [("gm_chemical_name", "in", ["Calcium", "Chloride"])]
+
+    `cache_dir` : Directory to store the cache in (default next to the csv).
+
+    `check_hash` : Also detect changes by hashing the contents of the csv file.
+
+    `sort_by` : See `build_cache`.
+
+    Any other keyword arguments are passed to `pd.read_csv` when building the cache.
+    """
+    parquet_path = cache_path(csv_path, cache_dir)
+    options = cache_options(sort_by, **read_csv_kwargs)
+
+    if not is_cache_valid(csv_path, parquet_path, options, check_hash):
+        build_cache(csv_path, parquet_path, check_hash=check_hash,
+                    sort_by=sort_by, **read_csv_kwargs)
+
+    return restore_missing(pd.read_parquet(parquet_path, columns=columns, filters=filters))
+
+
+def restore_missing(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Missing strings are read back from parquet as None,
+    replaces them with NaN like `pd.read_csv` and the cleaning stages use.
+    """
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+
+
+def write_cleaned_dataset(df: pd.DataFrame, parquet_path: str) -> None:
+    """
+    Writes a cleaned (pivoted) dataset to `parquet_path`.
+    """
+    df.to_parquet(parquet_path, index=False)
+
+
+def read_cleaned_dataset(parquet_path: str,
+                         chemical_names: list[str] | None = None,
+                         other_columns: list[str] | None = None
+                         ) -> pd.DataFrame:
+    """
+    Reads a cleaned dataset written by `write_cleaned_dataset`,
+    loading only the columns of the given `chemical_names` and `other_columns`
+    (eg ["SampleID"]). By default all columns are loaded.
+    """
+    # multiindex columns are stored with their tuple as the name
+    names = {name: ast.literal_eval(name) if name.startswith("(") else name
+             for name in pq.read_schema(parquet_path).names}
+
+    columns = None
+    if chemical_names is not None or other_columns is not None:
+        keep = set(chemical_names or []).union(other_columns or [])
+        columns = [name for name, column in names.items()
+                   if (column[0] if isinstance(column, tuple) else column) in keep]
+
+    df = pd.read_parquet(parquet_path, columns=columns)
+    if not isinstance(df.columns, pd.MultiIndex) and any(
+            isinstance(names[name], tuple) for name in df.columns):
+        df.columns = pd.MultiIndex.from_tuples([names[name] for name in df.columns])
+    return restore_missing(df)
@@ -0,0 +1,302 @@
+import os
+import math
+import shutil
+import weakref
+import tempfile
+import warnings
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+
+# : `dedup.py` drops duplicate rows while streaming through chunks of any number of files
+# : (eg the overlapping parts of the DDW export, see `stream_cleaning.iter_dataset_chunks`). Each row is hashed into a 64 bit fingerprint
+# : and only the fingerprints of the rows already seen are kept, in sorted arrays or, once
+# : there are more than `max_exact` of them, in sorted files behind a Bloom filter of bounded size.
+
+
+# the hash of a missing cell
+MISSING_HASH = np.uint64(0x9e3779b97f4a7c15)
+
+
+def cell_hashes(values: pd.Series) -> np.ndarray:
+    """
+    Hashes each cell of a column the same way whichever dtype the column was read with.
+    Numbers, and strings which `pd.read_csv` would read as numbers, are hashed as
+    their float value (eg 3, 3.0 and "3" are the same), other values as their string.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # each category is only hashed once
+        categories = cell_hashes(pd.Series(values.cat.categories))
+        codes = values.cat.codes.to_numpy()
+        return np.where(codes >= 0, categories[codes], MISSING_HASH)
+
+    hashes = np.full(len(values), MISSING_HASH, dtype=np.uint64)
+    missing = values.isna().to_numpy()
+    if pd.api.types.is_numeric_dtype(values):
+        hashes[~missing] = pd.util.hash_array(values.to_numpy(dtype=float)[~missing])
+        return hashes
+
+    # each distinct value is only parsed and hashed once
+    (codes, uniques) = pd.factorize(values.to_numpy(dtype=object))
+    uniques = pd.Series(uniques, dtype=object)
+    if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+        numbers = pd.to_numeric(uniques, errors="coerce").to_numpy(dtype=float)
+    else:
+        numbers = np.full(len(uniques), np.nan)
+    is_number = ~np.isnan(numbers)
+    unique_hashes = np.empty(len(uniques), dtype=np.uint64)
+    unique_hashes[is_number] = pd.util.hash_array(numbers[is_number])
+    unique_hashes[~is_number] = pd.util.hash_array(uniques[~is_number].astype(str).to_numpy(dtype=object))
+    hashes[~missing] = unique_hashes[codes[~missing]]
+    return hashes
+
+
+def row_fingerprints(df: pd.DataFrame, columns: list[str] | None = None) -> np.ndarray:
+    """
+    Hashes the `columns` (default all) of each row to a 64 bit fingerprint.
+
+    Cells are hashed by `cell_hashes`, so the same row has the same fingerprint
+    whichever dtype `pd.read_csv` inferred for its chunk (eg an Amount column is
+    float in a chunk of numbers, but object in a chunk which also has "<0.1").
+    """
+    df = df if columns is None else df[columns]
+    hashes = pd.DataFrame({idx: cell_hashes(df.iloc[:, idx]) for idx in range(df.shape[1])})
+    return pd.util.hash_pandas_object(hashes, index=False).to_numpy(dtype=np.uint64)
+
+
+def mix_fingerprints(fingerprints: np.ndarray) -> np.ndarray:
+    """
+    A second hash of the fingerprints (the splitmix64 finalizer), for the Bloom filter.
+    """
+    with np.errstate(over="ignore"):
+        mixed = fingerprints ^ (fingerprints >> np.uint64(30))
+        mixed = mixed * np.uint64(0xbf58476d1ce4e5b9)
+        mixed = mixed ^ (mixed >> np.uint64(27))
+        mixed = mixed * np.uint64(0x94d049bb133111eb)
+        return mixed ^ (mixed >> np.uint64(31))
+
+
+# fingerprints are added to and looked up in a Bloom filter this many at a time,
+# so the bit positions of a batch take at most 8 * n_hashes * BLOOM_BATCH_SIZE bytes
+BLOOM_BATCH_SIZE = 65536
+
+
+def bloom_capacity(n_bytes: int, false_positive_rate: float = 1e-6) -> int:
+    """
+    The most fingerprints a Bloom filter of `n_bytes` holds with `false_positive_rate`.
+    """
+    return max(1, math.floor(8 * n_bytes * math.log(2) ** 2 / -math.log(false_positive_rate)))
+
+
+class BloomFilter:
+    """
+    Set of fingerprints in a fixed number of bits. Fingerprints which were added
+    are always found, others are wrongly found with probability `false_positive_rate`
+    (while at most `capacity` fingerprints have been added).
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 1e-6):
+        self.n_bits = max(64, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+
+    def positions(self, fingerprints: np.ndarray) -> np.ndarray:
+        # double hashing, bit i of a fingerprint is h1 + i * h2
+        steps = np.arange(self.n_hashes, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            hashes = np.multiply.outer(mix_fingerprints(fingerprints) | np.uint64(1), steps)
+            hashes += fingerprints[:, None]
+        hashes %= np.uint64(self.n_bits)
+        return hashes
+
+    def contains(self, fingerprints: np.ndarray) -> np.ndarray:
+        """
+        Returns whether each fingerprint may have been added.
+        """
+        found = np.empty(len(fingerprints), dtype=bool)
+        for start in range(0, len(fingerprints), BLOOM_BATCH_SIZE):
+            positions = self.positions(fingerprints[start:start + BLOOM_BATCH_SIZE])
+            bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+            found[start:start + BLOOM_BATCH_SIZE] = bits.all(axis=1)
+        return found
+
+    def add(self, fingerprints: np.ndarray) -> None:
+        for start in range(0, len(fingerprints), BLOOM_BATCH_SIZE):
+            positions = self.positions(fingerprints[start:start + BLOOM_BATCH_SIZE]).ravel()
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+
+class DuplicateFilter:
+    """
+    Remembers the rows seen in earlier chunks (by `row_fingerprints`), so duplicates
+    can be dropped from a stream of chunks without holding the chunks in memory.
+
+    Fingerprints are kept exactly in sorted arrays (8 bytes per distinct row). Once
+    there are more than `max_exact` of them in memory they are spilled to sorted files
+    in `spill_dir`, and every fingerprint is also added to a `BloomFilter` sized for
+    `capacity` rows. Fingerprints which the Bloom filter may have seen are then looked
+    up in the spilled files, so no row is dropped unless it is a duplicate; its false
+    positives only cost a lookup (counted in `report`).
+
+    Parameters
+    ----------
+    `columns` : The key columns which identify a row (default all columns)
+
+    `max_exact` : The most fingerprints which are kept in memory
+
+    `capacity` : The number of distinct rows the Bloom filter is sized for (default
+        the most which fit in the `8 * max_exact` bytes of the fingerprints in memory,
+        about 2.2 times `max_exact` at the default `false_positive_rate`). Beyond it
+        the false positive rate grows, and a warning is given.
+
+    `false_positive_rate` : Chance of a row which is not a duplicate being looked up
+        in the spilled files
+
+    `spill_dir` : Where the spilled fingerprints are stored, in a temporary directory
+        which is removed with the filter (default the system's temporary directory)
+    """
+
+    def __init__(self,
+                 columns: list[str] | None = None,
+                 max_exact: int = 50000000,
+                 capacity: int | None = None,
+                 false_positive_rate: float = 1e-6,
+                 spill_dir: str | None = None):
+        self.columns = columns
+        self.max_exact = max_exact
+        self.capacity = bloom_capacity(8 * max_exact, false_positive_rate) if capacity is None else capacity
+        self.false_positive_rate = false_positive_rate
+        self.spill_dir = spill_dir
+        self.spill_path: str | None = None
+        # sorted arrays of fingerprints, merged when a newer one is as large as the one before
+        self.runs: list[np.ndarray] = []
+        # sorted arrays of fingerprints memory mapped from the spilled files
+        self.spilled: list[np.ndarray] = []
+        self.bloom: BloomFilter | None = None
+        self.distinct = 0
+        self.rows = 0
+        self.duplicates = 0
+        self.false_positives = 0
+        self.over_capacity = False
+
+    @property
+    def exact(self) -> bool:
+        """
+        Whether all the fingerprints are in memory (no Bloom filter or spilled files).
+        """
+        return self.bloom is None
+
+    @staticmethod
+    def in_runs(runs: list[np.ndarray], fingerprints: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(fingerprints), dtype=bool)
+        for run in runs:
+            positions = np.minimum(np.searchsorted(run, fingerprints), len(run) - 1)
+            found |= run[positions] == fingerprints
+        return found
+
+    def seen(self, fingerprints: np.ndarray) -> np.ndarray:
+        """
+        Returns whether each fingerprint was in an earlier chunk.
+        """
+        if self.bloom is None:
+            return self.in_runs(self.runs, fingerprints)
+        # only the fingerprints the Bloom filter may have seen are looked up
+        found = self.bloom.contains(fingerprints)
+        candidates = np.flatnonzero(found)
+        # in order, so the spilled files are read in order
+        candidates = candidates[np.argsort(fingerprints[candidates])]
+        found[candidates] = self.in_runs(self.runs + self.spilled, fingerprints[candidates])
+        self.false_positives += len(candidates) - int(found[candidates].sum())
+        return found
+
+    def add(self, fingerprints: np.ndarray) -> None:
+        """
+        Remembers new (distinct, unseen) fingerprints.
+        """
+        if len(fingerprints) == 0:
+            return
+        self.distinct += len(fingerprints)
+        if self.bloom is not None:
+            self.bloom.add(fingerprints)
+        self.runs.append(np.sort(fingerprints))
+        while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            newest = self.runs.pop()
+            self.runs[-1] = np.sort(np.concatenate([self.runs[-1], newest]), kind="mergesort")
+        if sum(len(run) for run in self.runs) > self.max_exact:
+            if self.bloom is None:
+                self.bloom = BloomFilter(self.capacity, self.false_positive_rate)
+                for run in self.runs:
+                    self.bloom.add(run)
+            self.spill()
+        if self.bloom is not None and self.distinct > self.capacity and not self.over_capacity:
+            self.over_capacity = True
+            warnings.warn(f"More than {self.capacity} distinct rows, the DuplicateFilter's Bloom filter is "
+                          "over capacity so more of the rows are looked up in the spilled fingerprints")
+
+    def spill(self) -> None:
+        """
+        Moves the fingerprints in memory to sorted files, which are memory mapped.
+        """
+        if self.spill_path is None:
+            self.spill_path = tempfile.mkdtemp(prefix="dedup_", dir=self.spill_dir)
+            weakref.finalize(self, shutil.rmtree, self.spill_path, ignore_errors=True)
+        for run in self.runs:
+            path = os.path.join(self.spill_path, f"run_{len(self.spilled)}.npy")
+            np.save(path, run)
+            self.spilled.append(np.load(path, mmap_mode="r"))
+        self.runs = []
+
+    def new_mask(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Returns a boolean array, True for the rows of a chunk which were not in it
+        or in an earlier chunk, and remembers them.
+        """
+        fingerprints = row_fingerprints(df, self.columns)
+        # the first of each distinct row within the chunk
+        first = ~pd.Series(fingerprints).duplicated().to_numpy()
+        new = first.copy()
+        new[first] = ~self.seen(fingerprints[first])
+        self.add(fingerprints[new])
+        self.rows += len(df)
+        self.duplicates += len(df) - int(new.sum())
+        return new
+
+    def drop_duplicates(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drops the rows of a chunk which were already seen, see `new_mask`.
+        """
+        return df[self.new_mask(df)]
+
+    def report(self) -> dict:
+        """
+        Returns the number of rows, duplicates and distinct rows seen, whether all the
+        fingerprints are in memory, the memory used by the fingerprints (and the Bloom
+        filter), the size of the spilled fingerprints and the number of Bloom filter
+        false positives which were looked up in them.
+        """
+        return {
+            "rows": self.rows,
+            "duplicates": self.duplicates,
+            "distinct": self.distinct,
+            "exact": self.exact,
+            "fingerprint_bytes": sum(run.nbytes for run in self.runs) + (
+                0 if self.bloom is None else self.bloom.bits.nbytes),
+            "spilled_bytes": sum(run.nbytes for run in self.spilled),
+            "false_positives": self.false_positives,
+        }
+
+
+def drop_duplicate_chunks(chunks: Iterable[pd.DataFrame],
+                          duplicates: DuplicateFilter | None = None
+                          ) -> Iterator[pd.DataFrame]:
+    """
+    Yields each chunk without the rows seen in it or an earlier chunk.
+    Pass a `DuplicateFilter` to configure it and read its `report` afterwards.
+    """
+    duplicates = DuplicateFilter() if duplicates is None else duplicates
+    for chunk in chunks:
+        yield duplicates.drop_duplicates(chunk)
+
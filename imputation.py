@@ -0,0 +1,360 @@
+import json
+import math
+from typing import Iterable, Iterator, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+
+
+# : `imputation.py` fits the statistics used to fill missing amounts in a single pass
+# : over chunks of a pivoted dataset, so the whole dataset never has to be in memory.
+# : The statistics can be merged, saved and reused to fill later batches.
+
+
+# default number of values counted for the mode (see `reduce_value_counts`)
+MODE_COUNTERS = 1000
+
+
+class ChemicalStats(NamedTuple):
+    """
+    Mergeable summary of one chemical's (non NaN) amounts.
+
+    Quantiles are estimated from a sketch of logarithmic buckets
+    (as in DDSketch), `positive` and `negative` hold the number of values
+    in each bucket. Every estimate is within `relative_accuracy` of
+    the exact quantile.
+
+    The mode is estimated from `value_counts`, the approximate counts of
+    at most `mode_counters` values (a Misra-Gries summary). No count is
+    overestimated and each is at most `mode_count_error` below the exact
+    count, so every value more common than count / (mode_counters + 1) is kept.
+    """
+    count: int
+    total: float
+    zeros: int
+    positive: pd.Series
+    negative: pd.Series
+    value_counts: pd.Series
+    relative_accuracy: float
+    mode_counters: int = MODE_COUNTERS
+
+
+def bucket_gamma(relative_accuracy: float) -> float:
+    """
+    Returns the ratio between the bounds of each bucket of the sketch.
+    """
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+
+def reduce_value_counts(counts: pd.Series, mode_counters: int) -> pd.Series:
+    """
+    Keeps at most `mode_counters` of the `counts` (Misra-Gries). Every count is
+    reduced by the next largest count after the first `mode_counters`, and
+    the counts which are then 0 are dropped.
+    """
+    if len(counts) <= mode_counters:
+        return counts
+    kth = len(counts) - mode_counters - 1
+    counts = counts - np.partition(counts.to_numpy(), kth)[kth]
+    return counts[counts > 0]
+
+
+def chemical_stats(values: np.ndarray,
+                   relative_accuracy: float = 0.01,
+                   mode_counters: int = MODE_COUNTERS
+                   ) -> ChemicalStats:
+    """
+    Summarises an array of amounts, NaNs are ignored.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    log_gamma = math.log(bucket_gamma(relative_accuracy))
+
+    def bucket_counts(magnitudes):
+        keys = np.ceil(np.log(magnitudes) / log_gamma).astype(np.int64)
+        return pd.Series(keys).value_counts(sort=False).sort_index()
+
+    return ChemicalStats(
+        count=len(values),
+        total=float(values.sum()),
+        zeros=int((values == 0).sum()),
+        positive=bucket_counts(values[values > 0]),
+        negative=bucket_counts(-values[values < 0]),
+        value_counts=reduce_value_counts(pd.Series(values).value_counts(sort=False).sort_index(), mode_counters),
+        relative_accuracy=relative_accuracy,
+        mode_counters=mode_counters,
+    )
+
+
+def merge_chemical_stats(a: ChemicalStats, b: ChemicalStats) -> ChemicalStats:
+    """
+    Combines the summaries of two parts of the dataset.
+    """
+    if a.relative_accuracy != b.relative_accuracy:
+        raise ValueError('Sketches have different accuracies',
+                         a.relative_accuracy, b.relative_accuracy)
+    if a.mode_counters != b.mode_counters:
+        raise ValueError('Sketches have different numbers of mode counters',
+                         a.mode_counters, b.mode_counters)
+
+    def add(x, y):
+        return x.add(y, fill_value=0).astype(np.int64)
+
+    return ChemicalStats(
+        count=a.count + b.count,
+        total=a.total + b.total,
+        zeros=a.zeros + b.zeros,
+        positive=add(a.positive, b.positive),
+        negative=add(a.negative, b.negative),
+        value_counts=reduce_value_counts(add(a.value_counts, b.value_counts), a.mode_counters),
+        relative_accuracy=a.relative_accuracy,
+        mode_counters=a.mode_counters,
+    )
+
+
+def remove_chemical_stats(a: ChemicalStats, b: ChemicalStats) -> ChemicalStats:
+    """
+    Removes the summary `b` of a part of the dataset (eg samples which have
+    changed) from the summary `a` of a dataset which includes that part.
+
+    Values which `a` no longer counted for the mode can't be removed, so
+    afterwards the mode counts may also be overestimated, by at most the
+    `mode_count_error` of `b`.
+    """
+    if a.relative_accuracy != b.relative_accuracy:
+        raise ValueError('Sketches have different accuracies',
+                         a.relative_accuracy, b.relative_accuracy)
+    if a.mode_counters != b.mode_counters:
+        raise ValueError('Sketches have different numbers of mode counters',
+                         a.mode_counters, b.mode_counters)
+
+    def subtract(x, y, exact=True):
+        counts = x.subtract(y, fill_value=0).astype(np.int64)
+        if exact and (counts < 0).any():
+            raise ValueError('Removed values which were not in the summary')
+        return counts[counts > 0]
+
+    count = a.count - b.count
+    return ChemicalStats(
+        count=count,
+        # the total of an empty summary is exactly 0 rather than rounding error
+        total=a.total - b.total if count > 0 else 0.0,
+        zeros=a.zeros - b.zeros,
+        positive=subtract(a.positive, b.positive),
+        negative=subtract(a.negative, b.negative),
+        value_counts=subtract(a.value_counts, b.value_counts, exact=False),
+        relative_accuracy=a.relative_accuracy,
+        mode_counters=a.mode_counters,
+    )
+
+
+def partial_imputation_stats(df: pd.DataFrame,
+                             chem_names: list[str],
+                             value_name: str = "Amount",
+                             relative_accuracy: float = 0.01,
+                             mode_counters: int = MODE_COUNTERS
+                             ) -> dict[str, ChemicalStats]:
+    """
+    Summarises the `value_name` column of each chemical in one chunk of a pivoted dataset.
+    """
+    return {chem_name: chemical_stats(df[(chem_name, value_name)].to_numpy(dtype=float),
+                                      relative_accuracy, mode_counters)
+            for chem_name in chem_names}
+
+
+def merge_imputation_stats(a: dict[str, ChemicalStats],
+                           b: dict[str, ChemicalStats]
+                           ) -> dict[str, ChemicalStats]:
+    """
+    Merges the statistics of two parts of a dataset, chemicals which
+    are only in one part are kept as they are.
+    """
+    merged = dict(a)
+    for chem_name, stats in b.items():
+        merged[chem_name] = merge_chemical_stats(merged[chem_name], stats) \
+            if chem_name in merged else stats
+    return merged
+
+
+def remove_imputation_stats(a: dict[str, ChemicalStats],
+                            b: dict[str, ChemicalStats]
+                            ) -> dict[str, ChemicalStats]:
+    """
+    Removes the statistics of a part of a dataset from the statistics of
+    the whole dataset (see `remove_chemical_stats`).
+    """
+    removed = dict(a)
+    for chem_name, stats in b.items():
+        removed[chem_name] = remove_chemical_stats(removed[chem_name], stats)
+    return removed
+
+
+def fit_imputation_stats(chunks: Iterable[pd.DataFrame],
+                         chem_names: list[str],
+                         value_name: str = "Amount",
+                         relative_accuracy: float = 0.01,
+                         mode_counters: int = MODE_COUNTERS
+                         ) -> dict[str, ChemicalStats]:
+    """
+    Fits the statistics of each chemical in a single pass over `chunks`
+    of a pivoted dataset (eg the cleaned dataset split into batches of samples).
+    Only one chunk is held in memory at a time.
+
+    Parameters
+    ----------
+    `chunks` : Iterable of pivoted dataframes with the same chemicals
+
+    `chem_names` : The chemicals to summarise
+
+    `value_name` : The column of each chemical which is summarised
+
+    `relative_accuracy` : Accuracy of the approximate quantiles (eg the median).
+        Lower is more accurate but uses more buckets.
+
+    `mode_counters` : The number of values counted for the mode. The counts (and
+        the saved statistics) stay the same size however many distinct amounts
+        there are, each count is at most count / (mode_counters + 1) too low.
+    """
+    stats = {chem_name: chemical_stats([], relative_accuracy, mode_counters) for chem_name in chem_names}
+    for chunk in chunks:
+        stats = merge_imputation_stats(
+            stats, partial_imputation_stats(chunk, chem_names, value_name, relative_accuracy, mode_counters))
+    return stats
+
+
+def stats_quantile(stats: ChemicalStats, q: float) -> float:
+    """
+    Returns the approximate `q` quantile (0 to 1) of the chemical's amounts.
+    """
+    if stats.count == 0:
+        return np.nan
+    gamma = bucket_gamma(stats.relative_accuracy)
+
+    def bucket_values(keys):
+        return 2 * np.power(gamma, keys.to_numpy(dtype=float)) / (gamma + 1)
+
+    # buckets in ascending order of value
+    negative = stats.negative.sort_index(ascending=False)
+    positive = stats.positive.sort_index()
+    values = np.concatenate([-bucket_values(negative.index), [0.0], bucket_values(positive.index)])
+    counts = np.concatenate([negative.to_numpy(), [stats.zeros], positive.to_numpy()])
+
+    rank = q * (stats.count - 1)
+    return float(values[np.searchsorted(np.cumsum(counts), rank, side="right")])
+
+
+def mode_count_error(stats: ChemicalStats) -> float:
+    """
+    Returns the most that any count of `value_counts` is below the exact count.
+    """
+    return (stats.count - int(stats.value_counts.sum())) / (stats.mode_counters + 1)
+
+
+def stats_mode(stats: ChemicalStats) -> float:
+    """
+    Returns the most commonly counted amount, the smallest if several are equally common.
+    Its count is within `mode_count_error` of the count of the exact mode.
+    If no value is common enough to be counted, the approximate median is returned.
+    """
+    if stats.count == 0:
+        return np.nan
+    if len(stats.value_counts) == 0:
+        return stats_quantile(stats, 0.5)
+    return float(stats.value_counts.idxmax())
+
+
+def imputation_fill_values(stats: dict[str, ChemicalStats],
+                           method: str | float = "mean"
+                           ) -> tuple[dict[str, float], list[str]]:
+    """
+    Computes the value to fill each chemical's missing amounts with.
+
+    `method` : "mean", "median", "mode" or a quantile between 0 and 1.
+
+    Returns
+    ---------
+    A tuple of the fill values and the chemicals with no values,
+    the same as `data_cleaning.get_chemical_averages`
+    (can be passed to `data_cleaning.fill_dataset_nans`).
+    """
+    fill_values = dict()
+    for chem_name, chem_stats in stats.items():
+        if method == "mean":
+            fill_values[chem_name] = chem_stats.total / chem_stats.count \
+                if chem_stats.count > 0 else np.nan
+        elif method == "median":
+            fill_values[chem_name] = stats_quantile(chem_stats, 0.5)
+        elif method == "mode":
+            fill_values[chem_name] = stats_mode(chem_stats)
+        elif isinstance(method, float) and 0 <= method <= 1:
+            fill_values[chem_name] = stats_quantile(chem_stats, method)
+        else:
+            raise ValueError('Invalid imputation method', method)
+
+    missing_chemicals = [chem_name for chem_name, value in fill_values.items() if math.isnan(value)]
+    return (fill_values, missing_chemicals)
+
+
+def impute_chunks(chunks: Iterable[pd.DataFrame],
+                  chem_names: list[str],
+                  stats: dict[str, ChemicalStats],
+                  method: str | float = "mean"
+                  ) -> Iterator[pd.DataFrame]:
+    """
+    Second pass, fills the missing amounts of each chunk with the fitted `stats`
+    (see `data_cleaning.fill_dataset_nans`) and yields the filled chunks.
+    """
+    fill_values, missing_chemicals = imputation_fill_values(stats, method)
+    for chunk in chunks:
+        dc.fill_dataset_nans(chunk, chem_names, fill_values, missing_chemicals)
+        yield chunk
+
+
+def save_imputation_stats(stats: dict[str, ChemicalStats], path: str) -> None:
+    """
+    Saves fitted statistics as json so later batches can be filled without refitting.
+    """
+    def pairs(series):
+        return [list(pair) for pair in zip(series.index.tolist(), series.tolist())]
+
+    data = {chem_name: {
+        "count": chem_stats.count,
+        "total": chem_stats.total,
+        "zeros": chem_stats.zeros,
+        "positive": pairs(chem_stats.positive),
+        "negative": pairs(chem_stats.negative),
+        "value_counts": pairs(chem_stats.value_counts),
+        "relative_accuracy": chem_stats.relative_accuracy,
+        "mode_counters": chem_stats.mode_counters,
+    } for chem_name, chem_stats in stats.items()}
+
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def load_imputation_stats(path: str) -> dict[str, ChemicalStats]:
+    """
+    Loads statistics saved by `save_imputation_stats`.
+    """
+    def series(pairs, dtype):
+        if len(pairs) == 0:
+            return pd.Series([], index=pd.Index([], dtype=dtype), dtype=np.int64)
+        keys, counts = zip(*pairs)
+        return pd.Series(counts, index=pd.Index(keys, dtype=dtype), dtype=np.int64)
+
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    return {chem_name: ChemicalStats(
+        count=item["count"],
+        total=item["total"],
+        zeros=item["zeros"],
+        positive=series(item["positive"], np.int64),
+        negative=series(item["negative"], np.int64),
+        value_counts=series(item["value_counts"], float),
+        relative_accuracy=item["relative_accuracy"],
+        # statistics saved before the mode counts were bounded
+        mode_counters=item.get("mode_counters", MODE_COUNTERS),
+    ) for chem_name, item in data.items()}
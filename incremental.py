@@ -0,0 +1,365 @@
+import os
+import sys
+import json
+import argparse
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+from cleaning_utils import UnitTable
+from dataset_cache import write_cleaned_dataset, read_cleaned_dataset
+from imputation import ChemicalStats, chemical_stats, partial_imputation_stats, merge_imputation_stats
+from imputation import remove_imputation_stats, imputation_fill_values, save_imputation_stats, load_imputation_stats
+from pipeline import Pipeline, load_pipeline_config
+
+
+# : `incremental.py` keeps a cleaned dataset up to date with new exports (eg the monthly
+# : `ddw2020-present_*` files). The state directory holds the cleaned samples in parts,
+# : a content hash of every sample and the running statistics used for imputation.
+# : Only the samples which are new or changed in an export are cleaned, and only they
+# : are written (as a new part), so an update takes time in proportion to the changes.
+
+
+# files in the state directory
+HASHES_FILE = "hashes.parquet"
+STATS_FILE = "stats.json"
+STATE_FILE = "state.json"
+
+# the part of samples which were dropped by `filter_rows_by_nas`
+NO_PART = -1
+
+
+class IncrementalState(NamedTuple):
+    """
+    What is kept between updates, see `load_incremental_state`.
+
+    `hashes` has the sample id columns, the "Hash" of each sample's raw rows
+    and the "Part" file holding its cleaned row (`NO_PART` if it was filtered out).
+    `stats` are the statistics of the cleaned amounts of every kept sample.
+    `parts` are the file names of the parts, in the order they were written.
+    """
+    hashes: pd.DataFrame
+    stats: dict[str, ChemicalStats]
+    parts: list[str]
+
+
+class IncrementalUpdate(NamedTuple):
+    """
+    Result of `update_incremental`.
+
+    `delta` has the cleaned (and imputed) rows of the new and changed samples.
+    `replaced` has the sample ids of the earlier rows which are now out of date,
+    because their sample changed, was filtered out or was removed.
+    """
+    delta: pd.DataFrame
+    replaced: pd.DataFrame
+    new_samples: int
+    changed_samples: int
+    removed_samples: int
+
+
+def sample_hashes(df: pd.DataFrame,
+                  sample_id_columns: list[str],
+                  columns: list[str]
+                  ) -> pd.DataFrame:
+    """
+    Returns a 64 bit hash of the `columns` of each sample's rows.
+    The hash does not depend on the order of the rows, and values are hashed
+    as strings so it does not depend on the dtypes `pd.read_csv` inferred.
+    """
+    row_hashes = pd.util.hash_pandas_object(df[columns].astype(str), index=False).to_numpy()
+    codes, samples = pd.MultiIndex.from_frame(df[sample_id_columns]).factorize()
+    hashes = np.zeros(len(samples), dtype=np.uint64)
+    # the sum of the row hashes (wrapping around) is independent of the order
+    np.add.at(hashes, codes, row_hashes)
+    samples = samples.to_frame(index=False, name=sample_id_columns)
+    samples["Hash"] = hashes
+    return samples
+
+
+def empty_state(sample_id_columns: list[str]) -> IncrementalState:
+    hashes = pd.DataFrame({**{column: [] for column in sample_id_columns},
+                           "Hash": np.array([], dtype=np.uint64), "Part": np.array([], dtype=np.int64)})
+    return IncrementalState(hashes, dict(), [])
+
+
+def load_incremental_state(state_dir: str, sample_id_columns: list[str]) -> IncrementalState:
+    """
+    Loads the state written by `update_incremental`, or an empty state
+    if the directory has none.
+    """
+    if not os.path.exists(os.path.join(state_dir, STATE_FILE)):
+        return empty_state(sample_id_columns)
+    with open(os.path.join(state_dir, STATE_FILE), "r") as f:
+        parts = json.load(f)["parts"]
+    return IncrementalState(
+        pd.read_parquet(os.path.join(state_dir, HASHES_FILE)),
+        load_imputation_stats(os.path.join(state_dir, STATS_FILE)),
+        parts,
+    )
+
+
+def save_incremental_state(state_dir: str, state: IncrementalState) -> None:
+    """
+    Writes the hashes and statistics, then the list of parts.
+    Each file is replaced whole, so an interrupted update leaves the previous
+    list of parts (new part files which are not listed are ignored).
+    """
+    def replace(name, write):
+        path = os.path.join(state_dir, name)
+        write(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    replace(HASHES_FILE, lambda path: state.hashes.to_parquet(path, index=False))
+    replace(STATS_FILE, lambda path: save_imputation_stats(state.stats, path))
+
+    def write_parts(path):
+        with open(path, "w") as f:
+            json.dump({"parts": state.parts}, f, indent=4)
+    replace(STATE_FILE, write_parts)
+
+
+def next_part_name(parts: list[str]) -> str:
+    """
+    Part files are numbered in the order they are written, numbers are not
+    reused after `compact_incremental` so an old file is never overwritten.
+    """
+    number = max((int(name[len("part-"):-len(".parquet")]) for name in parts), default=-1) + 1
+    return f"part-{number:05d}.parquet"
+
+
+def add_missing_chemicals(df: pd.DataFrame, chem_names: list[str]) -> pd.DataFrame:
+    """
+    Adds NaN Amount and Prefix columns for chemicals which were not measured
+    in any of the samples, so every part has the same columns.
+    """
+    missing = [(chem_name, column) for chem_name in chem_names for column in ["Amount", "Prefix"]
+               if (chem_name, column) not in df.columns]
+    if len(missing) == 0:
+        return df
+    df = df.copy()
+    for chem_name, column in missing:
+        df[chem_name, column] = np.nan if column == "Amount" else pd.Series(np.nan, index=df.index, dtype=object)
+    return df
+
+
+def sample_keys(df: pd.DataFrame, sample_id_columns: list[str]) -> pd.MultiIndex:
+    """
+    Returns the sample ids of a long (flat columns) or pivoted (multiindex columns) dataset.
+    """
+    if isinstance(df.columns, pd.MultiIndex):
+        return pd.MultiIndex.from_arrays([df[column, ""].to_numpy() for column in sample_id_columns],
+                                         names=sample_id_columns)
+    return pd.MultiIndex.from_frame(df[sample_id_columns])
+
+
+def read_part_samples(state_dir: str,
+                      state: IncrementalState,
+                      samples: pd.DataFrame,
+                      sample_id_columns: list[str]
+                      ) -> pd.DataFrame:
+    """
+    Reads the current cleaned rows of `samples` (which have a "Part" column)
+    from their part files.
+    """
+    frames = []
+    for part in np.unique(samples["Part"]):
+        if part == NO_PART:
+            continue
+        df = read_cleaned_dataset(os.path.join(state_dir, state.parts[part]))
+        wanted = pd.MultiIndex.from_frame(samples.loc[samples["Part"] == part, sample_id_columns])
+        frames.append(df[sample_keys(df, sample_id_columns).isin(wanted)])
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def update_incremental(df: pd.DataFrame,
+                       state_dir: str,
+                       sample_id_columns: list[str],
+                       per_sample_data: list[str],
+                       chemical_name_column: str,
+                       desired_chemical_names: list[str],
+                       convert_to_standard: UnitTable,
+                       na_threshold: int,
+                       *,
+                       erase_invalid: bool = True,
+                       policy: str = "default",
+                       method: str | float = "mean",
+                       remove_missing: bool = False,
+                       relative_accuracy: float = 0.01
+                       ) -> IncrementalUpdate:
+    """
+    Updates the cleaned dataset in `state_dir` with a new long format export `df`.
+
+    Samples (identified by the `sample_id_columns`) whose rows hash the same
+    as in the previous export are skipped. The new and changed samples are
+    cleaned with `data_cleaning.clean_long_dataset` and filtered by
+    `data_cleaning.filter_rows_by_nas`. The statistics of the changed samples'
+    earlier rows are removed and those of their new rows added, then the new
+    rows are written as the next part.
+
+    Parameters
+    ----------
+    See `data_cleaning.clean_long_dataset` and `data_cleaning.filter_rows_by_nas`.
+
+    `method` : How the returned delta is imputed, see `imputation.imputation_fill_values`
+
+    `remove_missing` : Remove the samples which are not in `df`. Leave this false
+        if an export only covers recent samples (eg "2020-present").
+
+    `relative_accuracy` : See `imputation.fit_imputation_stats`
+
+    Returns
+    ---------
+    An `IncrementalUpdate`, rows of `delta` are imputed with the updated statistics.
+    Earlier rows keep the values they were filled with, use
+    `read_incremental_dataset` to impute the whole dataset with the latest statistics.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    state = load_incremental_state(state_dir, sample_id_columns)
+    stats = state.stats or {chem_name: chemical_stats([], relative_accuracy)
+                            for chem_name in desired_chemical_names}
+
+    df = df[df[chemical_name_column].isin(desired_chemical_names)]
+    hashes = sample_hashes(df, sample_id_columns, [*sample_id_columns, *per_sample_data, chemical_name_column,
+                                                   "Amount", "UOM", "MinDetectLimit"])
+
+    previous_keys = pd.MultiIndex.from_frame(state.hashes[sample_id_columns])
+    current_keys = pd.MultiIndex.from_frame(hashes[sample_id_columns])
+    is_new = ~current_keys.isin(previous_keys)
+    # position -1 (new samples) indexes the appended 0
+    previous_hash = np.append(state.hashes["Hash"].to_numpy(dtype=np.uint64), np.uint64(0))[
+        previous_keys.get_indexer(current_keys)]
+    is_changed = ~is_new & (previous_hash != hashes["Hash"].to_numpy())
+    is_updated = is_new | is_changed
+
+    # samples whose earlier rows are out of date
+    is_removed = ~previous_keys.isin(current_keys) if remove_missing else np.zeros(len(previous_keys), dtype=bool)
+    replaced = state.hashes[previous_keys.isin(current_keys[is_changed]) | is_removed]
+
+    old_rows = read_part_samples(state_dir, state, replaced, sample_id_columns)
+    if old_rows is not None:
+        stats = remove_imputation_stats(stats, partial_imputation_stats(
+            old_rows, desired_chemical_names, relative_accuracy=relative_accuracy))
+
+    cleaned = None
+    if is_updated.any():
+        rows = df[sample_keys(df, sample_id_columns).isin(current_keys[is_updated])]
+        cleaned = dc.clean_long_dataset(rows, sample_id_columns, per_sample_data, chemical_name_column,
+                                        desired_chemical_names, convert_to_standard, erase_invalid, policy)
+        cleaned = add_missing_chemicals(cleaned, desired_chemical_names)
+        cleaned = dc.filter_rows_by_nas(cleaned, desired_chemical_names, na_threshold)
+        stats = merge_imputation_stats(stats, partial_imputation_stats(
+            cleaned, desired_chemical_names, relative_accuracy=relative_accuracy))
+
+    parts = list(state.parts)
+    part = NO_PART
+    if cleaned is not None and len(cleaned) > 0:
+        part = len(parts)
+        parts.append(next_part_name(parts))
+        write_cleaned_dataset(cleaned, os.path.join(state_dir, parts[part]))
+
+    # samples which were filtered out are kept in the hashes, so they are not cleaned again
+    updated_hashes = hashes[is_updated].copy()
+    updated_hashes["Part"] = np.where(
+        current_keys[is_updated].isin(sample_keys(cleaned, sample_id_columns)), part, NO_PART) \
+        if part != NO_PART else NO_PART
+    unchanged = state.hashes[~previous_keys.isin(current_keys[is_updated]) & ~is_removed]
+    new_hashes = pd.concat([frame for frame in [unchanged, updated_hashes] if len(frame) > 0] or [updated_hashes],
+                           ignore_index=True)
+    new_hashes["Part"] = new_hashes["Part"].astype(np.int64)
+
+    save_incremental_state(state_dir, IncrementalState(new_hashes, stats, parts))
+
+    delta = pd.DataFrame()
+    if cleaned is not None:
+        fill_values, missing_chemicals = imputation_fill_values(stats, method)
+        delta = cleaned.copy()
+        dc.fill_dataset_nans(delta, desired_chemical_names, fill_values, missing_chemicals)
+    return IncrementalUpdate(
+        delta=delta,
+        replaced=replaced[sample_id_columns].reset_index(drop=True),
+        new_samples=int(is_new.sum()),
+        changed_samples=int(is_changed.sum()),
+        removed_samples=int(is_removed.sum()),
+    )
+
+
+def read_incremental_dataset(state_dir: str,
+                             sample_id_columns: list[str],
+                             desired_chemical_names: list[str],
+                             method: str | float | None = "mean"
+                             ) -> pd.DataFrame:
+    """
+    Reads the current cleaned dataset from the parts in `state_dir`,
+    sorted by the sample ids. Missing amounts are imputed with the latest
+    statistics by `method` (see `imputation.imputation_fill_values`),
+    or left as NaN if `method` is None.
+    """
+    state = load_incremental_state(state_dir, sample_id_columns)
+    current = state.hashes[state.hashes["Part"] != NO_PART]
+    df = read_part_samples(state_dir, state, current, sample_id_columns)
+    if df is None:
+        return pd.DataFrame()
+
+    # parts have the same columns, rows are sorted like `pivot_measurements`
+    df = df.sort_values([(column, "") for column in sample_id_columns], ignore_index=True)
+    if method is not None:
+        fill_values, missing_chemicals = imputation_fill_values(state.stats, method)
+        dc.fill_dataset_nans(df, desired_chemical_names, fill_values, missing_chemicals)
+    return df
+
+
+def compact_incremental(state_dir: str, sample_id_columns: list[str]) -> None:
+    """
+    Rewrites the current rows of every part into a single part and deletes
+    the old parts, which otherwise grow with every update.
+    """
+    state = load_incremental_state(state_dir, sample_id_columns)
+    current = state.hashes[state.hashes["Part"] != NO_PART]
+    df = read_part_samples(state_dir, state, current, sample_id_columns)
+
+    parts = []
+    hashes = state.hashes.copy()
+    if df is not None:
+        name = next_part_name(state.parts)
+        write_cleaned_dataset(df, os.path.join(state_dir, name))
+        parts.append(name)
+        hashes.loc[hashes["Part"] != NO_PART, "Part"] = 0
+    save_incremental_state(state_dir, IncrementalState(hashes, state.stats, parts))
+
+    for name in state.parts:
+        if os.path.exists(os.path.join(state_dir, name)):
+            os.remove(os.path.join(state_dir, name))
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Update a cleaned dataset with a new export.")
+    parser.add_argument("export", help="long format csv export")
+    parser.add_argument("state_dir", help="directory holding the cleaned dataset between updates")
+    parser.add_argument("config", help="json or yaml pipeline config, its stages are ignored")
+    parser.add_argument("--na-threshold", type=int, required=True)
+    parser.add_argument("--method", default="mean", help="mean, median, mode or a quantile")
+    parser.add_argument("--remove-missing", action="store_true", help="remove samples not in the export")
+    parser.add_argument("--delta", help="write the new and changed rows to this csv file")
+    args = parser.parse_args(argv)
+
+    config = load_pipeline_config(args.config)
+    config.pop("stages", None)
+    context = Pipeline([], **config).context
+    method = args.method if args.method in ("mean", "median", "mode") else float(args.method)
+
+    update = update_incremental(
+        pd.read_csv(args.export, low_memory=False), args.state_dir,
+        context["sample_id_columns"], context["per_sample_data"], context["chemical_name_column"],
+        context["desired_chemical_names"], context["units"], args.na_threshold,
+        method=method, remove_missing=args.remove_missing)
+    if args.delta is not None:
+        update.delta.to_csv(args.delta, index=False, encoding="utf-8")
+    print(f"{update.new_samples} new, {update.changed_samples} changed and "
+          f"{update.removed_samples} removed samples, {len(update.delta)} rows written.")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
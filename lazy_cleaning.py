@@ -0,0 +1,366 @@
+from functools import partial
+from typing import Any, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import data_cleaning as dc
+from cleaning_utils import UnitTable, UNIT_ALIASES, pivot_dataset, pivot_measurements, normalize_units, map_chemicals
+from stream_cleaning import iter_dataset_chunks
+
+
+# : `lazy_cleaning.py` runs the wide format stages (`clean_dataset_units`, `format_dataset_amount`,
+# : `standardise_dataset_unit`, `drop_units_min_detect` and `agg_dataset_measurement`) lazily.
+# : The stages only record themselves, `collect` then plans them: the chemical filter and the
+# : columns which are needed are pushed down into the reader, and the stages are fused into a
+# : single pass over each chemical's columns which explodes list cells once and writes the
+# : final columns straight into the output dataframe.
+# :
+# :     df = (LazyDataset.scan_csv("Tests/small_complex_in.csv", ["SampleID"], ["DateCollected"],
+# :                                "ChemicalName", ["Calcium", "Chloride", "Water Temperature"])
+# :           .clean_units().format_amount().standardise_unit(units, erase_invalid=True)
+# :           .drop_units_min_detect().agg_measurement()
+# :           .collect())
+
+
+# the stages in the order they must be run (the same order as `data_cleaning`)
+OPERATIONS = ["clean_units", "format_amount", "standardise_unit", "drop_units_min_detect", "agg_measurement"]
+
+# stages which need the prefixes made by "format_amount"
+NEEDS_PREFIX = ["standardise_unit", "agg_measurement"]
+
+VALUES_PER_CHEMICAL = ["Amount", "UOM", "MinDetectLimit"]
+
+
+class Operation(NamedTuple):
+    """
+    A recorded stage, `name` is one of `OPERATIONS`.
+    """
+    name: str
+    params: dict[str, Any]
+
+
+class Source(NamedTuple):
+    """
+    Where a `LazyDataset` is read from, `kind` is "csv", "parquet" or "frame".
+    """
+    kind: str
+    data: Any
+    read_kwargs: dict[str, Any]
+
+
+class QueryPlan(NamedTuple):
+    """
+    How a `LazyDataset` is collected, see `LazyDataset.plan`.
+
+    `read_columns` and `chemicals` are pushed down into the reader, `values_per_chemical`
+    are pivoted and `operations` are fused into one pass per chemical which outputs
+    the `output_values` of each chemical.
+
+    If the measurements are aggregated and only their amounts and prefixes are kept,
+    `pivot_last` is True: the fused pass runs once over the long columns and the
+    aggregated measurements are pivoted, rather than pivoting them into list cells.
+    """
+    source: Source
+    sample_id_columns: list[str]
+    per_sample_data: list[str]
+    chemical_name_column: str
+    chemicals: list[str]
+    read_columns: list[str]
+    values_per_chemical: list[str]
+    operations: list[Operation]
+    output_values: list[str]
+    pivot_last: bool
+
+    def explain(self) -> str:
+        """
+        Describes the plan, one step per line.
+        """
+        source = self.source.data if self.source.kind != "frame" else "dataframe"
+        operations = [f"    {name} " + ", ".join(
+            f"{key}={value!r}" if isinstance(value, (bool, int, float, str)) else f"{key}=<{type(value).__name__}>"
+            for key, value in params.items()) for (name, params) in self.operations]
+        operations = [operation.rstrip() for operation in operations]
+        lines = [
+            f"read {self.source.kind} {source}",
+            f"    columns {self.read_columns}",
+            f"    where {self.chemical_name_column} in {self.chemicals}",
+        ]
+        if self.pivot_last:
+            lines.extend(["fused pass over the measurements", *operations,
+                          f"pivot {self.output_values}"])
+        else:
+            lines.extend([f"pivot {self.values_per_chemical}", "fused pass per chemical", *operations,
+                          f"    outputs {self.output_values}"])
+        return "\n".join(lines)
+
+
+class LazyDataset:
+    """
+    A long format dataset which is pivoted and cleaned when `collect` is called.
+    Each stage returns a new `LazyDataset` with the stage recorded.
+
+    Parameters
+    ----------
+    `source` : What to read, see `scan_csv`, `scan_parquet` and `from_frame`
+
+    See `cleaning_utils.pivot_dataset` for the other parameters.
+    """
+
+    def __init__(self,
+                 source: Source,
+                 sample_id_columns: list[str],
+                 per_sample_data: list[str],
+                 chemical_name_column: str,
+                 desired_chemical_names: list[str],
+                 operations: tuple[Operation, ...] = ()):
+        self.source = source
+        self.sample_id_columns = list(sample_id_columns)
+        self.per_sample_data = list(per_sample_data)
+        self.chemical_name_column = chemical_name_column
+        self.desired_chemical_names = list(desired_chemical_names)
+        self.operations = tuple(operations)
+
+    @classmethod
+    def scan_csv(cls, path: str | list[str], sample_id_columns: list[str], per_sample_data: list[str],
+                 chemical_name_column: str, desired_chemical_names: list[str],
+                 **read_csv_kwargs) -> "LazyDataset":
+        """
+        A dataset read from one or more csv files in chunks (see `stream_cleaning.iter_dataset_chunks`),
+        other keyword arguments (eg `chunksize`) are passed to the reader.
+        """
+        return cls(Source("csv", path, read_csv_kwargs), sample_id_columns, per_sample_data,
+                   chemical_name_column, desired_chemical_names)
+
+    @classmethod
+    def scan_parquet(cls, path: str, sample_id_columns: list[str], per_sample_data: list[str],
+                     chemical_name_column: str, desired_chemical_names: list[str],
+                     **read_parquet_kwargs) -> "LazyDataset":
+        """
+        A dataset read from a parquet file, the chemical filter is
+        applied to the row groups by pyarrow.
+        """
+        return cls(Source("parquet", path, read_parquet_kwargs), sample_id_columns, per_sample_data,
+                   chemical_name_column, desired_chemical_names)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, sample_id_columns: list[str], per_sample_data: list[str],
+                   chemical_name_column: str, desired_chemical_names: list[str]) -> "LazyDataset":
+        return cls(Source("frame", df, dict()), sample_id_columns, per_sample_data,
+                   chemical_name_column, desired_chemical_names)
+
+    def with_operation(self, name: str, **params) -> "LazyDataset":
+        done = [operation.name for operation in self.operations]
+        if name in done or any(OPERATIONS.index(other) > OPERATIONS.index(name) for other in done):
+            raise ValueError('Invalid operation order', name)
+        if name in NEEDS_PREFIX and "format_amount" not in done:
+            raise ValueError('Operation needs format_amount', name)
+        return LazyDataset(self.source, self.sample_id_columns, self.per_sample_data, self.chemical_name_column,
+                           self.desired_chemical_names, (*self.operations, Operation(name, params)))
+
+    def clean_units(self, aliases: dict[str, str] = UNIT_ALIASES) -> "LazyDataset":
+        """
+        See `data_cleaning.clean_dataset_units`.
+        """
+        return self.with_operation("clean_units", aliases=aliases)
+
+    def format_amount(self, erase_invalid: bool = True) -> "LazyDataset":
+        """
+        See `data_cleaning.format_dataset_amount`.
+        """
+        return self.with_operation("format_amount", erase_invalid=erase_invalid)
+
+    def standardise_unit(self, convert_to_standard: UnitTable | dict, erase_invalid: bool = False) -> "LazyDataset":
+        """
+        See `data_cleaning.standardise_dataset_unit`.
+        """
+        return self.with_operation("standardise_unit", convert_to_standard=convert_to_standard,
+                                   erase_invalid=erase_invalid)
+
+    def drop_units_min_detect(self) -> "LazyDataset":
+        """
+        See `data_cleaning.drop_units_min_detect`, the dropped columns are never made.
+        """
+        return self.with_operation("drop_units_min_detect")
+
+    def agg_measurement(self, policy: str = "default") -> "LazyDataset":
+        """
+        See `data_cleaning.agg_dataset_measurement`. List cells are aggregated
+        straight from the exploded measurements, without gathering them into lists.
+        """
+        if policy not in dc.AGG_POLICIES:
+            raise ValueError('Invalid aggregation policy', policy)
+        return self.with_operation("agg_measurement", policy=policy)
+
+    def plan(self) -> QueryPlan:
+        """
+        Plans the recorded stages, see `QueryPlan`.
+        """
+        done = [operation.name for operation in self.operations]
+        outputs = [*VALUES_PER_CHEMICAL, "Prefix"] if "format_amount" in done else list(VALUES_PER_CHEMICAL)
+        if "drop_units_min_detect" in done:
+            outputs = [value for value in outputs if value not in ["UOM", "MinDetectLimit"]]
+        return QueryPlan(
+            source=self.source,
+            sample_id_columns=self.sample_id_columns,
+            per_sample_data=self.per_sample_data,
+            chemical_name_column=self.chemical_name_column,
+            chemicals=self.desired_chemical_names,
+            read_columns=[*self.sample_id_columns, *self.per_sample_data, self.chemical_name_column,
+                          *VALUES_PER_CHEMICAL],
+            values_per_chemical=list(VALUES_PER_CHEMICAL),
+            operations=list(self.operations),
+            output_values=sorted(outputs),
+            pivot_last="agg_measurement" in done and "drop_units_min_detect" in done,
+        )
+
+    def collect(self, workers: int = 1) -> pd.DataFrame:
+        """
+        Reads, pivots and cleans the dataset, see `execute_plan`.
+        """
+        return execute_plan(self.plan(), workers)
+
+
+def read_source(plan: QueryPlan) -> pd.DataFrame:
+    """
+    Reads the `read_columns` of the rows of the `chemicals` from the plan's source.
+    """
+    (kind, data, read_kwargs) = plan.source
+    if kind == "frame":
+        return data.loc[data[plan.chemical_name_column].isin(plan.chemicals), plan.read_columns]
+    if kind == "parquet":
+        return pd.read_parquet(data, columns=plan.read_columns,
+                               filters=[(plan.chemical_name_column, "in", plan.chemicals)], **read_kwargs)
+    return pd.concat(iter_dataset_chunks(data, plan.chemical_name_column, plan.chemicals,
+                                         usecols=plan.read_columns, **read_kwargs), ignore_index=True)
+
+
+def fused_chemical_pass(operations: list[Operation],
+                        output_values: list[str],
+                        amounts: np.ndarray,
+                        uoms: np.ndarray,
+                        min_detection_limits: np.ndarray
+                        ) -> dict[str, np.ndarray]:
+    """
+    Runs the `operations` on one chemical's pivoted columns and returns its `output_values`.
+
+    List cells are exploded once and every operation runs on the flat arrays of
+    measurements, the outputs are only gathered back into lists at the end
+    (or aggregated straight from the flat arrays by "agg_measurement").
+    """
+    n_rows = len(amounts)
+    is_list = pd.Series(amounts).map(type).eq(list).to_numpy()
+    scalar_rows = np.flatnonzero(~is_list)
+    list_rows = np.flatnonzero(is_list)
+
+    # the scalar cells followed by the exploded list cells
+    values = {"Amount": amounts, "UOM": uoms, "MinDetectLimit": min_detection_limits}
+    if len(list_rows) > 0:
+        cells = pd.DataFrame({name: column[list_rows] for name, column in values.items()})
+        exploded = cells.explode(list(values.keys()))
+        lengths = np.maximum(cells["Amount"].map(len).to_numpy(), 1)
+        values = {name: np.concatenate([column[scalar_rows], exploded[name].to_numpy()])
+                  for name, column in values.items()}
+    n_scalar = len(scalar_rows)
+
+    for (name, params) in operations:
+        if name == "clean_units":
+            uoms = values["UOM"]
+            cleaned = normalize_units(uoms, params["aliases"])
+            # units in lists which are not strings are kept
+            kept = pd.Series(uoms[n_scalar:], dtype=object).map(type).ne(str).to_numpy()
+            cleaned[n_scalar:][kept] = uoms[n_scalar:][kept]
+            values["UOM"] = cleaned
+        elif name == "format_amount":
+            (values["Prefix"], values["Amount"], values["UOM"]) = dc.parse_amounts(
+                values["Amount"], values["MinDetectLimit"], values["UOM"], params["erase_invalid"])
+        elif name == "standardise_unit":
+            columns = [values[i] for i in ["Amount", "MinDetectLimit", "Prefix", "UOM"]]
+            if isinstance(params["convert_to_standard"], UnitTable):
+                standardised = dc.standardise_unit_arrays(params["convert_to_standard"],
+                                                          params["erase_invalid"], *columns)
+            elif len(columns[0]) > 0:
+                standardise = dc.standardise_units(params["convert_to_standard"], params["erase_invalid"])
+                standardised = np.vectorize(standardise, otypes=[object] * 4)(*columns)
+                standardised = [pd.Series(column, dtype=object).infer_objects().to_numpy()
+                                for column in standardised]
+            else:
+                standardised = columns
+            (values["Amount"], values["MinDetectLimit"], values["Prefix"], values["UOM"]) = standardised
+
+    outputs = dict()
+    aggregate = [params for (name, params) in operations if name == "agg_measurement"]
+    if len(aggregate) > 0:
+        # the measurements of list cells and scalar cells which are not missing, by row
+        flat_rows = np.concatenate([scalar_rows, np.repeat(list_rows, lengths)]) if len(list_rows) > 0 else scalar_rows
+        amounts = values["Amount"]
+        prefixes = np.asarray(values["Prefix"], dtype=object)
+        kept = np.ones(len(amounts), dtype=bool)
+        kept[:n_scalar] = pd.notna(amounts[:n_scalar])
+        measurements = pd.DataFrame({"Amount": amounts[kept], "Prefix": prefixes[kept], "Row": flat_rows[kept]})
+        aggregated = dc.agg_long_measurement(measurements, ["Row"], aggregate[0]["policy"]) \
+            .set_index("Row").reindex(range(n_rows))
+        outputs["Amount"] = aggregated["Amount"].to_numpy()
+        # single measurements keep their prefix
+        outputs["Prefix"] = aggregated["Prefix"].to_numpy(dtype=object)
+        single = scalar_rows[kept[:n_scalar]]
+        outputs["Prefix"][single] = prefixes[:n_scalar][kept[:n_scalar]]
+
+    for name in output_values:
+        if name in outputs:
+            continue
+        column = values[name]
+        if len(list_rows) == 0:
+            outputs[name] = column
+            continue
+        # gather the exploded measurements back into lists, like `cleaning_utils.apply_column_transform`
+        gathered = np.empty(n_rows, dtype=object)
+        gathered[scalar_rows] = column[:n_scalar]
+        parts = np.split(np.asarray(column[n_scalar:]), np.cumsum(lengths)[:-1])
+        gathered[list_rows] = pd.Series([part.tolist() for part in parts], dtype=object).to_numpy()
+        outputs[name] = gathered
+    return outputs
+
+
+def execute_plan(plan: QueryPlan, workers: int = 1) -> pd.DataFrame:
+    """
+    Reads the source, pivots it and runs the fused pass over each chemical
+    (in parallel with `workers`, see `cleaning_utils.map_chemicals`), or runs
+    the fused pass over the measurements before pivoting if `plan.pivot_last`.
+
+    Returns
+    ---------
+    The same dataset as running the stages one after another on the pivoted dataset,
+    with the columns sorted (like `data_cleaning.standardise_dataset_unit`).
+    """
+    df = read_source(plan)
+    if plan.pivot_last:
+        # every measurement is cleaned in one pass, aggregated, then pivoted once
+        keys = [*plan.sample_id_columns, *plan.per_sample_data, plan.chemical_name_column]
+        policy = [params for (name, params) in plan.operations if name == "agg_measurement"][0]["policy"]
+        operations = [operation for operation in plan.operations if operation.name != "agg_measurement"]
+        outputs = fused_chemical_pass(operations, plan.output_values,
+                                      *[df[value].to_numpy(dtype=object) for value in VALUES_PER_CHEMICAL])
+        measurements = df[keys].assign(Amount=outputs["Amount"], Prefix=outputs["Prefix"])
+        aggregated = dc.agg_long_measurement(measurements, keys, policy)
+        pivoted = pivot_measurements(aggregated, plan.sample_id_columns, plan.per_sample_data,
+                                     plan.chemical_name_column, plan.output_values)
+        return pivoted.reindex(columns=sorted(pivoted.columns), copy=False)
+
+    pivoted = pivot_dataset(df, plan.sample_id_columns, plan.per_sample_data, plan.chemical_name_column,
+                            plan.values_per_chemical, plan.chemicals)
+    chemicals = [name for name in plan.chemicals if (name, "Amount") in pivoted.columns]
+
+    results = map_chemicals(
+        partial(fused_chemical_pass, plan.operations, plan.output_values),
+        [[pivoted[name, value].to_numpy() for value in VALUES_PER_CHEMICAL] for name in chemicals],
+        workers=workers,
+    )
+
+    # every column is made once and the dataframe is built from them without copying
+    columns = {(column, ""): pivoted[column, ""].to_numpy() for column in [*plan.sample_id_columns,
+                                                                         *plan.per_sample_data]}
+    for name, outputs in zip(chemicals, results):
+        for value, values in outputs.items():
+            columns[name, value] = values
+    return pd.DataFrame({key: columns[key] for key in sorted(columns)}, copy=False)
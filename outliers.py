@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+
+# : `outliers.py` finds outliers in one vectorized pass and returns masks,
+# : so the dataset is only copied once when the outliers are removed.
+
+
+# default threshold of each method
+OUTLIER_METHODS = {"z-score": 3.0, "modified-z": 3.5, "iqr": 1.5}
+
+
+def outlier_mask(values: pd.Series,
+                 method: str = "z-score",
+                 threshold: float | None = None,
+                 groups: pd.Series | list[pd.Series] | None = None
+                 ) -> tuple[pd.Series, pd.DataFrame]:
+    """
+    Finds the outliers in `values`, NaNs are never outliers.
+
+    Parameters
+    ----------
+    `values` : The values to check
+
+    `method` : One of
+        "z-score" : |x - mean| / std > threshold (default 3)
+        "modified-z" : 0.6745 |x - median| / MAD > threshold (default 3.5),
+            where MAD is the median absolute deviation from the median. If MAD
+            is 0, 0.7979 |x - median| / MeanAD is used, where MeanAD is the mean
+            absolute deviation from the median
+        "iqr" : x is more than threshold (default 1.5) interquartile
+            ranges below the first or above the third quartile. If the
+            interquartile range is 0, 1.349 MeanAD / 0.7979 is used instead
+
+    `threshold` : Overrides the default threshold of the method
+
+    `groups` : Keys (aligned with `values`) to find outliers within each group
+        separately eg the well id. By default all values are one group.
+
+    Returns
+    ---------
+    A tuple of the boolean mask of outliers (aligned with `values`) and
+    a report with a row per group: the number of values and outliers
+    and the bounds outside of which values are outliers.
+    """
+    if method not in OUTLIER_METHODS:
+        raise ValueError('Invalid outlier method', method)
+    if threshold is None:
+        threshold = OUTLIER_METHODS[method]
+
+    values = pd.Series(values, dtype=float)
+    if groups is None:
+        codes = pd.Series(np.zeros(len(values), dtype=np.int64), index=values.index)
+        group_index = pd.RangeIndex(1)
+    else:
+        grouped = values.groupby(groups, sort=False, dropna=False, observed=True)
+        codes = grouped.ngroup()
+        group_index = pd.Index(grouped.size().index)
+    by_group = values.groupby(codes.to_numpy())
+
+    if method == "z-score":
+        center = by_group.mean()
+        scale = by_group.std()
+        lower, upper = center - threshold * scale, center + threshold * scale
+    elif method == "modified-z":
+        center = by_group.median()
+        by_deviation = (values - center.reindex(codes).to_numpy()).abs().groupby(codes.to_numpy())
+        scale = by_deviation.median() / 0.6745
+        # more than half the values are the median (eg at the detection limit),
+        # so the mean absolute deviation is used instead
+        scale = scale.mask(scale == 0, by_deviation.mean() / 0.7979)
+        lower, upper = center - threshold * scale, center + threshold * scale
+    else:
+        q1, q3 = by_group.quantile(0.25), by_group.quantile(0.75)
+        scale = q3 - q1
+        # the same for the interquartile range (1.349 standard deviations of a normal distribution)
+        by_deviation = (values - by_group.median().reindex(codes).to_numpy()).abs().groupby(codes.to_numpy())
+        scale = scale.mask(scale == 0, by_deviation.mean() * 1.349 / 0.7979)
+        lower, upper = q1 - threshold * scale, q3 + threshold * scale
+
+    # groups with a single value (or none) have no outliers
+    skipped = (by_group.count() < 2) | scale.isna()
+    lower, upper = lower.mask(skipped, -np.inf), upper.mask(skipped, np.inf)
+
+    row_lower = lower.reindex(codes).to_numpy()
+    row_upper = upper.reindex(codes).to_numpy()
+    mask = pd.Series((values.to_numpy() < row_lower) | (values.to_numpy() > row_upper),
+                     index=values.index)
+
+    report = pd.DataFrame({
+        "Count": by_group.count(),
+        "Outliers": mask.groupby(codes.to_numpy()).sum(),
+        "Lower": lower,
+        "Upper": upper,
+    }).reindex(range(len(group_index)))
+    report.index = group_index
+    return (mask, report)
+
+
+def dataset_outlier_mask(df: pd.DataFrame,
+                         chem_names: list[str],
+                         method: str = "z-score",
+                         threshold: float | None = None,
+                         group_columns: list | None = None,
+                         value_name: str = "Amount"
+                         ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Finds the outliers of each chemical's `value_name` column in a pivoted dataset.
+    See `outlier_mask`.
+
+    `group_columns` : Columns of `df` to find outliers within each group
+        separately eg [("WellID", "")]. By default the whole dataset is one group.
+
+    Returns
+    ---------
+    A tuple of a boolean dataframe with a column per chemical which is true
+    for outliers, and the reports of each chemical (with the chemical as the
+    first level of the index).
+    """
+    groups = None if group_columns is None else [df[i] for i in group_columns]
+
+    masks = dict()
+    reports = dict()
+    for chem_name in chem_names:
+        masks[chem_name], reports[chem_name] = outlier_mask(
+            df[(chem_name, value_name)], method, threshold, groups)
+
+    mask = pd.DataFrame(masks, index=df.index, columns=pd.Index(chem_names))
+    return (mask, pd.concat(reports, names=["Chemical"]))
+
+
+def drop_outliers(df: pd.DataFrame, mask: pd.DataFrame | pd.Series) -> pd.DataFrame:
+    """
+    Returns `df` without the rows which are an outlier in any column of `mask`.
+    """
+    if isinstance(mask, pd.DataFrame):
+        mask = mask.any(axis=1)
+    return df[~mask.to_numpy()]
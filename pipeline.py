@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from typing import Any, Callable
+
+import pandas as pd
+
+import data_cleaning as dc
+from cleaning_utils import pivot_dataset, create_unit_table
+from schema import read_compact_csv
+from dataset_cache import file_fingerprint
+from stage_cache import StageCache, fingerprint, frame_fingerprint, code_version
+import sql_backend
+from spatial_imputation import fill_dataset_nans_spatial
+from temporal import interpolate_by_well, resample_by_well
+from stream_cleaning import read_dataset
+from dedup import DuplicateFilter
+from lazy_cleaning import LazyDataset
+
+
+# : `pipeline.py` runs the cleaning stages described by a json or yaml config,
+# : and reports the wall time, rows in/out and peak memory of every stage.
+# :
+# : eg `python pipeline.py config.yaml --report report.json --cache-dir .stage_cache`
+# :
+# :     sample_id_columns: [SampleID]
+# :     per_sample_data: [DateCollected]
+# :     chemical_name_column: ChemicalName
+# :     desired_chemical_names: [Calcium, Chloride, Water Temperature]
+# :     units: {"g/l": [0, 1, 1], "mg/l": [0, 1, 1000], "°f": [-32, 5, 9]}
+# :     stages:
+# :       - read_csv: {path: Tests/small_complex_in.csv}
+# :       - pivot
+# :       - clean_units
+# :       - format_amount: {erase_invalid: true}
+# :       - standardise_unit: {erase_invalid: true}
+# :       - drop_units_min_detect
+# :       - agg_measurement
+# :       - filter_rows_by_nas: {na_threshold: 1000}
+# :       - fill_nans
+# :       - sort_columns
+# :       - write_csv: {path: Tests/small_complex_gen.csv}
+
+
+# stage name -> function(df, context, **params) returning the new dataframe
+STAGES: dict[str, Callable[..., pd.DataFrame]] = dict()
+
+
+def register_stage(name: str,
+                   context_keys: tuple[str, ...] | None = None,
+                   cache: bool = True
+                   ) -> Callable:
+    """
+    Decorator which adds a stage function to `STAGES` under `name`.
+
+    `context_keys` : The settings the stage uses, its cached output is only
+        invalidated when these change (default all of them)
+
+    `cache` : False for stages whose side effects must always run (eg writing files)
+    """
+    def register(func):
+        func.context_keys = context_keys
+        func.cacheable = cache
+        STAGES[name] = func
+        return func
+    return register
+
+
+# settings used by the stages
+CHEMICAL_NAMES = ("desired_chemical_names",)
+LAYOUT = ("sample_id_columns", "per_sample_data", "chemical_name_column", "desired_chemical_names")
+
+
+@register_stage("read_csv", context_keys=())
+def read_csv_stage(df, context, path, **read_csv_kwargs):
+    return pd.read_csv(path, **read_csv_kwargs)
+
+
+@register_stage("read_compact_csv", context_keys=())
+def read_compact_csv_stage(df, context, path, schema, float32=False, **read_csv_kwargs):
+    return read_compact_csv(path, schema, float32=float32, **read_csv_kwargs)
+
+
+# reads one or more (eg overlapping) csv files in chunks, dropping rows already read
+@register_stage("read_csv_deduplicated", context_keys=())
+def read_csv_deduplicated_stage(df, context, path, columns=None, max_exact=50000000, **read_csv_kwargs):
+    return read_dataset(path, duplicates=DuplicateFilter(columns, max_exact), **read_csv_kwargs)
+
+
+@register_stage("drop_duplicates", context_keys=())
+def drop_duplicates_stage(df, context, columns=None):
+    return DuplicateFilter(columns).drop_duplicates(df).reset_index(drop=True)
+
+
+@register_stage("pivot", context_keys=LAYOUT)
+def pivot_stage(df, context, values_per_chemical=("Amount", "UOM", "MinDetectLimit")):
+    return pivot_dataset(
+        df,
+        sample_id_columns=context["sample_id_columns"],
+        per_sample_data=context["per_sample_data"],
+        chemical_name_column=context["chemical_name_column"],
+        values_per_chemical=list(values_per_chemical),
+        desired_chemical_names=context["desired_chemical_names"],
+    )
+
+
+@register_stage("clean_units", context_keys=CHEMICAL_NAMES)
+def clean_units_stage(df, context):
+    dc.clean_dataset_units(df, context["desired_chemical_names"])
+    return df
+
+
+@register_stage("format_amount", context_keys=CHEMICAL_NAMES)
+def format_amount_stage(df, context, erase_invalid=True, workers=1):
+    dc.format_dataset_amount(df, context["desired_chemical_names"], erase_invalid, workers=workers)
+    return df
+
+
+@register_stage("standardise_unit", context_keys=(*CHEMICAL_NAMES, "units"))
+def standardise_unit_stage(df, context, erase_invalid=False, workers=1):
+    dc.standardise_dataset_unit(df, context["desired_chemical_names"], context["units"],
+                                erase_invalid, workers=workers)
+    return df
+
+
+@register_stage("drop_units_min_detect", context_keys=CHEMICAL_NAMES)
+def drop_units_min_detect_stage(df, context):
+    dc.drop_units_min_detect(df, context["desired_chemical_names"])
+    return df
+
+
+@register_stage("agg_measurement", context_keys=CHEMICAL_NAMES)
+def agg_measurement_stage(df, context, policy="default", workers=1):
+    dc.agg_dataset_measurement(df, context["desired_chemical_names"], workers=workers, policy=policy)
+    return df
+
+
+@register_stage("clean_long", context_keys=(*LAYOUT, "units"))
+def clean_long_stage(df, context, erase_invalid=True, policy="default"):
+    return dc.clean_long_dataset(
+        df,
+        sample_id_columns=context["sample_id_columns"],
+        per_sample_data=context["per_sample_data"],
+        chemical_name_column=context["chemical_name_column"],
+        desired_chemical_names=context["desired_chemical_names"],
+        convert_to_standard=context["units"],
+        erase_invalid=erase_invalid,
+        policy=policy,
+    )
+
+
+@register_stage("filter_rows_by_nas", context_keys=CHEMICAL_NAMES)
+def filter_rows_by_nas_stage(df, context, na_threshold):
+    return dc.filter_rows_by_nas(df, context["desired_chemical_names"], na_threshold)
+
+
+@register_stage("fill_nans", context_keys=CHEMICAL_NAMES)
+def fill_nans_stage(df, context):
+    (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, context["desired_chemical_names"])
+    dc.fill_dataset_nans(df, context["desired_chemical_names"], amount_avgs, missing_chemicals)
+    return df
+
+
+# fills gaps between the samples of each well, eg {well_columns: gm_well_id, date_column: src_samp_collection_date}
+@register_stage("interpolate_by_well", context_keys=CHEMICAL_NAMES)
+def interpolate_by_well_stage(df, context, well_columns, date_column, **interpolate_kwargs):
+    interpolate_by_well(df, context["desired_chemical_names"], well_columns, date_column, **interpolate_kwargs)
+    return df
+
+
+@register_stage("resample_by_well", context_keys=CHEMICAL_NAMES)
+def resample_by_well_stage(df, context, well_columns, date_column, frequency="monthly", **resample_kwargs):
+    return resample_by_well(df, context["desired_chemical_names"], well_columns, date_column, frequency,
+                            **resample_kwargs)
+
+
+# fills from the nearest samples which measured each chemical, needs Latitude and Longitude per sample data
+@register_stage("fill_nans_spatial", context_keys=CHEMICAL_NAMES)
+def fill_nans_spatial_stage(df, context, **spatial_kwargs):
+    (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, context["desired_chemical_names"])
+    fill_dataset_nans_spatial(df, context["desired_chemical_names"], amount_avgs, missing_chemicals,
+                              **spatial_kwargs)
+    return df
+
+
+# cleans, pivots, filters and fills in one stage on a SQLite database, reading the long format
+# csv or parquet file at `path` in chunks (or the input dataframe if there is no path)
+@register_stage("clean_sql", context_keys=(*LAYOUT, "units"))
+def clean_sql_stage(df, context, na_threshold, path=None, erase_invalid=True, policy="default",
+                    database=None, chunksize=1000000):
+    return sql_backend.clean_dataset(
+        df if path is None else path,
+        sample_id_columns=context["sample_id_columns"],
+        per_sample_data=context["per_sample_data"],
+        chemical_name_column=context["chemical_name_column"],
+        desired_chemical_names=context["desired_chemical_names"],
+        convert_to_standard=context["units"],
+        na_threshold=na_threshold,
+        backend="sqlite",
+        erase_invalid=erase_invalid,
+        policy=policy,
+        database=database,
+        chunksize=chunksize,
+    )
+
+
+# pivot, clean_units, format_amount, standardise_unit, drop_units_min_detect and agg_measurement
+# fused into one pass (see lazy_cleaning.py), reading the long format csv or parquet file at `path`
+# (or the input dataframe if there is no path)
+@register_stage("clean_fused", context_keys=(*LAYOUT, "units"))
+def clean_fused_stage(df, context, path=None, erase_invalid=True, policy="default", workers=1):
+    layout = [context["sample_id_columns"], context["per_sample_data"], context["chemical_name_column"],
+              context["desired_chemical_names"]]
+    if path is None:
+        dataset = LazyDataset.from_frame(df, *layout)
+    elif os.path.splitext(path)[1].lower() == ".parquet":
+        dataset = LazyDataset.scan_parquet(path, *layout)
+    else:
+        dataset = LazyDataset.scan_csv(path, *layout)
+    return dataset.clean_units().format_amount(erase_invalid) \
+        .standardise_unit(context["units"], erase_invalid) \
+        .drop_units_min_detect().agg_measurement(policy).collect(workers)
+
+
+@register_stage("sort_columns", context_keys=CHEMICAL_NAMES)
+def sort_columns_stage(df, context):
+    return dc.sort_columns(df, list(context["desired_chemical_names"]))
+
+
+@register_stage("write_csv", cache=False)
+def write_csv_stage(df, context, path, **to_csv_kwargs):
+    to_csv_kwargs.setdefault("index", False)
+    to_csv_kwargs.setdefault("encoding", "utf-8")
+    df.to_csv(path, **to_csv_kwargs)
+    return df
+
+
+class Pipeline:
+    """
+    A list of named stages from `STAGES` and their parameters, run in order.
+
+    Parameters
+    ----------
+    `stages` : List of (stage name, parameters) tuples
+
+    `context` : Settings shared by the stages, `sample_id_columns`,
+        `per_sample_data`, `chemical_name_column`, `desired_chemical_names`
+        and `units` (a `UnitTable`, or a dictionary to compile with `create_unit_table`)
+    """
+
+    def __init__(self, stages: list[tuple[str, dict]], **context):
+        for name, _ in stages:
+            if name not in STAGES:
+                raise ValueError('Unknown stage', name)
+        if isinstance(context.get("units"), dict):
+            context["units"] = create_unit_table(
+                {unit: tuple(conversion) for unit, conversion in context["units"].items()})
+        self.stages = stages
+        self.context = context
+
+    @classmethod
+    def from_config(cls, config: dict) -> "Pipeline":
+        """
+        Builds a pipeline from a config dictionary (see the top of this file).
+        Each stage is either its name, or a dictionary of its name to its parameters.
+        """
+        config = dict(config)
+        stages = []
+        for stage in config.pop("stages"):
+            if isinstance(stage, str):
+                stages.append((stage, dict()))
+            else:
+                ((name, params),) = stage.items()
+                stages.append((name, dict(params or {})))
+        return cls(stages, **config)
+
+    def stage_keys(self, df: pd.DataFrame | None = None) -> list[str]:
+        """
+        Returns the cache key of each stage's output. A key is made from the key
+        of the stage before (or the fingerprint of `df`), the stage name, its
+        parameters, the settings in its `context_keys` and the `code_version`.
+        Files read by a stage (a `path` parameter, or a list of them) are included by their size and
+        modification time. Stages which are not cacheable pass on the key before them.
+        """
+        key = fingerprint("input", None if df is None else frame_fingerprint(df))
+        version = code_version()
+        keys = []
+        for name, params in self.stages:
+            func = STAGES[name]
+            if func.cacheable:
+                context_keys = func.context_keys if func.context_keys is not None else sorted(self.context)
+                paths = params.get("path", [])
+                source = [file_fingerprint(path) for path in ([paths] if isinstance(paths, str) else paths)
+                          if os.path.exists(path)]
+                key = fingerprint(key, name, params, {i: self.context.get(i) for i in context_keys},
+                                  source, version)
+            keys.append(key)
+        return keys
+
+    def run(self,
+            df: pd.DataFrame | None = None,
+            trace_memory: bool = True,
+            cache: StageCache | None = None
+            ) -> tuple[pd.DataFrame, list[dict[str, Any]]]:
+        """
+        Runs every stage in order, starting from `df` (or None if the first stage reads it).
+
+        `trace_memory` : Measure the peak memory of each stage with tracemalloc.
+            Tracing slows down python code, so turn it off for accurate timings.
+
+        `cache` : Store the output of each stage in this `StageCache`. The run starts
+            after the last stage whose output is stored (see `stage_keys`), stages
+            before the first uncacheable stage (eg `write_csv`) can be skipped.
+
+        Returns
+        ---------
+        A tuple of the final dataframe and the report, a list with a dictionary
+        for each stage: `stage`, `seconds`, `rows_in`, `rows_out`,
+        `rows_per_second` (of the larger of rows in and out), `peak_memory_bytes`
+        (the peak memory allocated by python during the stage, None if not traced)
+        and `cached` (whether its output was loaded from the cache rather than run).
+        Stages skipped before the loaded one only have their `stage` and `cached`.
+        """
+        report = []
+        start_stage = 0
+        keys = None
+        if cache is not None:
+            keys = self.stage_keys(df)
+            for idx, (name, _) in enumerate(self.stages):
+                if not STAGES[name].cacheable:
+                    break
+                if keys[idx] in cache:
+                    start_stage = idx + 1
+            for name, _ in self.stages[:max(start_stage - 1, 0)]:
+                report.append({"stage": name, "cached": True})
+            if start_stage > 0:
+                start = time.perf_counter()
+                df = cache.load(keys[start_stage - 1])
+                seconds = time.perf_counter() - start
+                report.append({
+                    "stage": self.stages[start_stage - 1][0],
+                    "seconds": seconds,
+                    "rows_in": None,
+                    "rows_out": len(df),
+                    "rows_per_second": None,
+                    "peak_memory_bytes": None,
+                    "cached": True,
+                })
+
+        tracing = tracemalloc.is_tracing()
+        if trace_memory and not tracing:
+            tracemalloc.start()
+
+        try:
+            for idx, (name, params) in enumerate(self.stages[start_stage:], start_stage):
+                rows_in = 0 if df is None else len(df)
+                if trace_memory:
+                    tracemalloc.reset_peak()
+                    start_memory = tracemalloc.get_traced_memory()[0]
+                start = time.perf_counter()
+
+                df = STAGES[name](df, self.context, **params)
+
+                seconds = time.perf_counter() - start
+                peak_memory = tracemalloc.get_traced_memory()[1] - start_memory if trace_memory else None
+                report.append({
+                    "stage": name,
+                    "seconds": seconds,
+                    "rows_in": rows_in,
+                    "rows_out": len(df),
+                    "rows_per_second": max(rows_in, len(df)) / seconds if seconds > 0 else None,
+                    "peak_memory_bytes": peak_memory,
+                    "cached": False,
+                })
+                # stored outside of the timed stage
+                if cache is not None and STAGES[name].cacheable:
+                    cache.store(keys[idx], df, name)
+        finally:
+            if trace_memory and not tracing:
+                tracemalloc.stop()
+
+        return (df, report)
+
+
+def load_pipeline_config(path: str) -> dict:
+    """
+    Loads a pipeline config from a json or yaml (.yaml or .yml) file.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Run the cleaning stages described by a config file.")
+    parser.add_argument("config", help="json or yaml pipeline config")
+    parser.add_argument("--report", help="write the per stage report to this json file (default stdout)")
+    parser.add_argument("--cache-dir", help="reuse the stage outputs stored in this directory")
+    parser.add_argument("--cache-max-bytes", type=int, default=2 * 1024**3)
+    args = parser.parse_args(argv)
+
+    pipeline = Pipeline.from_config(load_pipeline_config(args.config))
+    cache = StageCache(args.cache_dir, args.cache_max_bytes) if args.cache_dir is not None else None
+    _, report = pipeline.run(cache=cache)
+
+    if args.report is None:
+        json.dump(report, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+    else:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
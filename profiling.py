@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import importlib
+import threading
+import tracemalloc
+import contextlib
+import functools
+from typing import Any, Callable, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+# : `profiling.py` records the time, number of elements and memory allocated by every call of the
+# : public functions of `cleaning_utils` and `data_cleaning` (and steps within them marked with `span`).
+# : It is off by default and costs nothing then, the functions are only wrapped while profiling.
+# :
+# : eg `CLEANING_PROFILE=trace.json python cleaning_acceptance_tests.py` writes a trace (for
+# : chrome://tracing, Perfetto or speedscope) when python exits, a `.folded` path writes folded
+# : stacks for flamegraph.pl and `CLEANING_PROFILE=1` prints a summary. Or in code:
+# :
+# :     with Profiler() as profiler:
+# :         clean(df)
+# :     print(profiler.summary())
+
+
+PROFILE_ENV = "CLEANING_PROFILE"
+
+PROFILED_MODULES = ["cleaning_utils", "data_cleaning"]
+
+
+class ProfileRecord(NamedTuple):
+    """
+    One call of a profiled function or `span`. `stack` is the names of the calls it
+    was made within (ending with its own name), `self_seconds` excludes the time in
+    profiled calls made by it and `allocated_bytes` is the change in memory traced
+    by tracemalloc (None if not traced).
+    """
+    name: str
+    stack: tuple[str, ...]
+    thread: int
+    start: float
+    seconds: float
+    self_seconds: float
+    elements: int | None
+    allocated_bytes: int | None
+
+
+# profilers which are recording, the calls are recorded by all of them
+active_profilers: list["Profiler"] = []
+
+# the calls each thread is within, lists of [name, child seconds]
+call_stacks = threading.local()
+
+# the wrapped functions while any profiler is active, (namespace, name, original function)
+patched: list[tuple[dict, str, Callable]] = []
+
+# the profiler started by the `PROFILE_ENV` variable
+environment_profiler: "Profiler | None" = None
+
+
+class Span:
+    """
+    Context manager recording one call for the `active_profilers`, see `span`.
+    """
+
+    def __init__(self, name: str, elements: int | None = None):
+        self.name = name
+        self.elements = elements
+
+    def __enter__(self) -> "Span":
+        stack = getattr(call_stacks, "stack", None)
+        if stack is None:
+            stack = call_stacks.stack = []
+        stack.append([self.name, 0.0])
+        self.memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        seconds = time.perf_counter() - self.start
+        allocated = tracemalloc.get_traced_memory()[0] - self.memory \
+            if self.memory is not None and tracemalloc.is_tracing() else None
+        stack = call_stacks.stack
+        (_, child_seconds) = stack.pop()
+        if len(stack) > 0:
+            stack[-1][1] += seconds
+        record = ProfileRecord(
+            name=self.name,
+            stack=(*(frame[0] for frame in stack), self.name),
+            thread=threading.get_ident(),
+            start=self.start,
+            seconds=seconds,
+            self_seconds=seconds - child_seconds,
+            elements=self.elements,
+            allocated_bytes=allocated,
+        )
+        for profiler in active_profilers:
+            profiler.records.append(record)
+
+
+def span(name: str, elements: int | None = None) -> contextlib.AbstractContextManager:
+    """
+    Marks a step within a function (eg `with span("apply_transform.vectorize", n):`)
+    so it is recorded as its own call. Does nothing unless a profiler is active.
+    """
+    if len(active_profilers) == 0:
+        return contextlib.nullcontext()
+    return Span(name, elements)
+
+
+def count_elements(args: tuple) -> int | None:
+    """
+    Returns the length of the first dataframe, series, array or list argument.
+    """
+    for arg in args:
+        if isinstance(arg, (pd.DataFrame, pd.Series, pd.Index, np.ndarray, list)):
+            return len(arg)
+    return None
+
+
+def profiled(func: Callable, name: str) -> Callable:
+    """
+    Wraps a function so each call is recorded by the `active_profilers`.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if len(active_profilers) == 0:
+            return func(*args, **kwargs)
+        with Span(name, count_elements(args)):
+            return func(*args, **kwargs)
+    wrapper.profiled = True
+    return wrapper
+
+
+def public_functions(module: Any) -> dict[str, Callable]:
+    """
+    Returns the public functions defined in a module.
+    """
+    return {name: value for name, value in vars(module).items()
+            if not name.startswith("_") and inspect.isfunction(value)
+            and value.__module__ == module.__name__ and not getattr(value, "profiled", False)}
+
+
+def instrument(module_names: list[str]) -> None:
+    """
+    Replaces the public functions of the modules with `profiled` wrappers, in the
+    modules themselves and in every loaded module which imported them by name.
+    """
+    originals = dict()
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        for name, func in public_functions(module).items():
+            originals[id(func)] = (func, profiled(func, f"{module_name}.{name}"))
+    if len(originals) == 0:
+        return
+
+    for module in list(sys.modules.values()):
+        namespace = getattr(module, "__dict__", None)
+        if namespace is None:
+            continue
+        for name, value in list(namespace.items()):
+            if inspect.isfunction(value) and id(value) in originals and originals[id(value)][0] is value:
+                namespace[name] = originals[id(value)][1]
+                patched.append((namespace, name, value))
+
+
+def restore() -> None:
+    """
+    Puts back the functions replaced by `instrument`.
+    """
+    while len(patched) > 0:
+        (namespace, name, func) = patched.pop()
+        namespace[name] = func
+
+
+class Profiler:
+    """
+    Records the calls of the public functions of `modules` while it is active
+    (between `start` and `stop`, or as a context manager).
+
+    Parameters
+    ----------
+    `modules` : The modules whose functions are profiled
+
+    `trace_memory` : Record the memory allocated by each call with tracemalloc,
+        which slows down python code so turn it off for accurate timings
+    """
+
+    def __init__(self, modules: list[str] = PROFILED_MODULES, trace_memory: bool = True):
+        self.modules = list(modules)
+        self.trace_memory = trace_memory
+        self.records: list[ProfileRecord] = []
+        self.started_tracing = False
+        self.origin = time.perf_counter()
+
+    def start(self) -> "Profiler":
+        self.origin = time.perf_counter()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        active_profilers.append(self)
+        instrument(self.modules)
+        return self
+
+    def stop(self) -> None:
+        active_profilers.remove(self)
+        if len(active_profilers) == 0:
+            restore()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def __enter__(self) -> "Profiler":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Returns a row per function (or span) with its number of calls, total and self
+        seconds, elements, elements per second and bytes allocated, slowest first.
+        """
+        records = pd.DataFrame(self.records, columns=ProfileRecord._fields)
+        grouped = records.groupby("name")
+        summary = grouped.agg(
+            calls=("seconds", "size"),
+            seconds=("seconds", "sum"),
+            self_seconds=("self_seconds", "sum"),
+        )
+        # NaN for functions without element counts or traced memory
+        summary["elements"] = grouped["elements"].sum(min_count=1)
+        summary["allocated_bytes"] = grouped["allocated_bytes"].sum(min_count=1)
+        summary["elements_per_second"] = summary["elements"] / summary["seconds"].where(summary["seconds"] > 0)
+        return summary.sort_values("seconds", ascending=False)
+
+    def trace_events(self) -> dict:
+        """
+        Returns the calls in the Chrome trace event format (complete events, in microseconds).
+        """
+        events = [{
+            "name": record.name,
+            "ph": "X",
+            "ts": (record.start - self.origin) * 1e6,
+            "dur": record.seconds * 1e6,
+            "pid": os.getpid(),
+            "tid": record.thread,
+            "args": {
+                "elements": record.elements,
+                "elements_per_second": record.elements / record.seconds
+                if record.elements is not None and record.seconds > 0 else None,
+                "allocated_bytes": record.allocated_bytes,
+            },
+        } for record in self.records]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def folded_stacks(self) -> list[str]:
+        """
+        Returns the self time (microseconds) of each call stack, as lines of
+        "outer;inner;function time" for flamegraph.pl or speedscope.
+        """
+        totals = dict()
+        for record in self.records:
+            key = ";".join(record.stack)
+            totals[key] = totals.get(key, 0.0) + record.self_seconds
+        return [f"{stack} {round(seconds * 1e6)}" for stack, seconds in sorted(totals.items())]
+
+    def save(self, path: str) -> None:
+        """
+        Writes folded stacks if `path` ends with .folded, or a json trace otherwise.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            if os.path.splitext(path)[1].lower() == ".folded":
+                f.write("\n".join(self.folded_stacks()) + "\n")
+            else:
+                json.dump(self.trace_events(), f)
+
+
+def finish_environment_profile(profiler: Profiler, target: str) -> None:
+    profiler.stop()
+    if target.lower() in ("1", "true", "yes"):
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            print(profiler.summary(), file=sys.stderr)
+    else:
+        profiler.save(target)
+
+
+def instrument_from_environment(module_name: str) -> None:
+    """
+    Called at the end of each profiled module. If the `PROFILE_ENV` variable is set,
+    profiles the module until python exits, then writes or prints the results.
+    """
+    target = os.environ.get(PROFILE_ENV, "")
+    if target == "" or module_name not in PROFILED_MODULES:
+        return
+    global environment_profiler
+    if environment_profiler is None:
+        environment_profiler = Profiler([]).start()
+        atexit.register(finish_environment_profile, environment_profiler, target)
+    environment_profiler.modules.append(module_name)
+    instrument([module_name])
+
@@ -0,0 +1,189 @@
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+# : `schema.py` loads datasets straight into compact dtypes (categoricals for repeated
+# : strings, small integers, dates and optionally float32) and reports the memory used by each column.
+
+
+# prefixes are stored as a categorical, so each is a single byte code
+PREFIX_DTYPE = pd.CategoricalDtype(["=", "<", ">"])
+PREFIX_CODES = {prefix: code for code, prefix in enumerate(PREFIX_DTYPE.categories)}
+
+# column name -> "category", "string", "integer", "float" or ("datetime", format)
+# Amount is mostly distinct strings, they are kept in arrow string arrays until parsed
+SCHEMAS = {
+    "fixture": {
+        "SampleID": "integer",
+        "DateCollected": ("datetime", "%d/%m/%Y"),
+        "ChemicalName": "category",
+        "Amount": "string",
+        "UOM": "category",
+        "MinDetectLimit": "float",
+    },
+    "idaho": {
+        "SampleNumber": "category",
+        "SampleDate": ("datetime", "%d/%m/%Y %H:%M"),
+        "Latitude": "float",
+        "Longitude": "float",
+        "CharName": "category",
+        "Amount": "string",
+        "UOM": "category",
+        "MinDetectLimit": "float",
+    },
+    "ddw": {
+        "gm_well_id": "category",
+        "gm_chemical_name": "category",
+        "src_samp_collection_date": ("datetime", None),
+        "src_samp_collection_time": "category",
+    },
+}
+
+
+def string_dtype() -> pd.StringDtype | str:
+    """
+    Strings are stored in arrow arrays when pyarrow is installed,
+    otherwise as a categorical.
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        return "category"
+    return pd.StringDtype("pyarrow")
+
+
+def convert_column(column: pd.Series, column_type: str | tuple, float32: bool = False) -> pd.Series:
+    """
+    Converts a column to the compact dtype of its `column_type` in a schema.
+    """
+    if isinstance(column_type, tuple):
+        (column_type, date_format) = column_type
+        if column_type != "datetime":
+            raise ValueError('Invalid column type', column_type)
+        return pd.to_datetime(column, format=date_format, errors="coerce")
+    if column_type == "category":
+        return column.astype("category")
+    if column_type == "string":
+        return column.astype(string_dtype())
+    if column_type == "integer":
+        numbers = pd.to_numeric(column, errors="coerce")
+        if numbers.isna().any():
+            return numbers
+        return pd.to_numeric(numbers, downcast="integer")
+    if column_type == "float":
+        return pd.to_numeric(column, errors="coerce").astype(np.float32 if float32 else np.float64)
+    raise ValueError('Invalid column type', column_type)
+
+
+def compact_dtypes(df: pd.DataFrame,
+                   schema: dict[str, str | tuple] | str,
+                   *,
+                   float32: bool = False,
+                   categorize_other: bool = True,
+                   max_unique_fraction: float = 0.5
+                   ) -> pd.DataFrame:
+    """
+    Converts the columns of a long format dataset to compact dtypes, in place.
+
+    Parameters
+    ----------
+    `schema` : Column names to their types, or the name of one of the `SCHEMAS`.
+        Columns of the schema which are not in `df` are ignored.
+
+    `float32` : Store "float" columns as float32 rather than float64.
+        Amounts are parsed into the same precision as the detection limits.
+
+    `categorize_other` : Also convert other string (object) columns to categoricals
+        if at most `max_unique_fraction` of their values are distinct.
+    """
+    if isinstance(schema, str):
+        schema = SCHEMAS[schema]
+    for column in df.columns:
+        if column in schema:
+            df[column] = convert_column(df[column], schema[column], float32)
+        elif categorize_other and df[column].dtype == object and len(df) > 0 \
+                and df[column].nunique() <= max_unique_fraction * len(df):
+            df[column] = df[column].astype("category")
+    return df
+
+
+def read_compact_csv(path: str,
+                     schema: dict[str, str | tuple] | str,
+                     *,
+                     float32: bool = False,
+                     categorize_other: bool = True,
+                     **read_csv_kwargs
+                     ) -> pd.DataFrame:
+    """
+    Reads a csv file into compact dtypes (see `compact_dtypes`).
+    Categorical and string columns are converted while reading, so the full
+    column of python strings is never held in memory.
+
+    Any other keyword arguments are passed to `pd.read_csv`.
+    """
+    if isinstance(schema, str):
+        schema = SCHEMAS[schema]
+    dtype = {column: "category" if column_type == "category" else string_dtype()
+             for column, column_type in schema.items() if column_type in ("category", "string")}
+    dtype.update(read_csv_kwargs.pop("dtype", None) or {})
+    df = pd.read_csv(path, dtype=dtype, **read_csv_kwargs)
+    return compact_dtypes(df, schema, float32=float32, categorize_other=categorize_other)
+
+
+def compact_pivoted(df: pd.DataFrame,
+                    chem_names: list[str],
+                    *,
+                    float32: bool = False
+                    ) -> pd.DataFrame:
+    """
+    Converts the Prefix columns of an aggregated pivoted dataset to
+    `PREFIX_DTYPE`, and the Amount columns to float32 if `float32`, in place.
+    """
+    for chem_name in chem_names:
+        if (chem_name, "Prefix") in df.columns:
+            df[chem_name, "Prefix"] = df[chem_name, "Prefix"].astype(PREFIX_DTYPE)
+        if float32 and (chem_name, "Amount") in df.columns:
+            df[chem_name, "Amount"] = df[chem_name, "Amount"].astype(np.float32)
+    return df
+
+
+def memory_report(df: pd.DataFrame, baseline: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Returns the dtype and memory (in bytes, including python objects) of each
+    column and the total. If a `baseline` frame (eg loaded without a schema)
+    is given, its memory and how many times smaller `df` is are included.
+    """
+    def column_memory(frame):
+        memory = frame.memory_usage(deep=True, index=True)
+        report = pd.DataFrame({
+            "dtype": [str(frame.index.dtype), *frame.dtypes.astype(str)],
+            "bytes": memory.to_numpy(),
+        }, index=pd.Index(["Index", *frame.columns], tupleize_cols=False))
+        total = pd.DataFrame({"dtype": [""], "bytes": [memory.sum()]}, index=["Total"])
+        return pd.concat([report, total])
+
+    report = column_memory(df)
+    if baseline is not None:
+        report = report.join(column_memory(baseline).add_prefix("baseline_"), how="left")
+        report["reduction"] = report["baseline_bytes"] / report["bytes"]
+    return report
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Report the memory of a dataset with and without a schema.")
+    parser.add_argument("path", help="csv file")
+    parser.add_argument("schema", choices=list(SCHEMAS.keys()))
+    parser.add_argument("--float32", action="store_true")
+    args = parser.parse_args(argv)
+
+    baseline = pd.read_csv(args.path, low_memory=False)
+    df = read_compact_csv(args.path, args.schema, float32=args.float32, low_memory=False)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(memory_report(df, baseline))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
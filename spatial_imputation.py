@@ -0,0 +1,269 @@
+from typing import Any, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+# : `spatial_imputation.py` fills missing amounts from the nearest samples which measured
+# : the chemical rather than from the chemical's global average. Sample locations are indexed
+# : once in a KD-tree (scipy) and the index is reused for every chemical and for
+# : "wells within a radius" queries.
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+# chemicals measured in fewer of the indexed samples are estimated from a tree of
+# only the measured samples, rather than searching through the unmeasured ones
+SPARSE_FRACTION = 0.25
+
+
+class SpatialIndex(NamedTuple):
+    """
+    KD-tree over the locations of a dataset's samples (rows).
+
+    Locations are points on the unit sphere, so the straight line (chord) distances
+    in the tree are in the same order as great circle distances.
+    `points` has a point per row (NaN for rows without a location) and
+    `rows` is the row of each point in the `tree`.
+    """
+    tree: Any
+    points: np.ndarray
+    rows: np.ndarray
+
+
+def to_unit_sphere(latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """
+    Converts latitudes and longitudes (degrees) to points on the unit sphere.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    return np.stack([np.cos(latitudes) * np.cos(longitudes),
+                     np.cos(latitudes) * np.sin(longitudes),
+                     np.sin(latitudes)], axis=-1)
+
+
+def chord_length(distance_km: float | np.ndarray) -> float | np.ndarray:
+    """
+    Converts a great circle distance (km) to the chord distance in a `SpatialIndex`.
+    """
+    return 2 * np.sin(np.minimum(np.asarray(distance_km, dtype=float) / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def great_circle_km(chord: float | np.ndarray) -> float | np.ndarray:
+    """
+    Converts a chord distance in a `SpatialIndex` to the great circle distance (km).
+    """
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord, dtype=float) / 2, 1))
+
+
+def location_columns(df: pd.DataFrame,
+                     latitude_column: str = "Latitude",
+                     longitude_column: str = "Longitude"
+                     ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the latitudes and longitudes of a long (flat columns) or
+    pivoted (multiindex columns) dataset.
+    """
+    if isinstance(df.columns, pd.MultiIndex):
+        latitude_column, longitude_column = (latitude_column, ""), (longitude_column, "")
+    return (pd.to_numeric(df[latitude_column], errors="coerce").to_numpy(dtype=float),
+            pd.to_numeric(df[longitude_column], errors="coerce").to_numpy(dtype=float))
+
+
+def build_spatial_index(latitudes: np.ndarray, longitudes: np.ndarray) -> SpatialIndex:
+    """
+    Indexes the locations of samples, rows with a missing (or invalid)
+    latitude or longitude are left out of the tree.
+    """
+    from scipy.spatial import cKDTree
+
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    located = np.isfinite(latitudes) & np.isfinite(longitudes) & (np.abs(latitudes) <= 90)
+    points = np.full((len(latitudes), 3), np.nan)
+    points[located] = to_unit_sphere(latitudes[located], longitudes[located])
+    rows = np.flatnonzero(located)
+    return SpatialIndex(tree=cKDTree(points[rows]), points=points, rows=rows)
+
+
+def dataset_spatial_index(df: pd.DataFrame,
+                          latitude_column: str = "Latitude",
+                          longitude_column: str = "Longitude"
+                          ) -> SpatialIndex:
+    """
+    Indexes the locations of a dataset's samples, see `build_spatial_index`.
+    """
+    return build_spatial_index(*location_columns(df, latitude_column, longitude_column))
+
+
+def wells_within_radius(index: SpatialIndex,
+                        latitudes: float | np.ndarray,
+                        longitudes: float | np.ndarray,
+                        radius_km: float,
+                        batch_size: int = 100000
+                        ) -> np.ndarray | list[np.ndarray]:
+    """
+    Finds the samples within `radius_km` of each location.
+
+    Returns
+    ---------
+    The (sorted) rows of the indexed dataset within the radius of the location,
+    or a list of them if arrays of locations are given.
+    """
+    scalar = np.ndim(latitudes) == 0
+    points = to_unit_sphere(np.atleast_1d(latitudes), np.atleast_1d(longitudes))
+    radius = chord_length(radius_km)
+    found = []
+    for start in range(0, len(points), batch_size):
+        for positions in index.tree.query_ball_point(points[start:start + batch_size], radius):
+            found.append(np.sort(index.rows[np.asarray(positions, dtype=np.int64)]))
+    return found[0] if scalar else found
+
+
+def idw_batch(tree: Any,
+              tree_rows: np.ndarray,
+              points: np.ndarray,
+              values: np.ndarray,
+              measured: np.ndarray,
+              rows: np.ndarray,
+              k: int,
+              power: float,
+              max_chord: float
+              ) -> np.ndarray:
+    """
+    Inverse distance weighted estimates at `rows` from their `k` nearest measured rows,
+    `tree_rows` is the row of each point in the `tree`.
+    """
+    n_points = tree.n
+    estimates = np.full(len(rows), np.nan)
+    pending = np.arange(len(rows))
+    # start with enough neighbours to find k measured ones if they were spread evenly
+    n_query = min(n_points, int(np.ceil(k * n_points / max(measured[tree_rows].sum(), 1))))
+    while len(pending) > 0:
+        chords, positions = tree.query(points[rows[pending]], k=n_query, distance_upper_bound=max_chord)
+        chords = chords.reshape(len(pending), -1)
+        positions = positions.reshape(len(pending), -1)
+        # missing neighbours (beyond the maximum distance) have position n_points
+        found = positions < n_points
+        neighbours = tree_rows[np.minimum(positions, n_points - 1)]
+        usable = found & measured[neighbours]
+        done = (usable.sum(axis=1) >= k) | ~found[:, -1] | (n_query >= n_points)
+
+        chords, neighbours = chords[done], neighbours[done]
+        usable = usable[done] & (np.cumsum(usable[done], axis=1) <= k)
+        distances = great_circle_km(np.where(usable, chords, 1.0))
+        weights = np.where(usable, 1 / np.maximum(distances, 1e-12) ** power, 0.0)
+        # samples at the same location (eg the same well) outweigh all others
+        same = usable & (distances == 0)
+        weights = np.where(same.any(axis=1, keepdims=True), same.astype(float), weights)
+        totals = weights.sum(axis=1)
+        weighted = (weights * np.where(usable, values[neighbours], 0.0)).sum(axis=1)
+        estimates[pending[done]] = np.where(totals > 0, weighted / np.where(totals > 0, totals, 1), np.nan)
+
+        pending = pending[~done]
+        n_query = min(n_points, 2 * n_query)
+    return estimates
+
+
+def idw_estimates(index: SpatialIndex,
+                  values: np.ndarray,
+                  k: int = 8,
+                  power: float = 2.0,
+                  max_distance_km: float | None = None,
+                  batch_size: int = 100000
+                  ) -> np.ndarray:
+    """
+    Estimates each missing value from the inverse distance weighted
+    average of the `k` nearest samples which have a value.
+
+    Parameters
+    ----------
+    `index` : The `SpatialIndex` of the dataset `values` belong to. Values which are
+        measured in fewer than `SPARSE_FRACTION` of its samples get their own index.
+
+    `values` : A value per row of the dataset (eg a chemical's amounts), NaN where missing
+
+    `k` : The number of neighbours each estimate is made from
+
+    `power` : Weights are 1 / distance ** power. Neighbours at the same
+        location as the missing value are averaged on their own.
+
+    `max_distance_km` : Neighbours further away are not used
+
+    `batch_size` : The number of missing values estimated at once
+
+    Returns
+    ---------
+    An array of the estimates (aligned with `values`). NaN where a value is not
+    missing, the row has no location or there are no neighbours with values.
+    """
+    values = np.asarray(values, dtype=float)
+    estimates = np.full(len(values), np.nan)
+    if index.tree.n == 0:
+        return estimates
+    located = ~np.isnan(index.points[:, 0])
+    measured = located & ~np.isnan(values)
+    missing = np.flatnonzero(located & np.isnan(values))
+    if len(missing) == 0 or not measured.any():
+        return estimates
+
+    tree, tree_rows = index.tree, index.rows
+    if measured.sum() < SPARSE_FRACTION * len(index.rows):
+        from scipy.spatial import cKDTree
+        tree_rows = np.flatnonzero(measured)
+        tree = cKDTree(index.points[tree_rows])
+
+    max_chord = np.inf if max_distance_km is None else chord_length(max_distance_km)
+    k = min(k, int(measured.sum()))
+    for start in range(0, len(missing), batch_size):
+        rows = missing[start:start + batch_size]
+        estimates[rows] = idw_batch(tree, tree_rows, index.points, values, measured, rows, k, power, max_chord)
+    return estimates
+
+
+def fill_dataset_nans_spatial(df: pd.DataFrame,
+                              desired_chemical_names: list[str],
+                              amount_avgs: dict[str, float],
+                              missing_chemicals: list[str],
+                              index: SpatialIndex | None = None,
+                              *,
+                              k: int = 8,
+                              power: float = 2.0,
+                              max_distance_km: float | None = None,
+                              latitude_column: str = "Latitude",
+                              longitude_column: str = "Longitude",
+                              batch_size: int = 100000
+                              ) -> None:
+    """
+    Fills the missing amounts of a pivoted dataset in place with `idw_estimates`
+    from nearby samples, like `data_cleaning.fill_dataset_nans` (filled prefixes
+    are "=" and `missing_chemicals` are removed). Amounts which cannot be
+    estimated (no location or no neighbours) are filled with `amount_avgs`.
+
+    Parameters
+    ----------
+    `index` : The `SpatialIndex` of `df` (default built from its
+        `latitude_column` and `longitude_column` per sample data)
+
+    See `idw_estimates` for the other parameters.
+    """
+    if index is None:
+        index = dataset_spatial_index(df, latitude_column, longitude_column)
+
+    df.drop(missing_chemicals, axis=1, inplace=True)
+    for chemical_name in desired_chemical_names:
+        if chemical_name in missing_chemicals:
+            continue
+        amounts = df[chemical_name, "Amount"]
+        prefixes = df[chemical_name, "Prefix"]
+        missing = amounts.isna()
+        if not missing.any():
+            continue
+        estimates = idw_estimates(index, amounts.to_numpy(dtype=float), k, power, max_distance_km, batch_size)
+        estimates = np.where(np.isnan(estimates), amount_avgs[chemical_name], estimates)
+        if amounts.dtype != np.float32:
+            amounts = amounts.astype(float)
+        if not isinstance(prefixes.dtype, pd.CategoricalDtype):
+            prefixes = prefixes.astype(object)
+        df[chemical_name, "Amount"] = amounts.mask(missing, pd.Series(estimates, index=amounts.index))
+        df[chemical_name, "Prefix"] = prefixes.mask(missing, "=")
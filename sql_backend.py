@@ -0,0 +1,259 @@
+import os
+import sqlite3
+from typing import Iterator
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import data_cleaning as dc
+from cleaning_utils import UnitTable
+from stream_cleaning import iter_dataset_chunks
+
+
+# : `sql_backend.py` runs the duplicate aggregation, pivot, NA filtering and average filling
+# : in an on-disk SQLite database rather than in pandas frames, so datasets larger than
+# : memory can be cleaned. Measurements are read from csv or parquet files in chunks and
+# : cleaned row by row (units, amounts) in pandas before they are inserted.
+# : Only the final wide dataset is loaded into a dataframe.
+
+
+BACKENDS = ["pandas", "sqlite"]
+
+MEASUREMENTS_TABLE = "measurements"
+
+
+def quote(name: str) -> str:
+    """
+    Quotes a column name for SQL, eg `Water Temperature` -> `"Water Temperature"`.
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def connect(database: str | None = None, cache_mb: int = 256) -> sqlite3.Connection:
+    """
+    Opens the SQLite `database` file (default a private temporary database,
+    deleted when the connection is closed). Tables, sorting and grouping which
+    do not fit in `cache_mb` of memory spill to disk.
+    """
+    # an empty file name is SQLite's temporary on-disk database
+    connection = sqlite3.connect("" if database is None else database)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA temp_store = FILE")
+    connection.execute(f"PRAGMA cache_size = {-1024 * cache_mb}")
+    return connection
+
+
+def iter_source_chunks(source: str | pd.DataFrame,
+                       columns: list[str],
+                       chemical_name_column: str,
+                       desired_chemical_names: list[str],
+                       chunksize: int = 1000000
+                       ) -> Iterator[pd.DataFrame]:
+    """
+    Yields chunks of the desired chemicals' rows from a csv file, a parquet
+    file or a dataframe.
+    """
+    if isinstance(source, pd.DataFrame):
+        source = source[source[chemical_name_column].isin(desired_chemical_names)]
+        for start in range(0, len(source), chunksize):
+            yield source.iloc[start:start + chunksize]
+    elif os.path.splitext(source)[1].lower() == ".parquet":
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize, columns=columns):
+            chunk = batch.to_pandas()
+            yield chunk[chunk[chemical_name_column].isin(desired_chemical_names)]
+    else:
+        yield from iter_dataset_chunks(source, chemical_name_column, desired_chemical_names,
+                                       chunksize=chunksize, usecols=columns)
+
+
+def load_measurements(connection: sqlite3.Connection,
+                      source: str | pd.DataFrame,
+                      sample_id_columns: list[str],
+                      per_sample_data: list[str],
+                      chemical_name_column: str,
+                      desired_chemical_names: list[str],
+                      convert_to_standard: UnitTable,
+                      *,
+                      erase_invalid: bool = True,
+                      chunksize: int = 1000000
+                      ) -> int:
+    """
+    Cleans the measurements of `source` one chunk at a time with
+    `data_cleaning.clean_long_measurements` and inserts them into the
+    `MEASUREMENTS_TABLE`, replacing any earlier measurements.
+    Returns the number of measurements inserted.
+    """
+    group_columns = [*sample_id_columns, *per_sample_data, chemical_name_column]
+    connection.execute(f"DROP TABLE IF EXISTS {MEASUREMENTS_TABLE}")
+    rows = 0
+    for chunk in iter_source_chunks(source, [*group_columns, "Amount", "UOM", "MinDetectLimit"],
+                                    chemical_name_column, desired_chemical_names, chunksize):
+        chunk = dc.clean_long_measurements(
+            chunk, sample_id_columns, per_sample_data, chemical_name_column,
+            desired_chemical_names, convert_to_standard, erase_invalid)
+        chunk = chunk[[*group_columns, "Amount", "Prefix"]]
+        chunk = chunk.assign(Amount=chunk["Amount"].astype(float), Prefix=chunk["Prefix"].astype(object))
+        chunk.to_sql(MEASUREMENTS_TABLE, connection, if_exists="append", index=False)
+        rows += len(chunk)
+    connection.commit()
+    return rows
+
+
+def aggregate_amount_sql(policy: str = "default") -> str:
+    """
+    Returns the SQL expression aggregating the amounts of a chemical within
+    a sample, the same as `data_cleaning.finish_agg_long_measurement`.
+    """
+    all_below = "MIN(COALESCE(Prefix = '<', 0)) = 1"
+    mean = "SUM(Amount) / COUNT(Amount)"
+    detected_sum = "TOTAL(CASE WHEN COALESCE(Prefix = '<', 0) = 0 THEN Amount END)"
+    below_sum = "TOTAL(CASE WHEN Prefix = '<' THEN Amount END)"
+    detected_count = "COUNT(CASE WHEN COALESCE(Prefix = '<', 0) = 0 THEN Amount END)"
+    if policy == "default":
+        aggregated = f"CASE WHEN {all_below} THEN MIN(Amount) ELSE {mean} END"
+    elif policy == "max_dl":
+        aggregated = f"CASE WHEN {all_below} THEN MAX(Amount) ELSE {mean} END"
+    elif policy == "half_dl":
+        aggregated = f"({detected_sum} + {below_sum} / 2) / COUNT(Amount)"
+    elif policy == "detected":
+        aggregated = f"CASE WHEN {all_below} THEN MIN(Amount) ELSE {detected_sum} / {detected_count} END"
+    else:
+        raise ValueError('Invalid aggregation policy', policy)
+    # any missing amount makes the aggregate missing
+    return f"CASE WHEN MAX(Amount IS NULL) = 1 THEN NULL ELSE {aggregated} END"
+
+
+def clean_measurements_sql(connection: sqlite3.Connection,
+                           sample_id_columns: list[str],
+                           per_sample_data: list[str],
+                           chemical_name_column: str,
+                           desired_chemical_names: list[str],
+                           na_threshold: int,
+                           policy: str = "default"
+                           ) -> pd.DataFrame:
+    """
+    Aggregates, pivots, filters and fills the measurements loaded by
+    `load_measurements` in a single query.
+
+    Returns the same wide dataset as `data_cleaning.clean_long_dataset` followed by
+    `filter_rows_by_nas`, `fill_dataset_nans` (with `get_chemical_averages`) and `sort_columns`.
+    """
+    keys = [quote(column) for column in [*sample_id_columns, *per_sample_data]]
+    chemical = quote(chemical_name_column)
+
+    # like pandas, chemicals which were never measured have no columns
+    chemicals = sorted(name for (name,) in connection.execute(
+        f"SELECT DISTINCT {chemical} FROM {MEASUREMENTS_TABLE} WHERE {chemical} IS NOT NULL"))
+    if len(chemicals) == 0:
+        return pd.DataFrame()
+
+    not_null = " AND ".join(f"{key} IS NOT NULL" for key in [*keys, chemical])
+    amounts = [f"a{idx}" for idx in range(len(chemicals))]
+    prefixes = [f"p{idx}" for idx in range(len(chemicals))]
+    averages = [f"m{idx}" for idx in range(len(chemicals))]
+    pivot = ", ".join(
+        f"MAX(CASE WHEN chemical = ? THEN amount END) AS {amount}, "
+        f"MAX(CASE WHEN chemical = ? THEN prefix END) AS {prefix}"
+        for amount, prefix in zip(amounts, prefixes))
+    missing = " + ".join(f"({amount} IS NULL)" for amount in amounts)
+
+    query = f"""
+        WITH aggregated AS (
+            SELECT {", ".join(keys)}, {chemical} AS chemical,
+                {aggregate_amount_sql(policy)} AS amount,
+                CASE WHEN MIN(COALESCE(Prefix = '<', 0)) = 1 THEN '<' ELSE '=' END AS prefix
+            FROM {MEASUREMENTS_TABLE}
+            WHERE {not_null}
+            GROUP BY {", ".join(keys)}, {chemical}
+        ), wide AS (
+            SELECT {", ".join(keys)}, {pivot}
+            FROM aggregated
+            GROUP BY {", ".join(keys)}
+        ), filtered AS (
+            SELECT * FROM wide WHERE {missing} <= ?
+        ), averages AS (
+            SELECT {", ".join(f"AVG({amount}) AS {average}" for amount, average in zip(amounts, averages))}
+            FROM filtered
+        )
+        SELECT {", ".join(keys)},
+            {", ".join(f"COALESCE({amount}, {average}) AS {amount}, "
+                       f"CASE WHEN {amount} IS NULL THEN '=' ELSE {prefix} END AS {prefix}"
+                       for amount, prefix, average in zip(amounts, prefixes, averages))}
+        FROM filtered, averages
+        ORDER BY {", ".join(keys)}
+    """
+    params = [name for name in chemicals for _ in range(2)] + [na_threshold]
+    df = pd.read_sql_query(query, connection, params=params)
+
+    # chemicals without any amounts are removed, like `fill_dataset_nans`
+    columns = [(column, "") for column in [*sample_id_columns, *per_sample_data]]
+    for name in chemicals:
+        columns.extend([(name, "Amount"), (name, "Prefix")])
+    df.columns = pd.MultiIndex.from_tuples(columns)
+    df = df.astype({(name, "Amount"): float for name in chemicals})
+    empty = [name for name in chemicals if df[name, "Amount"].isna().all()]
+    df = df.drop(columns=empty, level=0)
+    return dc.sort_columns(df, [name for name in desired_chemical_names if name in chemicals and name not in empty])
+
+
+def clean_dataset(source: str | pd.DataFrame,
+                  sample_id_columns: list[str],
+                  per_sample_data: list[str],
+                  chemical_name_column: str,
+                  desired_chemical_names: list[str],
+                  convert_to_standard: UnitTable,
+                  na_threshold: int,
+                  *,
+                  backend: str = "pandas",
+                  erase_invalid: bool = True,
+                  policy: str = "default",
+                  database: str | None = None,
+                  chunksize: int = 1000000
+                  ) -> pd.DataFrame:
+    """
+    Cleans a long format dataset (a csv or parquet file, or a dataframe) into
+    the wide dataset: cleaning, aggregating duplicate measurements, pivoting,
+    filtering rows by NaNs and filling them with each chemical's average.
+
+    Parameters
+    ----------
+    `backend` : "pandas" runs `data_cleaning.clean_long_dataset` in memory.
+        "sqlite" aggregates, pivots, filters and fills in a SQLite database (see
+        `clean_measurements_sql`), only holding a chunk of `chunksize` rows in memory
+        while loading. Both give the same dataset, although averages
+        may differ in the last bits as SQLite adds the amounts in a different order.
+
+    `database` : The SQLite file to use (default a temporary file)
+
+    See `data_cleaning.clean_long_dataset` and `data_cleaning.filter_rows_by_nas`
+    for the other parameters.
+    """
+    if backend == "sqlite":
+        connection = connect(database)
+        try:
+            load_measurements(connection, source, sample_id_columns, per_sample_data, chemical_name_column,
+                              desired_chemical_names, convert_to_standard,
+                              erase_invalid=erase_invalid, chunksize=chunksize)
+            return clean_measurements_sql(connection, sample_id_columns, per_sample_data, chemical_name_column,
+                                          desired_chemical_names, na_threshold, policy)
+        finally:
+            connection.close()
+
+    if backend != "pandas":
+        raise ValueError('Invalid backend', backend)
+
+    if isinstance(source, pd.DataFrame):
+        df = source
+    elif os.path.splitext(source)[1].lower() == ".parquet":
+        df = pd.read_parquet(source)
+    else:
+        df = pd.read_csv(source)
+    df = dc.clean_long_dataset(df, sample_id_columns, per_sample_data, chemical_name_column,
+                               desired_chemical_names, convert_to_standard, erase_invalid, policy)
+    df = dc.filter_rows_by_nas(df, [name for name in desired_chemical_names if (name, "Amount") in df.columns],
+                               na_threshold)
+    names = [name for name in desired_chemical_names if (name, "Amount") in df.columns]
+    (amount_avgs, missing_chemicals) = dc.get_chemical_averages(df, names)
+    dc.fill_dataset_nans(df, names, amount_avgs, missing_chemicals)
+    return dc.sort_columns(df, [name for name in names if name not in missing_chemicals])
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import hashlib
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+from cleaning_utils import UnitTable
+
+
+# : `stage_cache.py` stores the output of each pipeline stage on disk under a key made from
+# : the stage's input, name, parameters, the settings it uses and the version of the code.
+# : A rerun with changed settings (eg `na_threshold`) loads the output of the last stage
+# : which did not change and only runs the stages after it, see `Pipeline.run`.
+
+
+# modules whose code the stages run, any change to them invalidates the cache
+CODE_MODULES = ["data_cleaning.py", "cleaning_utils.py", "schema.py", "pipeline.py", "sql_backend.py",
+                "spatial_imputation.py", "temporal.py", "stream_cleaning.py", "dedup.py", "lazy_cleaning.py",
+                "amount_parsing.py"]
+
+INDEX_FILE = "index.json"
+
+
+def normalize_value(value: Any) -> Any:
+    """
+    Converts stage parameters and settings to json values, so equal settings
+    always give the same fingerprint.
+    """
+    if isinstance(value, UnitTable):
+        return {"units": list(value.units), "offsets": value.offsets.tolist(),
+                "scales": value.scales.tolist(), "divisors": value.divisors.tolist()}
+    if isinstance(value, dict):
+        return {str(key): normalize_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, pd.Index)):
+        return [normalize_value(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def fingerprint(*values: Any) -> str:
+    """
+    Returns the sha256 hash of the json of the `values`.
+    """
+    text = json.dumps([normalize_value(value) for value in values], sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """
+    Returns a hash of the contents, columns and dtypes of a dataframe.
+    """
+    rows = pd.util.hash_pandas_object(df.astype(str), index=True).to_numpy()
+    return fingerprint(hashlib.sha256(rows.tobytes()).hexdigest(),
+                       [repr(column) for column in df.columns], [str(dtype) for dtype in df.dtypes])
+
+
+def code_version() -> str:
+    """
+    Returns a hash of the source of the `CODE_MODULES` and the versions of pandas and numpy.
+    """
+    sha256 = hashlib.sha256(f"{pd.__version__} {np.__version__}".encode("utf-8"))
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in CODE_MODULES:
+        with open(os.path.join(directory, module), "rb") as f:
+            sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+class StageCache:
+    """
+    Directory of stage outputs (pickled dataframes) keyed by `fingerprint`s.
+    When the outputs take more than `max_bytes` the least recently used are deleted.
+
+    Parameters
+    ----------
+    `directory` : Where the outputs are stored, created if missing
+
+    `max_bytes` : The most disk space the stored outputs may take
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 2 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pkl")
+
+    def read_index(self) -> dict[str, dict]:
+        """
+        Returns the stage, size and last time used of each stored output.
+        Outputs whose file was deleted are left out.
+        """
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return dict()
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        return {key: entry for key, entry in index.items() if os.path.exists(self.path(key))}
+
+    def write_index(self, index: dict[str, dict]) -> None:
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f, indent=4)
+        os.replace(index_path + ".tmp", index_path)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def load(self, key: str) -> pd.DataFrame:
+        """
+        Loads a stored output and marks it as used.
+        """
+        df = pd.read_pickle(self.path(key))
+        index = self.read_index()
+        if key in index:
+            index[key]["last_used"] = time.time()
+            self.write_index(index)
+        return df
+
+    def store(self, key: str, df: pd.DataFrame, stage: str) -> None:
+        """
+        Stores the output of a stage, then evicts the least recently used outputs
+        until they fit in `max_bytes`. An output larger than `max_bytes` is not kept.
+        """
+        df.to_pickle(self.path(key) + ".tmp")
+        os.replace(self.path(key) + ".tmp", self.path(key))
+        index = self.read_index()
+        index[key] = {"stage": stage, "bytes": os.path.getsize(self.path(key)), "last_used": time.time()}
+        self.write_index(self.evict(index))
+
+    def evict(self, index: dict[str, dict]) -> dict[str, dict]:
+        """
+        Deletes the least recently used outputs in the `index` until the rest fit
+        in `max_bytes`, returns the index of the outputs which are kept.
+        """
+        total = sum(entry["bytes"] for entry in index.values())
+        for key in sorted(index, key=lambda key: index[key]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= index[key]["bytes"]
+            os.remove(self.path(key))
+            del index[key]
+        return index
+
+    def total_bytes(self) -> int:
+        return sum(entry["bytes"] for entry in self.read_index().values())
+
+    def clear(self) -> None:
+        for key in self.read_index():
+            os.remove(self.path(key))
+        self.write_index(dict())
@@ -0,0 +1,121 @@
+from typing import Iterator
+
+import pandas as pd
+
+import data_cleaning as dc
+from cleaning_utils import pivot_measurements, UnitTable
+from dedup import DuplicateFilter
+
+
+# : `stream_cleaning.py` reads and cleans long format csv files in fixed size chunks,
+# : so memory use depends on the chunk size rather than the size of the file.
+
+
+def iter_dataset_chunks(
+        path: str | list[str],
+        chemical_name_column: str | None = None,
+        desired_chemical_names: list[str] | None = None,
+        *,
+        chunksize: int = 1000000,
+        duplicates: DuplicateFilter | None = None,
+        **read_csv_kwargs
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads the csv file at `path` (or each of a list of files) in chunks of at
+    most `chunksize` rows. If `desired_chemical_names` is given, only rows where the 
+    `chemical_name_column` is one of the desired chemicals are kept.
+
+    If a `DuplicateFilter` is given, rows which were already read (from any of
+    the files, or earlier files read with the same filter) are dropped.
+
+    Any other keyword arguments are passed to `pd.read_csv` 
+    eg `usecols` or `dtype`.
+    """
+    for file_path in [path] if isinstance(path, str) else path:
+        with pd.read_csv(file_path, chunksize=chunksize, **read_csv_kwargs) as reader:
+            for chunk in reader:
+                if desired_chemical_names is not None:
+                    chunk = chunk[chunk[chemical_name_column].isin(
+                        desired_chemical_names)]
+                if duplicates is not None:
+                    chunk = duplicates.drop_duplicates(chunk)
+                yield chunk
+
+
+def read_dataset(
+        path: str | list[str],
+        chemical_name_column: str | None = None,
+        desired_chemical_names: list[str] | None = None,
+        *,
+        chunksize: int = 1000000,
+        **read_csv_kwargs
+) -> pd.DataFrame:
+    """
+    Reads the whole csv file at `path` in chunks, keeping only the desired chemicals.
+    Replaces splitting large files into parts and concatenating them.
+    See `iter_dataset_chunks`.
+    """
+    return pd.concat(
+        iter_dataset_chunks(path, chemical_name_column, desired_chemical_names,
+                            chunksize=chunksize, **read_csv_kwargs),
+        ignore_index=True
+    )
+
+
+def stream_clean_dataset(
+        path: str | list[str],
+        sample_id_columns: list[str],
+        per_sample_data: list[str],
+        chemical_name_column: str,
+        desired_chemical_names: list[str],
+        convert_to_standard: UnitTable,
+        *,
+        erase_invalid: bool = True,
+        policy: str = "default",
+        chunksize: int = 1000000,
+        **read_csv_kwargs
+) -> pd.DataFrame:
+    """
+    Streaming version of `data_cleaning.clean_long_dataset`. 
+
+    Each chunk of the csv file is filtered to the desired chemicals, cleaned 
+    and partially aggregated. The partial aggregates of all the chunks are 
+    merged once, so a sample which is split across chunks still ends up as a 
+    single row once the dataset is pivoted at the end.
+
+    `policy` : How measurements below the detection limit are aggregated, 
+        see `data_cleaning.AGG_POLICIES`.
+
+    `duplicates` : A `dedup.DuplicateFilter` to drop repeated rows, eg where the parts
+        of an export overlap. Rows are compared on the columns read (`usecols`).
+
+    Only one chunk and the partial aggregates (one row per chemical within 
+    each sample of each chunk) are held in memory at a time.
+
+    Returns 
+    ---------
+    The pivoted dataset, the same as `data_cleaning.clean_long_dataset`.
+    """
+    group_columns = [*sample_id_columns, *per_sample_data, chemical_name_column]
+    read_csv_kwargs.setdefault(
+        "usecols", [*group_columns, "Amount", "UOM", "MinDetectLimit"])
+
+    # the partial aggregates are merged once at the end, rather than merging the
+    # growing aggregate of the earlier chunks again for every chunk
+    partials = []
+    for chunk in iter_dataset_chunks(path, chemical_name_column, desired_chemical_names,
+                                     chunksize=chunksize, **read_csv_kwargs):
+        chunk = dc.clean_long_measurements(
+            chunk, sample_id_columns, per_sample_data, chemical_name_column,
+            desired_chemical_names, convert_to_standard, erase_invalid)
+        partials.append(dc.partial_agg_long_measurement(chunk, group_columns))
+
+    partial = partials[0] if len(partials) == 1 else dc.merge_partial_measurements(partials)
+    df = dc.finish_agg_long_measurement(partial, policy)
+    return pivot_measurements(
+        df,
+        sample_id_columns=sample_id_columns,
+        per_sample_data=per_sample_data,
+        chemical_name_column=chemical_name_column,
+        values_per_chemical=["Amount", "Prefix"],
+    )
@@ -0,0 +1,262 @@
+import numpy as np
+import pandas as pd
+
+
+# : `temporal.py` treats each well's samples as a time series. Missing amounts are interpolated
+# : between the well's own samples, and series can be resampled to monthly or quarterly grids.
+# : The dataset is sorted once by (well, date) and every chemical is interpolated together in
+# : vectorized numpy operations, there is no loop over wells.
+
+
+INTERPOLATION_METHODS = ["linear", "previous", "nearest"]
+
+# pandas period frequencies of the resampling grids
+RESAMPLE_FREQUENCIES = {"monthly": "M", "quarterly": "Q", "yearly": "Y"}
+
+
+def column_values(df: pd.DataFrame, column: str) -> pd.Series:
+    """
+    Returns a per sample column of a long (flat columns) or pivoted (multiindex columns) dataset.
+    """
+    return df[column, ""] if isinstance(df.columns, pd.MultiIndex) else df[column]
+
+
+def well_codes(df: pd.DataFrame, well_columns: str | list[str]) -> np.ndarray:
+    """
+    Numbers the wells identified by the `well_columns` (eg `gm_well_id`, or
+    `Latitude` and `Longitude`). Rows with a missing well id are -1.
+    """
+    if isinstance(well_columns, str):
+        well_columns = [well_columns]
+    keys = pd.DataFrame({idx: column_values(df, column).to_numpy() for idx, column in enumerate(well_columns)})
+    codes = keys.groupby(list(keys.columns), sort=False, dropna=True).ngroup()
+    return codes.fillna(-1).to_numpy(dtype=np.int64)
+
+
+def sample_dates(df: pd.DataFrame,
+                 date_column: str,
+                 dayfirst: bool = False,
+                 date_format: str | None = None
+                 ) -> pd.Series:
+    """
+    Parses the sampling dates, invalid dates are NaT.
+    """
+    dates = column_values(df, date_column)
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates.reset_index(drop=True)
+    return pd.Series(pd.to_datetime(dates.to_numpy(), errors="coerce", dayfirst=dayfirst, format=date_format))
+
+
+def interpolate_sorted(wells: np.ndarray,
+                       times: np.ndarray,
+                       values: np.ndarray,
+                       method: str = "linear",
+                       max_gap: float | None = None
+                       ) -> np.ndarray:
+    """
+    Fills the NaNs of `values` (a column per chemical) between earlier and later
+    values of the same well. Rows must be sorted by well then time.
+
+    Parameters
+    ----------
+    `wells` : The well of each row
+
+    `times` : The time of each row (as numbers)
+
+    `method` : "linear" interpolates in time between the previous and next values,
+        "previous" uses the previous value and "nearest" the value closest in time
+
+    `max_gap` : Gaps longer than this (the time between the previous and next
+        values) are not filled
+
+    Returns
+    ---------
+    A boolean array, True where a NaN in `values` was filled (in place).
+    Gaps before the first or after the last value of a well are not filled.
+    """
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError('Invalid interpolation method', method)
+    n_rows = len(values)
+    if n_rows == 0:
+        return np.zeros(values.shape, dtype=bool)
+
+    # first and last row of each row's well
+    starts = np.searchsorted(wells, wells, side="left")[:, None]
+    ends = np.searchsorted(wells, wells, side="right")[:, None] - 1
+
+    rows = np.arange(n_rows)[:, None]
+    valid = ~np.isnan(values)
+    previous = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, rows, n_rows)[::-1], axis=0)[::-1]
+    filled = ~valid & (previous >= starts) & (following <= ends)
+
+    # only the gaps are estimated
+    (gap_rows, gap_columns) = np.nonzero(filled)
+    previous, following = previous[gap_rows, gap_columns], following[gap_rows, gap_columns]
+    gaps = times[following] - times[previous]
+    if max_gap is not None:
+        keep = gaps <= max_gap
+        filled[gap_rows[~keep], gap_columns[~keep]] = False
+        (gap_rows, gap_columns, previous, following, gaps) = \
+            (gap_rows[keep], gap_columns[keep], previous[keep], following[keep], gaps[keep])
+
+    previous_values, following_values = values[previous, gap_columns], values[following, gap_columns]
+    elapsed = times[gap_rows] - times[previous]
+    if method == "linear":
+        fraction = np.divide(elapsed, gaps, out=np.zeros(gaps.shape), where=gaps > 0)
+        values[gap_rows, gap_columns] = previous_values + (following_values - previous_values) * fraction
+    elif method == "previous":
+        values[gap_rows, gap_columns] = previous_values
+    else:
+        values[gap_rows, gap_columns] = np.where(elapsed <= gaps - elapsed, previous_values, following_values)
+    return filled
+
+
+def interpolate_by_well(df: pd.DataFrame,
+                        desired_chemical_names: list[str],
+                        well_columns: str | list[str],
+                        date_column: str,
+                        *,
+                        method: str = "linear",
+                        max_gap_days: float | None = None,
+                        dayfirst: bool = False,
+                        date_format: str | None = None
+                        ) -> None:
+    """
+    Fills the missing amounts of a pivoted dataset in place by interpolating between
+    the samples of the same well (see `interpolate_sorted`), filled prefixes are "=".
+    Amounts before a well's first or after its last measurement of a chemical, and
+    of samples without a well id or a valid date, are left missing
+    (eg for `data_cleaning.fill_dataset_nans`).
+
+    Parameters
+    ----------
+    `well_columns` : The per sample columns identifying a well
+
+    `date_column` : The per sample column of sampling dates
+
+    `max_gap_days` : Gaps between measurements longer than this are not filled
+
+    `dayfirst`, `date_format` : How to parse the dates, see `pd.to_datetime`
+    """
+    chemicals = [name for name in desired_chemical_names if (name, "Amount") in df.columns]
+    wells = well_codes(df, well_columns)
+    times = sample_dates(df, date_column, dayfirst, date_format).to_numpy(dtype="datetime64[ns]")
+    # sort once by well and date, rows without either are not interpolated
+    rows = np.flatnonzero((wells >= 0) & ~np.isnat(times))
+    rows = rows[np.lexsort((times[rows], wells[rows]))]
+    if len(rows) == 0 or len(chemicals) == 0:
+        return
+
+    values = np.column_stack([df[name, "Amount"].to_numpy(dtype=float)[rows] for name in chemicals])
+    days = times[rows].astype(np.int64) / (24 * 60 * 60 * 1e9)
+    filled = interpolate_sorted(wells[rows], days, values, method, max_gap_days)
+
+    for idx, name in enumerate(chemicals):
+        filled_rows = rows[filled[:, idx]]
+        if len(filled_rows) == 0:
+            continue
+        amounts = df[name, "Amount"]
+        prefixes = df[name, "Prefix"]
+        dtype = np.float32 if amounts.dtype == np.float32 else float
+        amounts = amounts.to_numpy(dtype=float, copy=True)
+        amounts[filled_rows] = values[filled[:, idx], idx]
+        mask = np.zeros(len(df), dtype=bool)
+        mask[filled_rows] = True
+        if not isinstance(prefixes.dtype, pd.CategoricalDtype):
+            prefixes = prefixes.astype(object)
+        df[name, "Amount"] = amounts.astype(dtype)
+        df[name, "Prefix"] = prefixes.mask(mask, "=")
+
+
+def resample_by_well(df: pd.DataFrame,
+                     desired_chemical_names: list[str],
+                     well_columns: str | list[str],
+                     date_column: str,
+                     frequency: str = "monthly",
+                     *,
+                     interpolate: bool = True,
+                     method: str = "linear",
+                     max_gap_periods: int | None = None,
+                     dayfirst: bool = False,
+                     date_format: str | None = None
+                     ) -> pd.DataFrame:
+    """
+    Resamples each well's series of a pivoted dataset to a regular grid of periods.
+
+    Amounts of the samples of a well within a period are averaged, the prefix is "<"
+    if all of them were below the detection limit. The grid of each well runs from its
+    first to its last sampled period, so wells sampled over decades have hundreds of
+    rows. Periods without samples are interpolated between the well's sampled periods
+    (by period, see `interpolate_sorted`) unless `interpolate` is False.
+
+    Parameters
+    ----------
+    `frequency` : "monthly", "quarterly" or "yearly"
+
+    `max_gap_periods` : Gaps longer than this many periods are not interpolated
+
+    See `interpolate_by_well` for the other parameters.
+
+    Returns
+    ---------
+    A pivoted dataset with the `well_columns`, the `date_column` (the start of each period)
+    and the Amount and Prefix of each chemical, sorted by well and period
+    (with no rows if none of the chemicals are in `df`).
+    """
+    if frequency not in RESAMPLE_FREQUENCIES:
+        raise ValueError('Invalid resampling frequency', frequency)
+    if isinstance(well_columns, str):
+        well_columns = [well_columns]
+    chemicals = [name for name in desired_chemical_names if (name, "Amount") in df.columns]
+    if len(chemicals) == 0:
+        # nothing to resample, an empty grid
+        columns = {(column, ""): column_values(df, column).to_numpy()[:0] for column in well_columns}
+        columns[date_column, ""] = np.array([], dtype="datetime64[ns]")
+        return pd.DataFrame(columns)
+
+    wells = well_codes(df, well_columns)
+    periods = sample_dates(df, date_column, dayfirst, date_format).dt.to_period(RESAMPLE_FREQUENCIES[frequency])
+    ordinals = periods.array.asi8
+    rows = np.flatnonzero((wells >= 0) & periods.notna().to_numpy())
+    wells, ordinals = wells[rows], ordinals[rows]
+
+    amounts = pd.DataFrame({idx: df[name, "Amount"].to_numpy(dtype=float)[rows] for idx, name in enumerate(chemicals)})
+    below = pd.DataFrame({idx: (df[name, "Prefix"].to_numpy()[rows] == "<") & amounts[idx].notna().to_numpy()
+                          for idx, name in enumerate(chemicals)})
+    # the mean, number of values and number below the detection limit in each sampled period
+    means = amounts.groupby([wells, ordinals], sort=True).mean()
+    counts = pd.concat([amounts.notna(), below], axis=1, keys=["Count", "Below"]) \
+        .groupby([wells, ordinals], sort=True).sum()
+    all_below = (counts["Below"].to_numpy() == counts["Count"].to_numpy()) & (counts["Count"].to_numpy() > 0)
+    sampled_wells = means.index.get_level_values(0).to_numpy(dtype=np.int64)
+    sampled_ordinals = means.index.get_level_values(1).to_numpy(dtype=np.int64)
+
+    # every period from the first to the last sampled period of each well
+    (well_ids, first_sampled, n_sampled) = np.unique(sampled_wells, return_index=True, return_counts=True)
+    firsts = sampled_ordinals[first_sampled]
+    lengths = sampled_ordinals[first_sampled + n_sampled - 1] - firsts + 1
+    grid_starts = np.cumsum(lengths) - lengths
+    grid_wells = np.repeat(well_ids, lengths)
+    grid_ordinals = np.repeat(firsts - grid_starts, lengths) + np.arange(lengths.sum())
+    positions = np.repeat(grid_starts - firsts, n_sampled) + sampled_ordinals
+
+    grid_amounts = np.full((len(grid_wells), len(chemicals)), np.nan)
+    grid_amounts[positions] = means.to_numpy()
+    grid_prefixes = np.full(grid_amounts.shape, np.nan, dtype=object)
+    grid_prefixes[positions] = np.where(all_below, "<", "=")
+    grid_prefixes[np.isnan(grid_amounts)] = np.nan
+    if interpolate:
+        filled = interpolate_sorted(grid_wells, grid_ordinals.astype(float), grid_amounts, method, max_gap_periods)
+        grid_prefixes[filled] = "="
+
+    # well ids from the first sample of each well
+    first_rows = rows[np.unique(wells, return_index=True)[1]]
+    grid_rows = np.repeat(first_rows, lengths)
+    columns = {(column, ""): column_values(df, column).to_numpy()[grid_rows] for column in well_columns}
+    columns[date_column, ""] = pd.PeriodIndex(pd.arrays.PeriodArray(
+        grid_ordinals, dtype=pd.PeriodDtype(RESAMPLE_FREQUENCIES[frequency]))).to_timestamp()
+    for idx, name in enumerate(chemicals):
+        columns[name, "Amount"] = grid_amounts[:, idx]
+        columns[name, "Prefix"] = grid_prefixes[:, idx]
+    return pd.DataFrame(columns)